@@ -0,0 +1,306 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+
+import metrics
+from config import Config
+
+# TPM 统计窗口（秒）
+_TPM_WINDOW = 60
+
+# 队列已满或排队超时时建议客户端等待的秒数
+_SHED_RETRY_AFTER = 1
+
+# 每隔多少秒清理一次空闲的客户端记录
+_SWEEP_INTERVAL = _TPM_WINDOW
+
+_lock = threading.Lock()
+# 有进行中请求、排队请求或 TPM 窗口内用量的客户端；空闲后移除，避免来源地址等 key 无限增长
+_clients = {}
+# 有排队请求的客户端，_dispatch 只扫描这些
+_waiting = {}
+_last_sweep = time.monotonic()
+_inflight = 0
+_queued = 0
+
+_STATS = {
+    'admitted': 0,
+    'queued': 0,
+    'rejected_queue_full': 0,
+    'rejected_timeout': 0,
+    'rejected_tpm': 0,
+}
+
+
+class Rejected(Exception):
+    """请求被准入控制拒绝，调用方应返回 429 并带上 Retry-After"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class _Client:
+    """一个客户端（接入 Key 或来源地址）的并发、排队与 token 用量"""
+
+    __slots__ = ('client_id', 'weight', 'active', 'waiters', 'current', 'usage', 'tokens')
+
+    def __init__(self, client_id, weight):
+        self.client_id = client_id
+        self.weight = weight
+        self.active = 0
+        self.waiters = deque()
+        self.current = 0  # 平滑加权轮询的当前权重
+        self.usage = deque()  # (时间, token 数)
+        self.tokens = 0
+
+    def _recent_tokens(self, now):
+        while self.usage and now - self.usage[0][0] >= _TPM_WINDOW:
+            self.tokens -= self.usage.popleft()[1]
+        return self.tokens
+
+    def idle(self, now):
+        """没有进行中和排队的请求，TPM 窗口内也没有需要计入限额的用量"""
+        if self.active or self.waiters:
+            return False
+        return Config.ADMISSION_PER_KEY_TPM <= 0 or not self._recent_tokens(now)
+
+
+class _Waiter:
+    __slots__ = ('client', 'granted', 'wake')
+
+    def __init__(self, client, wake):
+        self.client = client
+        self.granted = False
+        self.wake = wake
+
+
+class Ticket:
+    """已获准的一次上游请求；请求结束时调用 release，重复调用无副作用"""
+
+    __slots__ = ('_client', '_released')
+
+    def __init__(self, client):
+        self._client = client
+        self._released = False
+
+    def release(self, tokens=0):
+        """释放并发名额，tokens 计入该客户端的 TPM"""
+        global _inflight
+        with _lock:
+            if self._released:
+                return
+            self._released = True
+            _inflight -= 1
+            self._client.active -= 1
+            if tokens:
+                self._client.usage.append((time.monotonic(), tokens))
+                self._client.tokens += tokens
+            _dispatch()
+            _forget_if_idle(self._client)
+        metrics.ADMISSION_INFLIGHT.dec()
+
+
+def _parse_weights():
+    """ADMISSION_WEIGHTS 为逗号分隔的 客户端:权重 列表，未列出的客户端权重为 1"""
+    weights = {}
+    for item in Config.ADMISSION_WEIGHTS.split(','):
+        client_id, sep, weight = item.strip().rpartition(':')
+        if sep and client_id:
+            weights[client_id] = max(int(weight), 1)
+    return weights
+
+
+_WEIGHTS = _parse_weights()
+
+
+def _get_client(client_id):
+    client = _clients.get(client_id)
+    if client is None:
+        client = _clients[client_id] = _Client(client_id, _WEIGHTS.get(client_id, 1))
+    return client
+
+
+def _forget_if_idle(client, now=None):
+    """客户端空闲时移除其记录（需持有 _lock）；下次请求重新创建，平滑轮询的权重从 0 开始"""
+    if client.idle(time.monotonic() if now is None else now) and _clients.get(client.client_id) is client:
+        del _clients[client.client_id]
+
+
+def _sweep(now):
+    """定期移除 TPM 用量已过期、之后没有再请求的客户端（需持有 _lock）"""
+    global _last_sweep
+    if now - _last_sweep < _SWEEP_INTERVAL:
+        return
+    _last_sweep = now
+    for client in list(_clients.values()):
+        _forget_if_idle(client, now)
+
+
+def _add_waiter(client, waiter):
+    global _queued
+    client.waiters.append(waiter)
+    _waiting[client.client_id] = client
+    _queued += 1
+
+
+def _remove_waiter(client, waiter=None):
+    """移出 waiter（为 None 时移出队首）并返回；队列空了的客户端不再参与 _dispatch（需持有 _lock）"""
+    global _queued
+    if waiter is None:
+        waiter = client.waiters.popleft()
+    else:
+        client.waiters.remove(waiter)
+    if not client.waiters:
+        del _waiting[client.client_id]
+    _queued -= 1
+    return waiter
+
+
+def _has_capacity(client):
+    per_key = Config.ADMISSION_PER_KEY_CONCURRENCY
+    return per_key <= 0 or client.active < per_key
+
+
+def _grant(client):
+    global _inflight
+    _inflight += 1
+    client.active += 1
+    _STATS['admitted'] += 1
+
+
+def _dispatch():
+    """有空闲名额时按平滑加权轮询从各客户端队首放行（需持有 _lock）"""
+    while _inflight < Config.ADMISSION_MAX_INFLIGHT:
+        eligible = [c for c in _waiting.values() if _has_capacity(c)]
+        if not eligible:
+            return
+        total = 0
+        for client in eligible:
+            client.current += client.weight
+            total += client.weight
+        client = max(eligible, key=lambda c: c.current)
+        client.current -= total
+        waiter = _remove_waiter(client)
+        waiter.granted = True
+        _grant(client)
+        metrics.ADMISSION_QUEUE_DEPTH.dec()
+        waiter.wake()
+
+
+def _enqueue(client_id, wake):
+    """登记请求：能直接放行时返回 (Ticket, None)，否则返回 (None, 排队的 waiter)"""
+    now = time.monotonic()
+    with _lock:
+        _sweep(now)
+        client = _get_client(client_id)
+        limit = Config.ADMISSION_PER_KEY_TPM
+        if limit > 0 and client._recent_tokens(now) >= limit:
+            _STATS['rejected_tpm'] += 1
+            retry_after = client.usage[0][0] + _TPM_WINDOW - now
+            reason = 'tpm'
+        elif _queued >= Config.ADMISSION_QUEUE_SIZE:
+            _STATS['rejected_queue_full'] += 1
+            retry_after = _SHED_RETRY_AFTER
+            reason = 'queue_full'
+            _forget_if_idle(client, now)
+        else:
+            waiter = _Waiter(client, wake)
+            _add_waiter(client, waiter)
+            metrics.ADMISSION_QUEUE_DEPTH.inc()
+            _dispatch()
+            if waiter.granted:
+                return Ticket(client), None
+            _STATS['queued'] += 1
+            return None, waiter
+    metrics.ADMISSION_REJECTED.inc((reason,))
+    raise Rejected(reason, retry_after)
+
+
+def _finish_wait(waiter, started):
+    """等待结束：已放行返回 Ticket，超时则移出队列并拒绝"""
+    with _lock:
+        granted = waiter.granted
+        if not granted:
+            _remove_waiter(waiter.client, waiter)
+            _forget_if_idle(waiter.client)
+            _STATS['rejected_timeout'] += 1
+    metrics.ADMISSION_WAIT_SECONDS.observe((), time.perf_counter() - started)
+    if granted:
+        metrics.ADMISSION_INFLIGHT.inc()
+        return Ticket(waiter.client)
+    metrics.ADMISSION_QUEUE_DEPTH.dec()
+    metrics.ADMISSION_REJECTED.inc(('timeout',))
+    raise Rejected('timeout', _SHED_RETRY_AFTER)
+
+
+def admit(client_id):
+    """请求上游前调用：未开启准入控制时返回 None；否则阻塞至获准，返回 Ticket
+
+    超出 TPM、队列已满或排队超过 ADMISSION_QUEUE_TIMEOUT 时抛出 Rejected。
+    """
+    if not Config.ADMISSION_CONTROL:
+        return None
+    event = threading.Event()
+    ticket, waiter = _enqueue(client_id, event.set)
+    if ticket is not None:
+        metrics.ADMISSION_INFLIGHT.inc()
+        return ticket
+    started = time.perf_counter()
+    event.wait(Config.ADMISSION_QUEUE_TIMEOUT)
+    return _finish_wait(waiter, started)
+
+
+async def admit_async(client_id):
+    """admit 的 asyncio 版本，排队时不占用事件循环"""
+    if not Config.ADMISSION_CONTROL:
+        return None
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def wake():
+        loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+    ticket, waiter = _enqueue(client_id, wake)
+    if ticket is not None:
+        metrics.ADMISSION_INFLIGHT.inc()
+        return ticket
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(future, Config.ADMISSION_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    except asyncio.CancelledError:
+        _abandon(waiter)
+        raise
+    return _finish_wait(waiter, started)
+
+
+def _abandon(waiter):
+    """客户端在排队时断开：已放行则归还名额，否则移出队列"""
+    with _lock:
+        granted = waiter.granted
+        if not granted:
+            _remove_waiter(waiter.client, waiter)
+            _forget_if_idle(waiter.client)
+    if granted:
+        metrics.ADMISSION_INFLIGHT.inc()
+        Ticket(waiter.client).release()
+    else:
+        metrics.ADMISSION_QUEUE_DEPTH.dec()
+
+
+def stats():
+    """准入控制统计，供 /health 输出"""
+    with _lock:
+        result = dict(_STATS)
+        result.update(
+            enabled=Config.ADMISSION_CONTROL,
+            inflight=_inflight,
+            queue_depth=_queued,
+            clients=len(_clients),
+        )
+    return result
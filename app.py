@@ -1,21 +1,44 @@
 import json
 import logging
+import random
+import time
 
 import requests
 from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
-
+from werkzeug.exceptions import BadRequest
+
+import admission
+import cancellation
+import coalesce
+import context_compaction
+import conversion_cache
+import image_cache
+import json_codec
+import metrics
+import response_cache
+import routing
+import tool_cache
 from config import Config
 from openai_adapter import (
     anthropic_to_openai_response,
-    anthropic_to_openai_stream_chunk,
-    init_stream_state,
-    cleanup_stream_state,
+    encode_anthropic_request,
+    gen_stream_id,
     openai_to_anthropic_request,
 )
+from prompt_cache import cache_stats
+from sse_transcoder import SSETranscoder
+from tool_use_fixer import repair_stats
+from traffic_capture import capture_stats, start_recording
+from upstream import get_session, iter_stream_bytes, pool_stats, relay_headers
 
 logger = logging.getLogger(__name__)
 
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
 
 def create_app():
     app = Flask(__name__)
@@ -26,164 +49,263 @@ def create_app():
         """接入鉴权：校验 ACCESS_API_KEY"""
         if not Config.ACCESS_API_KEY:
             return  # 未配置则不鉴权
-        if request.path == '/health':
-            return  # 健康检查跳过鉴权
-
-        auth = request.headers.get('Authorization', '')
-        token = ''
-        if auth.startswith('Bearer '):
-            token = auth[7:]
-        if not token:
-            token = request.headers.get('x-api-key', '')
-
-        if token != Config.ACCESS_API_KEY:
-            logger.warning(f'[auth] rejected {request.path}')
+        if request.path in ('/health', '/metrics'):
+            return  # 健康检查与监控采集跳过鉴权
+
+        if _extract_access_token(request.headers) != Config.ACCESS_API_KEY:
+            logger.warning('[auth] rejected %s', request.path)
             return jsonify({
                 'error': {'message': 'Invalid API key', 'type': 'authentication_error'}
             }), 401
 
     @app.route('/health', methods=['GET'])
     def health():
-        return jsonify({'status': 'ok', 'target': Config.PROXY_TARGET_URL})
+        return jsonify({
+            'status': 'ok',
+            'target': Config.PROXY_TARGET_URL,
+            'pool': pool_stats(),
+            'routing': routing.stats(),
+            'admission': admission.stats(),
+            'prompt_cache': cache_stats(),
+            'conversion_cache': conversion_cache.stats(),
+            'compaction': context_compaction.stats(),
+            'image_cache': image_cache.stats(),
+            'json': json_codec.stats(),
+            'tool_cache': tool_cache.stats(),
+            'tool_repair': repair_stats(),
+            'capture': capture_stats(),
+            'response_cache': response_cache.stats(),
+            'coalescing': coalesce.stats(),
+            'cancellation': cancellation.stats(),
+        })
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
     @app.route('/v1/chat/completions', methods=['POST'])
     def chat_completions():
         """OpenAI 兼容接口 — 主路由"""
-        payload = request.get_json(force=True)
+        payload = _request_json()
         is_stream = payload.get('stream', False)
         model = payload.get('model', 'unknown')
         msg_count = len(payload.get('messages', []))
-        logger.info(f'[chat] model={model} stream={is_stream} messages={msg_count}')
-
-        # 记录每条消息的摘要
-        for i, msg in enumerate(payload.get('messages', [])):
-            role = msg.get('role', '?')
-            content = msg.get('content')
-            content_type = type(content).__name__
-            has_tc = 'tool_calls' in msg
-            tc_count = len(msg.get('tool_calls', []))
-            tc_id = msg.get('tool_call_id', '')
-            if isinstance(content, list):
-                types = [p.get('type','?') if isinstance(p,dict) else 'str' for p in content]
-                content_info = f'list[{len(content)}] types={types}'
-            elif isinstance(content, str):
-                content_info = f'str[{len(content)}]'
-            elif content is None:
-                content_info = 'None'
-            else:
-                content_info = content_type
-            extra = ''
-            if has_tc:
-                extra += f' tool_calls={tc_count}'
-            if tc_id:
-                extra += f' tool_call_id={tc_id}'
-            logger.info(f'[chat]   msg[{i}] role={role} content={content_info}{extra}')
+        logger.info('[chat] model=%s stream=%s messages=%d', model, is_stream, msg_count)
+
+        _log_payload_summary(payload)
+        request_metrics = metrics.RequestMetrics(model, is_stream)
+        recording = start_recording(payload, is_stream)
 
         # 转换请求
+        started = time.perf_counter()
         anthropic_payload = openai_to_anthropic_request(payload)
-        logger.debug(f'[chat] anthropic_payload: {json.dumps(anthropic_payload, ensure_ascii=False)}')
-
-        # 准备请求头
-        headers = _prepare_headers()
-        headers['Content-Type'] = 'application/json'
+        conversion_seconds = time.perf_counter() - started
+        request_metrics.conversion(conversion_seconds)
+        if recording is not None:
+            recording.converted(anthropic_payload, conversion_seconds)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('[chat] anthropic_payload: %s', json.dumps(anthropic_payload, ensure_ascii=False))
+
+        anthropic_payload['stream'] = bool(is_stream)
+        body = encode_anthropic_request(anthropic_payload)
+
+        cache_key = response_cache.cache_key(anthropic_payload, body)
+        cached = response_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            logger.info('[chat] response cache hit')
+            if is_stream:
+                return Response(response_cache.replay_stream(cached), content_type='text/event-stream',
+                                headers=SSE_HEADERS)
+            return _json_response(anthropic_to_openai_response(json_codec.loads(cached)))
+
+        # 相同请求正在请求上游时直接加入，共用同一次上游调用
+        flight = None
+        flight_key = coalesce.flight_key(body)
+        if flight_key:
+            flight, cursor = coalesce.join(flight_key)
+            if cursor is not None:
+                logger.info('[chat] joined in-flight upstream call')
+                request_metrics.coalesced()
+                if is_stream:
+                    return _join_stream(flight, cursor, request_metrics, recording)
+                return _join_non_stream(flight, cursor, request_metrics, recording)
 
-        target_url = f'{Config.PROXY_TARGET_URL.rstrip("/")}/v1/messages'
+        try:
+            ticket = admission.admit(_client_id(request.headers, request.remote_addr))
+        except admission.Rejected as e:
+            logger.warning('[chat] rejected by admission control: %s', e.reason)
+            if flight is not None:
+                flight.close(f'rejected by admission control: {e.reason}')
+            if recording is not None:
+                recording.finish()
+            return _rejected_response(e)
 
         if is_stream:
-            anthropic_payload['stream'] = True
-            return _handle_stream(target_url, headers, anthropic_payload)
-        else:
-            anthropic_payload['stream'] = False
-            return _handle_non_stream(target_url, headers, anthropic_payload)
+            guard = cancellation.StreamGuard(
+                'chat', anthropic_payload.get('max_tokens'), request.environ.get('waitress.client_disconnected'))
+            response = _handle_stream(body, request_metrics, recording, cache_key, flight, guard)
+            # 流结束或客户端断开时由 WSGI 服务器调用 close，生成器未启动时也会执行
+            if flight is not None:
+                # 生成器未启动就被关闭时 finally 不会执行，跟随者会一直等到 API_TIMEOUT；
+                # 正常结束时 flight 已关闭，close 只有第一次调用生效
+                response.call_on_close(lambda: flight.close('upstream stream aborted'))
+            if ticket is not None:
+                response.call_on_close(lambda: ticket.release(request_metrics.tokens))
+            return response
+        try:
+            return _handle_non_stream(body, request_metrics, recording, cache_key, flight)
+        finally:
+            if ticket is not None:
+                ticket.release(request_metrics.tokens)
 
     @app.route('/v1/messages', methods=['POST'])
     def messages_passthrough():
         """Anthropic 原生格式透传"""
-        payload = request.get_json(force=True)
+        payload = _request_json()
         model = payload.get('model', 'unknown')
         is_stream = payload.get('stream', False)
-        logger.info(f'[passthrough] model={model} stream={is_stream}')
-
-        headers = _prepare_headers()
-        headers['Content-Type'] = 'application/json'
-
-        target_url = f'{Config.PROXY_TARGET_URL.rstrip("/")}/v1/messages'
-        is_stream = payload.get('stream', False)
+        logger.info('[passthrough] model=%s stream=%s', model, is_stream)
 
         try:
-            resp = requests.post(
-                target_url,
-                headers=headers,
-                json=payload,
-                timeout=Config.API_TIMEOUT,
-                stream=is_stream,
-            )
+            ticket = admission.admit(_client_id(request.headers, request.remote_addr))
+        except admission.Rejected as e:
+            logger.warning('[passthrough] rejected by admission control: %s', e.reason)
+            return _rejected_response(e)
 
-            if is_stream:
-                def generate():
-                    for line in resp.iter_lines():
-                        if line:
-                            yield line.decode('utf-8', errors='replace') + '\n\n'
-
-                return Response(generate(), content_type='text/event-stream')
-            else:
-                return Response(
-                    resp.content,
-                    status=resp.status_code,
-                    content_type=resp.headers.get('Content-Type', 'application/json'),
-                )
+        try:
+            resp, upstream = _send_upstream(request.get_data(), stream=is_stream)
         except requests.RequestException as e:
-            logger.error(f'[passthrough] request error: {e}')
+            logger.error('[passthrough] request error: %s', e)
+            if ticket is not None:
+                ticket.release()
             return jsonify({'error': {'message': str(e), 'type': 'proxy_error'}}), 502
 
-    def _handle_non_stream(target_url, headers, anthropic_payload):
+        if is_stream:
+            guard = cancellation.StreamGuard(
+                'messages', payload.get('max_tokens'), request.environ.get('waitress.client_disconnected'))
+
+            def generate():
+                # 原样转发上游字节，保留 SSE 分帧，不解析也不重新编码
+                try:
+                    for data in iter_stream_bytes(resp):
+                        if guard.client_gone():
+                            return
+                        yield data
+                except requests.RequestException as e:
+                    logger.error('[passthrough] stream error: %s', e)
+                except GeneratorExit:
+                    guard.cancel()
+                    raise
+                finally:
+                    # 归还连接到池，客户端提前断开时也不泄漏（未读完的连接直接关闭）
+                    resp.close()
+                    upstream.release()
+                    guard.finish()
+
+            response = Response(generate(), status=resp.status_code, headers=relay_headers(resp.headers))
+            if ticket is not None:
+                response.call_on_close(ticket.release)
+            return response
+
+        upstream.release()
+        if ticket is not None:
+            ticket.release()
+        return Response(resp.content, status=resp.status_code, headers=relay_headers(resp.headers))
+
+    def _handle_non_stream(body, request_metrics, recording, cache_key, flight):
         """处理非流式请求"""
+        upstream = None
         try:
-            resp = requests.post(
-                target_url,
-                headers=headers,
-                json=anthropic_payload,
-                timeout=Config.API_TIMEOUT,
-            )
-
-            if resp.status_code != 200:
-                logger.warning(f'[chat] upstream error {resp.status_code}')
-                return Response(
-                    resp.content,
-                    status=resp.status_code,
-                    content_type=resp.headers.get('Content-Type', 'application/json'),
-                )
-
-            anthropic_data = resp.json()
-            openai_response = anthropic_to_openai_response(anthropic_data)
-            usage = openai_response.get('usage', {})
-            logger.info(f'[chat] done prompt={usage.get("prompt_tokens", 0)} completion={usage.get("completion_tokens", 0)}')
-            return jsonify(openai_response)
+            resp, upstream = _send_upstream(body, request_metrics)
+            content_type = resp.headers.get('Content-Type', 'application/json')
+            if flight is not None:
+                flight.respond(resp.status_code, content_type)
+                flight.publish(resp.content)
+                flight.close()
+            return _non_stream_response(resp.status_code, resp.content, content_type,
+                                        request_metrics, recording, cache_key)
 
         except requests.RequestException as e:
-            logger.error(f'[chat] request error: {e}')
+            logger.error('[chat] request error: %s', e)
+            request_metrics.error('proxy_error')
+            if flight is not None:
+                flight.close(str(e))
             return jsonify({'error': {'message': str(e), 'type': 'proxy_error'}}), 502
-
-    def _handle_stream(target_url, headers, anthropic_payload):
-        """处理流式请求"""
-        request_id = f'chatcmpl-stream-{id(request)}'
+        finally:
+            if upstream is not None:
+                upstream.release()
+            if flight is not None:
+                flight.close('upstream call aborted')
+            if recording is not None:
+                recording.finish()
+
+    def _join_non_stream(flight, cursor, request_metrics, recording):
+        """处理非流式请求：等待相同请求的上游调用结束，复用其响应"""
+        try:
+            status = flight.wait_response()
+            content = b''.join(flight.subscribe(cursor))
+            return _non_stream_response(status, content, flight.content_type, request_metrics, recording)
+        except coalesce.FlightError as e:
+            logger.error('[chat] coalesced request error: %s', e)
+            request_metrics.error('proxy_error')
+            return jsonify({'error': {'message': str(e), 'type': 'proxy_error'}}), 502
+        finally:
+            flight.leave(cursor)
+            if recording is not None:
+                recording.finish()
+
+    def _non_stream_response(status, content, content_type, request_metrics, recording, cache_key=None):
+        """把上游的非流式响应转换为 OpenAI 格式"""
+        if recording is not None:
+            recording.upstream_response(status)
+            recording.upstream_data(content)
+
+        if status != 200:
+            logger.warning('[chat] upstream error %s', status)
+            return Response(content, status=status, content_type=content_type)
+
+        anthropic_data = json_codec.loads(content)
+        openai_response = anthropic_to_openai_response(anthropic_data)
+        request_metrics.finish(anthropic_data.get('usage'))
+        if cache_key and response_cache.should_store(anthropic_data.get('stop_reason')):
+            response_cache.put(cache_key, content)
+        if recording is not None:
+            recording.request_id = openai_response['id']
+            recording.output_data(openai_response)
+        usage = openai_response.get('usage', {})
+        logger.info('[chat] done prompt=%s completion=%s', usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+        return _json_response(openai_response)
+
+    def _handle_stream(body, request_metrics, recording, cache_key, flight, guard):
+        """处理流式请求
+
+        客户端断开后 waitress 在下一次写出时关闭生成器；没有数据可写时（ping、缓冲的工具参数）
+        也在每次收到上游数据后检查 guard，及早关闭上游响应、释放连接。
+        """
+        request_id = gen_stream_id()
+        if recording is not None:
+            recording.request_id = request_id
 
         def generate():
-            init_stream_state(request_id)
-            event_type = ''
+            resp = None
+            upstream = None
+            transcoder = None
             try:
-                resp = requests.post(
-                    target_url,
-                    headers=headers,
-                    json=anthropic_payload,
-                    timeout=Config.API_TIMEOUT,
-                    stream=True,
-                )
+                resp, upstream = _send_upstream(body, request_metrics, stream=True)
+                if guard.client_gone():
+                    return
+                if recording is not None:
+                    recording.upstream_response(resp.status_code)
+                if flight is not None:
+                    flight.respond(resp.status_code)
 
                 if resp.status_code != 200:
+                    if flight is not None:
+                        flight.publish(resp.content)
+                        flight.close()
                     error_body = resp.content.decode('utf-8', errors='replace')
-                    logger.warning(f'[stream] upstream error {resp.status_code}: {error_body[:200]}')
-                    error_chunk = json.dumps({
+                    logger.warning('[stream] upstream error %s: %.200s', resp.status_code, error_body)
+                    error_chunk = json_codec.dumps({
                         'error': {
                             'message': f'Upstream error {resp.status_code}: {error_body}',
                             'type': 'upstream_error',
@@ -192,66 +314,267 @@ def create_app():
                     yield f'data: {error_chunk}\n\n'
                     return
 
-                for line in resp.iter_lines():
-                    if not line:
-                        continue
-                    decoded = line.decode('utf-8', errors='replace')
-
-                    if decoded.startswith('event:'):
-                        event_type = decoded[6:].strip()
-                        continue
-
-                    if decoded.startswith('data:'):
-                        data_str = decoded[5:].strip()
-                        if not data_str:
-                            continue
-                        try:
-                            event_data = json.loads(data_str)
-                        except json.JSONDecodeError:
-                            continue
-
-                        logger.debug(f'[stream] event={event_type} data_keys={list(event_data.keys()) if isinstance(event_data, dict) else "?"}')
-                        if event_type == 'content_block_start':
-                            block = event_data.get('content_block', {})
-                            logger.info(f'[stream] content_block_start type={block.get("type")} name={block.get("name", "")}')
-
-                        chunks = anthropic_to_openai_stream_chunk(
-                            event_type, event_data, request_id
-                        )
-                        for chunk_str in chunks:
-                            yield f'data: {chunk_str}\n\n'
-
-                yield 'data: [DONE]\n\n'
+                request_metrics.stream_started()
+                transcoder = SSETranscoder(request_id)
+                # 可缓存的请求保留上游原始字节，结束后写入响应缓存
+                raw_chunks = [] if cache_key else None
+                for data in iter_stream_bytes(resp):
+                    if guard.client_gone():
+                        return
+                    if flight is not None:
+                        flight.publish(data)
+                    if raw_chunks is not None:
+                        raw_chunks.append(data)
+                    if recording is not None:
+                        recording.upstream_data(data)
+                    frames = transcoder.feed(data)
+                    if frames:
+                        request_metrics.frames_sent(len(frames))
+                        # 同一次网络读取到的事件合并为一次写出
+                        output = b''.join(frames)
+                        if recording is not None:
+                            recording.output_data(output)
+                        yield output
+                if flight is not None:
+                    flight.close()
+                output = b''.join(transcoder.finish()) + b'data: [DONE]\n\n'
+                if recording is not None:
+                    recording.output_data(output)
+                yield output
+                if raw_chunks is not None and response_cache.should_store(transcoder.stop_reason):
+                    response_cache.put(cache_key, b''.join(raw_chunks))
 
             except requests.RequestException as e:
-                logger.error(f'[stream] request error: {e}')
-                error_chunk = json.dumps({
+                logger.error('[stream] request error: %s', e)
+                request_metrics.error('proxy_error')
+                if flight is not None:
+                    flight.close(str(e))
+                error_chunk = json_codec.dumps({
                     'error': {'message': str(e), 'type': 'proxy_error'}
                 })
                 yield f'data: {error_chunk}\n\n'
+            except GeneratorExit:
+                guard.cancel()
+                raise
             finally:
-                cleanup_stream_state(request_id)
+                if resp is not None:
+                    resp.close()
+                if upstream is not None:
+                    upstream.release()
+                if flight is not None:
+                    # 客户端提前断开时上游流被中止，跟随请求需要收到错误而非截断的响应
+                    flight.close('upstream stream aborted')
+                if transcoder is not None:
+                    request_metrics.finish(transcoder.usage)
+                guard.finish(transcoder.usage.get('output_tokens') if transcoder is not None else 0)
+                if recording is not None:
+                    recording.finish()
+
+        return Response(generate(), content_type='text/event-stream', headers=SSE_HEADERS)
+
+    def _join_stream(flight, cursor, request_metrics, recording):
+        """处理流式请求：从头读取相同请求的上游流，按当前请求的 id 转换后发送"""
+        request_id = gen_stream_id()
+        if recording is not None:
+            recording.request_id = request_id
 
-        return Response(
-            generate(),
-            content_type='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'X-Accel-Buffering': 'no',
-            },
-        )
+        def generate():
+            transcoder = None
+            try:
+                status = flight.wait_response()
+                if recording is not None:
+                    recording.upstream_response(status)
+
+                if status != 200:
+                    error_body = b''.join(flight.subscribe(cursor)).decode('utf-8', errors='replace')
+                    logger.warning('[stream] upstream error %s: %.200s', status, error_body)
+                    error_chunk = json_codec.dumps({
+                        'error': {
+                            'message': f'Upstream error {status}: {error_body}',
+                            'type': 'upstream_error',
+                        }
+                    })
+                    yield f'data: {error_chunk}\n\n'
+                    return
+
+                request_metrics.stream_started()
+                transcoder = SSETranscoder(request_id)
+                for data in flight.subscribe(cursor):
+                    if recording is not None:
+                        recording.upstream_data(data)
+                    frames = transcoder.feed(data)
+                    if frames:
+                        request_metrics.frames_sent(len(frames))
+                        output = b''.join(frames)
+                        if recording is not None:
+                            recording.output_data(output)
+                        yield output
+                output = b''.join(transcoder.finish()) + b'data: [DONE]\n\n'
+                if recording is not None:
+                    recording.output_data(output)
+                yield output
+
+            except coalesce.FlightError as e:
+                logger.error('[stream] coalesced request error: %s', e)
+                request_metrics.error('proxy_error')
+                error_chunk = json_codec.dumps({
+                    'error': {'message': str(e), 'type': 'proxy_error'}
+                })
+                yield f'data: {error_chunk}\n\n'
+            finally:
+                flight.leave(cursor)
+                if transcoder is not None:
+                    request_metrics.finish(transcoder.usage)
+                if recording is not None:
+                    recording.finish()
+
+        return Response(generate(), content_type='text/event-stream', headers=SSE_HEADERS)
 
     return app
 
 
-def _prepare_headers():
-    """准备请求头，注入 API Key"""
-    headers = {
-        'anthropic-version': '2023-06-01',
-    }
-    key = Config.PROXY_API_KEY
-    if key.startswith('sk-'):
-        headers['x-api-key'] = key
+def _send_upstream(body, request_metrics=None, stream=False):
+    """按负载均衡选择上游发送请求，返回 (resp, upstream)，调用方用完响应后需 upstream.release()
+
+    连接失败或返回 5xx/429 时还没有向客户端写出任何数据：先换未尝试的上游，都失败后按
+    退避重试（见 routing.next_attempt）。放弃时抛出最后一次的异常或返回最后一次的响应。
+    """
+    routing.request_started()
+    tried = []
+    retries = 0
+    while True:
+        upstream = routing.acquire(tried)
+        tried.append(upstream)
+        try:
+            resp = get_session().post(
+                upstream.messages_url,
+                headers=upstream.headers,
+                data=body,
+                timeout=Config.API_TIMEOUT,
+                stream=stream,
+            )
+        except requests.RequestException as e:
+            upstream.failure()
+            upstream.release()
+            delay = routing.next_attempt(tried, retries)
+            if delay is None:
+                raise
+            reason = str(e)
+        else:
+            # elapsed 为发出请求到收到响应头的耗时
+            ttfb = resp.elapsed.total_seconds()
+            upstream.response(resp.status_code, ttfb)
+            if request_metrics is not None:
+                request_metrics.upstream_response(resp.status_code, ttfb)
+            if resp.status_code not in routing.RETRYABLE_STATUS:
+                return resp, upstream
+            delay = routing.next_attempt(tried, retries, resp.headers.get('retry-after'))
+            if delay is None:
+                return resp, upstream
+            resp.close()
+            upstream.release()
+            reason = f'status {resp.status_code}'
+
+        if routing.can_failover(tried):
+            upstream.failover()
+            logger.warning('[upstream] %s failed (%s), failing over', upstream.name, reason)
+        else:
+            logger.warning('[upstream] %s failed (%s), retrying in %.2fs', upstream.name, reason, delay)
+            time.sleep(delay)
+            retries += 1
+            tried = []
+
+
+def _client_id(headers, remote_addr):
+    """准入控制区分客户端：默认按接入 Key，取不到或 ADMISSION_CLIENT_KEY=ip 时按来源地址"""
+    if Config.ADMISSION_CLIENT_KEY == 'token':
+        token = _extract_access_token(headers)
+        if token:
+            return token
+    return remote_addr or ''
+
+
+def _parse_request_body(data):
+    """解析请求体 JSON（不检查 Content-Type）；格式错误或不是对象时抛出 ValueError"""
+    payload = json_codec.loads(data)
+    if not isinstance(payload, dict):
+        raise ValueError('request body must be a JSON object')
+    return payload
+
+
+def _invalid_request_error(error):
+    """请求体无法解析时的 400 响应体，sync / async 模式一致"""
+    return {'error': {'message': f'Failed to decode JSON object: {error}', 'type': 'invalid_request_error'}}
+
+
+def _request_json():
+    """解析请求体 JSON；格式错误时返回 400"""
+    try:
+        return _parse_request_body(request.get_data())
+    except ValueError as e:
+        resp = jsonify(_invalid_request_error(e))
+        resp.status_code = 400
+        raise BadRequest(response=resp)
+
+
+def _json_response(obj):
+    """序列化 OpenAI 响应体"""
+    return Response(json_codec.dumpb(obj), content_type='application/json')
+
+
+def _rejected_response(error):
+    """准入控制拒绝：429 + Retry-After"""
+    resp = jsonify({
+        'error': {'message': f'Too many requests ({error.reason}), retry later', 'type': 'rate_limit_error'}
+    })
+    resp.status_code = 429
+    resp.headers['Retry-After'] = str(error.retry_after)
+    return resp
+
+
+def _extract_access_token(headers):
+    """从 Authorization / x-api-key 头中取出接入 Key"""
+    auth = headers.get('Authorization', '')
+    token = ''
+    if auth.startswith('Bearer '):
+        token = auth[7:]
+    if not token:
+        token = headers.get('x-api-key', '')
+    return token
+
+
+def _log_payload_summary(payload):
+    """记录每条消息的摘要
+
+    历史消息每轮可达数百条，逐条日志开销可观：DEBUG 开启时每个请求都记录，
+    否则按 LOG_MESSAGE_SAMPLE_RATE 抽样以 INFO 级别记录。
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        level = logging.DEBUG
+    elif Config.LOG_MESSAGE_SAMPLE_RATE > 0 and random.random() < Config.LOG_MESSAGE_SAMPLE_RATE:
+        level = logging.INFO
     else:
-        headers['Authorization'] = f'Bearer {key}'
-    return headers
+        return
+
+    for i, msg in enumerate(payload.get('messages', [])):
+        role = msg.get('role', '?')
+        content = msg.get('content')
+        content_type = type(content).__name__
+        has_tc = 'tool_calls' in msg
+        tc_count = len(msg.get('tool_calls', []))
+        tc_id = msg.get('tool_call_id', '')
+        if isinstance(content, list):
+            types = [p.get('type','?') if isinstance(p,dict) else 'str' for p in content]
+            content_info = f'list[{len(content)}] types={types}'
+        elif isinstance(content, str):
+            content_info = f'str[{len(content)}]'
+        elif content is None:
+            content_info = 'None'
+        else:
+            content_info = content_type
+        extra = ''
+        if has_tc:
+            extra += f' tool_calls={tc_count}'
+        if tc_id:
+            extra += f' tool_call_id={tc_id}'
+        logger.log(level, '[chat]   msg[%d] role=%s content=%s%s', i, role, content_info, extra)
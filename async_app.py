@@ -0,0 +1,767 @@
+import asyncio
+import json
+import logging
+import time
+
+import httpx
+from aiohttp import web
+
+from app import _client_id, _extract_access_token, _invalid_request_error, _log_payload_summary, _parse_request_body
+import admission
+import cancellation
+import coalesce
+import context_compaction
+import conversion_cache
+import image_cache
+import json_codec
+import metrics
+import response_cache
+import routing
+import tool_cache
+from config import Config
+from openai_adapter import (
+    anthropic_to_openai_response,
+    encode_anthropic_request,
+    gen_stream_id,
+    openai_to_anthropic_request,
+)
+from prompt_cache import cache_stats
+from sse_transcoder import SSETranscoder
+from tool_use_fixer import repair_stats
+from traffic_capture import capture_stats, start_recording
+from upstream import create_async_client, pool_stats, relay_headers
+
+logger = logging.getLogger(__name__)
+
+# Cursor 会把截图以 base64 发送，请求体可能有几十 MB
+MAX_REQUEST_SIZE = 256 * 1024 * 1024
+
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
+UPSTREAM_CLIENT = web.AppKey('upstream_client', httpx.AsyncClient)
+
+
+def create_async_app():
+    """asyncio 模式：单进程承载大量并发 SSE 流，转换逻辑与 Flask 版共用 openai_adapter"""
+    app = web.Application(
+        middlewares=[_cors, _check_access_key],
+        client_max_size=MAX_REQUEST_SIZE,
+    )
+    app.cleanup_ctx.append(_upstream_client_ctx)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', prometheus_metrics)
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    app.router.add_post('/v1/messages', messages_passthrough)
+    return app
+
+
+async def _upstream_client_ctx(app):
+    """应用生命周期内共享一个异步上游客户端"""
+    client = create_async_client()
+    app[UPSTREAM_CLIENT] = client
+    yield
+    await client.aclose()
+
+
+@web.middleware
+async def _cors(request, handler):
+    """与 flask_cors 默认行为一致：允许任意来源"""
+    if request.method == 'OPTIONS':
+        resp = web.Response()
+        resp.headers['Access-Control-Allow-Methods'] = request.headers.get(
+            'Access-Control-Request-Method', 'GET, POST, OPTIONS')
+        resp.headers['Access-Control-Allow-Headers'] = request.headers.get(
+            'Access-Control-Request-Headers', '*')
+    else:
+        resp = await handler(request)
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
+
+@web.middleware
+async def _check_access_key(request, handler):
+    """接入鉴权：校验 ACCESS_API_KEY"""
+    if Config.ACCESS_API_KEY and request.path not in ('/health', '/metrics'):
+        if _extract_access_token(request.headers) != Config.ACCESS_API_KEY:
+            logger.warning('[auth] rejected %s', request.path)
+            return web.json_response({
+                'error': {'message': 'Invalid API key', 'type': 'authentication_error'}
+            }, status=401)
+    return await handler(request)
+
+
+async def health(request):
+    return web.json_response({
+        'status': 'ok',
+        'target': Config.PROXY_TARGET_URL,
+        'pool': pool_stats(),
+        'routing': routing.stats(),
+        'admission': admission.stats(),
+        'prompt_cache': cache_stats(),
+        'conversion_cache': conversion_cache.stats(),
+        'compaction': context_compaction.stats(),
+        'image_cache': image_cache.stats(),
+        'json': json_codec.stats(),
+        'tool_cache': tool_cache.stats(),
+        'tool_repair': repair_stats(),
+        'capture': capture_stats(),
+        'response_cache': response_cache.stats(),
+        'coalescing': coalesce.stats(),
+        'cancellation': cancellation.stats(),
+    })
+
+
+async def prometheus_metrics(request):
+    return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def chat_completions(request):
+    """OpenAI 兼容接口 — 主路由"""
+    try:
+        payload = _parse_request_body(await request.read())
+    except ValueError as e:
+        return web.json_response(_invalid_request_error(e), status=400)
+    is_stream = payload.get('stream', False)
+    model = payload.get('model', 'unknown')
+    msg_count = len(payload.get('messages', []))
+    logger.info('[chat] model=%s stream=%s messages=%d', model, is_stream, msg_count)
+    _log_payload_summary(payload)
+    request_metrics = metrics.RequestMetrics(model, is_stream)
+    recording = start_recording(payload, is_stream)
+
+    # 转换请求
+    started = time.perf_counter()
+    anthropic_payload = openai_to_anthropic_request(payload)
+    conversion_seconds = time.perf_counter() - started
+    request_metrics.conversion(conversion_seconds)
+    if recording is not None:
+        recording.converted(anthropic_payload, conversion_seconds)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('[chat] anthropic_payload: %s', json.dumps(anthropic_payload, ensure_ascii=False))
+
+    client = request.app[UPSTREAM_CLIENT]
+
+    anthropic_payload['stream'] = bool(is_stream)
+    body = encode_anthropic_request(anthropic_payload)
+
+    cache_key = response_cache.cache_key(anthropic_payload, body)
+    cached = await _cache_get(cache_key) if cache_key else None
+    if cached is not None:
+        logger.info('[chat] response cache hit')
+        if is_stream:
+            if Config.STREAM_TOOL_REPAIR and b'tool_use' in cached:
+                replayed = await asyncio.to_thread(response_cache.replay_stream, cached)
+            else:
+                replayed = response_cache.replay_stream(cached)
+            return web.Response(body=replayed, headers=SSE_HEADERS)
+        return _json_response(await _to_openai_response(json_codec.loads(cached)))
+
+    # 相同请求正在请求上游时直接加入，共用同一次上游调用
+    flight = None
+    flight_key = coalesce.flight_key(body)
+    if flight_key:
+        flight, cursor = coalesce.join(flight_key, coalesce.AsyncFlight)
+        if cursor is not None:
+            logger.info('[chat] joined in-flight upstream call')
+            request_metrics.coalesced()
+            if is_stream:
+                guard = cancellation.StreamGuard('chat', client_disconnected=_client_disconnected(request))
+                return await _join_stream(request, flight, cursor, request_metrics, recording, guard)
+            return await _join_non_stream(flight, cursor, request_metrics, recording)
+
+    try:
+        ticket = await admission.admit_async(_client_id(request.headers, request.remote))
+    except admission.Rejected as e:
+        logger.warning('[chat] rejected by admission control: %s', e.reason)
+        if flight is not None:
+            flight.close(f'rejected by admission control: {e.reason}')
+        if recording is not None:
+            recording.finish()
+        return _rejected_response(e)
+
+    try:
+        if is_stream:
+            guard = cancellation.StreamGuard(
+                'chat', anthropic_payload.get('max_tokens'), _client_disconnected(request))
+            return await _handle_stream(request, client, body, request_metrics, recording, cache_key, flight, guard)
+        else:
+            return await _handle_non_stream(client, body, request_metrics, recording, cache_key, flight)
+    finally:
+        if ticket is not None:
+            ticket.release(request_metrics.tokens)
+
+
+async def messages_passthrough(request):
+    """Anthropic 原生格式透传"""
+    body = await request.read()
+    try:
+        payload = _parse_request_body(body)
+    except ValueError as e:
+        return web.json_response(_invalid_request_error(e), status=400)
+    model = payload.get('model', 'unknown')
+    is_stream = payload.get('stream', False)
+    logger.info('[passthrough] model=%s stream=%s', model, is_stream)
+
+    client = request.app[UPSTREAM_CLIENT]
+
+    try:
+        ticket = await admission.admit_async(_client_id(request.headers, request.remote))
+    except admission.Rejected as e:
+        logger.warning('[passthrough] rejected by admission control: %s', e.reason)
+        return _rejected_response(e)
+
+    try:
+        return await _relay_passthrough(request, client, body, payload, is_stream)
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+async def _relay_passthrough(request, client, body, payload, is_stream):
+    if not is_stream:
+        try:
+            upstream_resp, upstream = await _send_upstream(client, body)
+            try:
+                await upstream_resp.aread()
+            finally:
+                await upstream_resp.aclose()
+                upstream.release()
+        except httpx.HTTPError as e:
+            logger.error('[passthrough] request error: %s', e)
+            return web.json_response({'error': {'message': str(e), 'type': 'proxy_error'}}, status=502)
+        return web.Response(
+            body=upstream_resp.content,
+            status=upstream_resp.status_code,
+            headers=relay_headers(upstream_resp.headers),
+        )
+
+    guard = cancellation.StreamGuard('messages', payload.get('max_tokens'), _client_disconnected(request))
+    watcher = cancellation.watch_async(guard)
+    resp = web.StreamResponse()
+    try:
+        try:
+            upstream_resp, upstream = await _send_upstream(client, body)
+        except httpx.HTTPError as e:
+            logger.error('[passthrough] request error: %s', e)
+            return web.json_response({'error': {'message': str(e), 'type': 'proxy_error'}}, status=502)
+        try:
+            # 原样转发上游状态码、响应头与字节，保留 SSE 分帧，不解析也不重新编码
+            resp.set_status(upstream_resp.status_code)
+            resp.headers.update(relay_headers(upstream_resp.headers))
+            await resp.prepare(request)
+            async for data in upstream_resp.aiter_bytes():
+                await resp.write(data)
+        except httpx.HTTPError as e:
+            logger.error('[passthrough] stream error: %s', e)
+        finally:
+            # 先释放再关闭：关闭时被取消也不会漏掉 release
+            upstream.release()
+            await upstream_resp.aclose()
+    except ConnectionResetError:
+        guard.cancel()
+    except asyncio.CancelledError:
+        if not cancellation.absorb_cancel(guard):
+            raise
+    finally:
+        watcher.cancel()
+        guard.finish()
+    return resp
+
+
+def _client_disconnected(request):
+    """返回检查客户端连接是否已关闭的函数，供 StreamGuard 轮询"""
+    def check():
+        transport = request.transport
+        return transport is None or transport.is_closing()
+    return check
+
+
+def _json_response(obj):
+    """序列化 OpenAI 响应体"""
+    return web.Response(body=json_codec.dumpb(obj), content_type='application/json')
+
+
+def _rejected_response(error):
+    """准入控制拒绝：429 + Retry-After"""
+    return web.json_response({
+        'error': {'message': f'Too many requests ({error.reason}), retry later', 'type': 'rate_limit_error'}
+    }, status=429, headers={'Retry-After': str(error.retry_after)})
+
+
+async def _send_upstream(client, body, request_metrics=None, primary=True):
+    """按负载均衡选择上游发送请求，返回 (resp, upstream)
+
+    resp 的响应体尚未读取，调用方用完后需 aclose() 并 upstream.release()。连接失败或返回
+    5xx/429 时还没有向客户端写出任何数据：先换未尝试的上游，都失败后按退避重试（见
+    routing.next_attempt）。放弃时抛出最后一次的异常或返回最后一次的响应。对冲请求传入
+    primary=False，不再积累额外请求预算。
+    """
+    if primary:
+        routing.request_started()
+    tried = []
+    retries = 0
+    while True:
+        upstream = routing.acquire(tried)
+        tried.append(upstream)
+        sent = time.perf_counter()
+        try:
+            resp = await client.send(
+                client.build_request('POST', upstream.messages_url, headers=upstream.headers, content=body),
+                stream=True,
+            )
+        except asyncio.CancelledError:
+            upstream.release()
+            raise
+        except httpx.HTTPError as e:
+            upstream.failure()
+            upstream.release()
+            delay = routing.next_attempt(tried, retries)
+            if delay is None:
+                raise
+            reason = str(e)
+        else:
+            ttfb = time.perf_counter() - sent
+            upstream.response(resp.status_code, ttfb)
+            if request_metrics is not None:
+                request_metrics.upstream_response(resp.status_code, ttfb)
+            if resp.status_code not in routing.RETRYABLE_STATUS:
+                return resp, upstream
+            delay = routing.next_attempt(tried, retries, resp.headers.get('retry-after'))
+            if delay is None:
+                return resp, upstream
+            await resp.aclose()
+            upstream.release()
+            reason = f'status {resp.status_code}'
+
+        if routing.can_failover(tried):
+            upstream.failover()
+            logger.warning('[upstream] %s failed (%s), failing over', upstream.name, reason)
+        else:
+            logger.warning('[upstream] %s failed (%s), retrying in %.2fs', upstream.name, reason, delay)
+            await asyncio.sleep(delay)
+            retries += 1
+            tried = []
+
+
+async def _open_stream(client, body, request_metrics):
+    """发送流式请求，返回 (resp, upstream, chunks)，chunks 为上游字节的异步迭代器（非 200 时为 None）
+
+    开启 UPSTREAM_HEDGE 时先等待最近首字节耗时的 p95：仍未收到 message_start 就再发一个
+    相同请求，先收到首字节的一路胜出，另一路取消。对冲受额外请求预算限制。
+    """
+    if not Config.UPSTREAM_HEDGE:
+        resp, upstream = await _send_upstream(client, body, request_metrics)
+        return resp, upstream, resp.aiter_bytes() if resp.status_code == 200 else None
+
+    delay = routing.hedge_delay()
+    if delay is None:
+        return await _first_bytes(client, body, request_metrics)
+    attempts = [asyncio.ensure_future(_first_bytes(client, body, request_metrics))]
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if done or not routing.start_hedge():
+            return await attempts[0]
+        logger.info('[upstream] no first byte after %.2fs, sending hedged request', delay)
+        attempts.append(asyncio.ensure_future(_first_bytes(client, body, request_metrics, primary=False)))
+        return await _race(attempts)
+    except asyncio.CancelledError:
+        # 等待首字节时被取消（客户端断开）：asyncio.wait 不会取消其中的任务，
+        # 需自行取消，已拿到的响应关闭并释放上游，否则连接、outstanding 与上游生成都会泄漏
+        await _discard(attempts)
+        raise
+
+
+async def _first_bytes(client, body, request_metrics, primary=True):
+    """发送流式请求并等到首字节（message_start），返回值同 _open_stream"""
+    started = time.perf_counter()
+    resp, upstream = await _send_upstream(client, body, request_metrics, primary)
+    if resp.status_code != 200:
+        return resp, upstream, None
+    chunks = resp.aiter_bytes()
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = b''
+    except BaseException:
+        await resp.aclose()
+        upstream.release()
+        raise
+    routing.record_first_byte(time.perf_counter() - started)
+    return resp, upstream, _prepend(first, chunks)
+
+
+async def _prepend(first, chunks):
+    if first:
+        yield first
+    async for data in chunks:
+        yield data
+
+
+async def _paced(chunks, transcoder):
+    """依次产出上游字节；转换器暂存的合并增量到了发送时间而上游还没有新数据时产出 None"""
+    if not transcoder.hold:
+        async for data in chunks:
+            yield data
+        return
+    chunks = chunks.__aiter__()
+    next_chunk = None
+    try:
+        while True:
+            if next_chunk is None:
+                # 用 task 等待下一块数据，超时后继续等同一个 task，不打断上游读取
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+            delay = transcoder.flush_delay()
+            if delay is not None and not next_chunk.done():
+                done, _ = await asyncio.wait((next_chunk,), timeout=delay)
+                if not done:
+                    yield None
+                    continue
+            try:
+                data = await next_chunk
+            except StopAsyncIteration:
+                return
+            next_chunk = None
+            yield data
+    finally:
+        if next_chunk is not None:
+            next_chunk.cancel()
+
+
+async def _race(attempts):
+    """返回先收到首字节的一路；都失败时返回最后的非 200 响应或抛出最后的异常。其余请求取消并释放"""
+    primary, hedge = attempts
+    pending = set(attempts)
+    error = None
+    fallback = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                error = task.exception()
+                continue
+            if task.result()[2] is not None:
+                if task is hedge:
+                    routing.hedge_won()
+                await _discard(attempts, keep=task)
+                return task.result()
+            fallback = task
+    if fallback is None:
+        raise error
+    await _discard(attempts, keep=fallback)
+    return fallback.result()
+
+
+async def _discard(attempts, keep=None):
+    """取消并等待 attempts 中除 keep 以外的请求任务，已拿到响应的先释放上游再关闭响应
+
+    处理过的任务从 attempts 中移除，中途被取消后再次调用不会重复释放。
+    """
+    tasks = [task for task in attempts if task is not keep]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.wait(tasks)
+    for task in tasks:
+        attempts.remove(task)
+        if task.cancelled() or task.exception() is not None:
+            continue
+        resp, upstream, _ = task.result()
+        upstream.release()
+        await resp.aclose()
+
+
+async def _handle_non_stream(client, body, request_metrics, recording, cache_key, flight):
+    """处理非流式请求"""
+    try:
+        return await _send_non_stream(client, body, request_metrics, recording, cache_key, flight)
+    finally:
+        if flight is not None:
+            flight.close('upstream call aborted')
+        if recording is not None:
+            recording.finish()
+
+
+async def _send_non_stream(client, body, request_metrics, recording, cache_key, flight):
+    try:
+        resp, upstream = await _send_upstream(client, body, request_metrics)
+        if recording is not None:
+            recording.upstream_response(resp.status_code)
+        try:
+            await resp.aread()
+        finally:
+            await resp.aclose()
+            upstream.release()
+    except httpx.HTTPError as e:
+        logger.error('[chat] request error: %s', e)
+        request_metrics.error('proxy_error')
+        if flight is not None:
+            flight.close(str(e))
+        return web.json_response({'error': {'message': str(e), 'type': 'proxy_error'}}, status=502)
+
+    content_type = resp.headers.get('Content-Type', 'application/json').split(';')[0]
+    if flight is not None:
+        flight.respond(resp.status_code, content_type)
+        flight.publish(resp.content)
+        flight.close()
+    if recording is not None:
+        recording.upstream_data(resp.content)
+    return await _non_stream_response(
+        resp.status_code, resp.content, content_type, request_metrics, recording, cache_key)
+
+
+async def _join_non_stream(flight, cursor, request_metrics, recording):
+    """处理非流式请求：等待相同请求的上游调用结束，复用其响应"""
+    try:
+        status = await flight.wait_response()
+        if recording is not None:
+            recording.upstream_response(status)
+        content = b''.join([data async for data in flight.subscribe(cursor)])
+        if recording is not None:
+            recording.upstream_data(content)
+        return await _non_stream_response(status, content, flight.content_type, request_metrics, recording)
+    except coalesce.FlightError as e:
+        logger.error('[chat] coalesced request error: %s', e)
+        request_metrics.error('proxy_error')
+        return web.json_response({'error': {'message': str(e), 'type': 'proxy_error'}}, status=502)
+    finally:
+        flight.leave(cursor)
+        if recording is not None:
+            recording.finish()
+
+
+async def _cache_get(key):
+    """查询响应缓存；内存未命中且开启磁盘缓存时，读盘放到线程池执行"""
+    cached = response_cache.get_memory(key)
+    if cached is not None:
+        return cached
+    if Config.RESPONSE_CACHE_DIR:
+        return await asyncio.to_thread(response_cache.get, key)
+    return response_cache.get(key)
+
+
+async def _cache_put(key, data):
+    """写入响应缓存；开启磁盘缓存时写盘和定期清理放到线程池执行"""
+    if Config.RESPONSE_CACHE_DIR:
+        await asyncio.to_thread(response_cache.put, key, data)
+    else:
+        response_cache.put(key, data)
+
+
+async def _to_openai_response(anthropic_data):
+    """转换非流式响应；含 tool_use 时工具参数修复会读取本地文件，放到线程池执行"""
+    content = anthropic_data.get('content')
+    if isinstance(content, list) and any(isinstance(block, dict) and block.get('type') == 'tool_use'
+                                         for block in content):
+        return await asyncio.to_thread(anthropic_to_openai_response, anthropic_data)
+    return anthropic_to_openai_response(anthropic_data)
+
+
+async def _feed(transcoder, data):
+    """转换一段上游字节；可能修复工具参数时放到线程池执行，不阻塞事件循环"""
+    if transcoder.may_repair(data):
+        return await asyncio.to_thread(transcoder.feed, data)
+    return transcoder.feed(data)
+
+
+async def _finish(transcoder):
+    """处理流末尾的残留数据，规则同 _feed"""
+    if transcoder.may_repair():
+        return await asyncio.to_thread(transcoder.finish)
+    return transcoder.finish()
+
+
+async def _non_stream_response(status, content, content_type, request_metrics, recording, cache_key=None):
+    """把上游的非流式响应转换为 OpenAI 格式"""
+    if status != 200:
+        logger.warning('[chat] upstream error %s', status)
+        return web.Response(body=content, status=status, content_type=content_type)
+
+    anthropic_data = json_codec.loads(content)
+    openai_response = await _to_openai_response(anthropic_data)
+    request_metrics.finish(anthropic_data.get('usage'))
+    if cache_key and response_cache.should_store(anthropic_data.get('stop_reason')):
+        await _cache_put(cache_key, content)
+    if recording is not None:
+        recording.request_id = openai_response['id']
+        recording.output_data(openai_response)
+    usage = openai_response.get('usage', {})
+    logger.info('[chat] done prompt=%s completion=%s', usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+    return _json_response(openai_response)
+
+
+async def _handle_stream(request, client, body, request_metrics, recording, cache_key, flight, guard):
+    """处理流式请求：每个流只占用一个协程，不再独占工作线程
+
+    客户端断开（轮询发现或写出失败）时取消当前任务，立即关闭上游响应、释放连接。
+    """
+    request_id = gen_stream_id()
+    if recording is not None:
+        recording.request_id = request_id
+    resp = web.StreamResponse(headers=SSE_HEADERS)
+    await resp.prepare(request)
+
+    transcoder = None
+    watcher = cancellation.watch_async(guard)
+    try:
+        upstream_resp, upstream, chunks = await _open_stream(client, body, request_metrics)
+        try:
+            if recording is not None:
+                recording.upstream_response(upstream_resp.status_code)
+            if flight is not None:
+                flight.respond(upstream_resp.status_code)
+            if upstream_resp.status_code != 200:
+                error_content = await upstream_resp.aread()
+                if flight is not None:
+                    flight.publish(error_content)
+                    flight.close()
+                error_body = error_content.decode('utf-8', errors='replace')
+                logger.warning('[stream] upstream error %s: %.200s', upstream_resp.status_code, error_body)
+                error_chunk = json_codec.dumps({
+                    'error': {
+                        'message': f'Upstream error {upstream_resp.status_code}: {error_body}',
+                        'type': 'upstream_error',
+                    }
+                })
+                await resp.write(f'data: {error_chunk}\n\n'.encode('utf-8'))
+                return resp
+
+            request_metrics.stream_started()
+            transcoder = SSETranscoder(request_id, hold=True)
+            # 可缓存的请求保留上游原始字节，结束后写入响应缓存
+            raw_chunks = [] if cache_key else None
+            async for data in _paced(chunks, transcoder):
+                if data is None:
+                    frames = transcoder.flush()
+                else:
+                    if flight is not None:
+                        flight.publish(data)
+                    if raw_chunks is not None:
+                        raw_chunks.append(data)
+                    if recording is not None:
+                        recording.upstream_data(data)
+                    frames = await _feed(transcoder, data)
+                if frames:
+                    request_metrics.frames_sent(len(frames))
+                    output = b''.join(frames)
+                    if recording is not None:
+                        recording.output_data(output)
+                    await resp.write(output)
+            if flight is not None:
+                flight.close()
+            output = b''.join(await _finish(transcoder)) + b'data: [DONE]\n\n'
+            if recording is not None:
+                recording.output_data(output)
+            await resp.write(output)
+            if raw_chunks is not None and response_cache.should_store(transcoder.stop_reason):
+                await _cache_put(cache_key, b''.join(raw_chunks))
+        finally:
+            # 先释放再关闭：关闭时被取消也不会漏掉 release
+            upstream.release()
+            await upstream_resp.aclose()
+
+    except httpx.HTTPError as e:
+        logger.error('[stream] request error: %s', e)
+        request_metrics.error('proxy_error')
+        if flight is not None:
+            flight.close(str(e))
+        error_chunk = json_codec.dumps({
+            'error': {'message': str(e), 'type': 'proxy_error'}
+        })
+        await resp.write(f'data: {error_chunk}\n\n'.encode('utf-8'))
+    except ConnectionResetError:
+        guard.cancel()
+    except asyncio.CancelledError:
+        if not cancellation.absorb_cancel(guard):
+            raise
+    finally:
+        watcher.cancel()
+        if flight is not None:
+            # 客户端提前断开时上游流被中止，跟随请求需要收到错误而非截断的响应
+            flight.close('upstream stream aborted')
+        if transcoder is not None:
+            request_metrics.finish(transcoder.usage)
+        guard.finish(transcoder.usage.get('output_tokens') if transcoder is not None else 0)
+        if recording is not None:
+            recording.finish()
+
+    return resp
+
+
+async def _join_stream(request, flight, cursor, request_metrics, recording, guard):
+    """处理流式请求：从头读取相同请求的上游流，按当前请求的 id 转换后发送
+
+    客户端断开时与 _handle_stream 一样取消当前任务、离开 flight；上游调用属于 leader，
+    不计入取消统计（不调用 guard.finish）。
+    """
+    request_id = gen_stream_id()
+    if recording is not None:
+        recording.request_id = request_id
+    resp = web.StreamResponse(headers=SSE_HEADERS)
+    await resp.prepare(request)
+
+    transcoder = None
+    watcher = cancellation.watch_async(guard)
+    try:
+        status = await flight.wait_response()
+        if recording is not None:
+            recording.upstream_response(status)
+        if status != 200:
+            error_content = b''.join([data async for data in flight.subscribe(cursor)])
+            error_body = error_content.decode('utf-8', errors='replace')
+            logger.warning('[stream] upstream error %s: %.200s', status, error_body)
+            error_chunk = json_codec.dumps({
+                'error': {
+                    'message': f'Upstream error {status}: {error_body}',
+                    'type': 'upstream_error',
+                }
+            })
+            await resp.write(f'data: {error_chunk}\n\n'.encode('utf-8'))
+            return resp
+
+        request_metrics.stream_started()
+        transcoder = SSETranscoder(request_id, hold=True)
+        async for data in _paced(flight.subscribe(cursor), transcoder):
+            if data is None:
+                frames = transcoder.flush()
+            else:
+                if recording is not None:
+                    recording.upstream_data(data)
+                frames = await _feed(transcoder, data)
+            if frames:
+                request_metrics.frames_sent(len(frames))
+                output = b''.join(frames)
+                if recording is not None:
+                    recording.output_data(output)
+                await resp.write(output)
+        output = b''.join(await _finish(transcoder)) + b'data: [DONE]\n\n'
+        if recording is not None:
+            recording.output_data(output)
+        await resp.write(output)
+
+    except coalesce.FlightError as e:
+        logger.error('[stream] coalesced request error: %s', e)
+        request_metrics.error('proxy_error')
+        error_chunk = json_codec.dumps({
+            'error': {'message': str(e), 'type': 'proxy_error'}
+        })
+        await resp.write(f'data: {error_chunk}\n\n'.encode('utf-8'))
+    except ConnectionResetError:
+        guard.cancel()
+    except asyncio.CancelledError:
+        if not cancellation.absorb_cancel(guard):
+            raise
+    finally:
+        watcher.cancel()
+        flight.leave(cursor)
+        if transcoder is not None:
+            request_metrics.finish(transcoder.usage)
+        if recording is not None:
+            recording.finish()
+
+    return resp
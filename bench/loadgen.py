@@ -0,0 +1,332 @@
+"""压测客户端：按给定并发驱动 /v1/chat/completions 或 /v1/messages，输出吞吐与延迟报告
+
+仅依赖标准库。请求语料为 JSONL：每行可以是完整的 OpenAI chat 请求（含 messages），
+也可以是 requests.jsonl 这类 {title, body} 工单，会被包装成一轮 system + user 对话。
+
+    python bench/loadgen.py --port 3029 --levels 1,8,32 --corpus requests.jsonl --proxy-pid 12345
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import re
+import statistics
+import threading
+import time
+
+SYSTEM_PROMPT = 'You are a coding agent working inside the user\'s repository. Use the tools to edit files.'
+
+# 模拟中转站在每个 text_delta 里写入的发送时刻
+_TIMESTAMP_RE = re.compile(rb'@(\d{9,11}\.\d{6})')
+# OpenAI 流中携带实际输出的 chunk（第一条 role chunk 不算）
+# 冒号后可能有空格：代理按 json.dumps 的默认格式输出（带空格），其他实现可能输出紧凑格式
+_CHAT_TOKEN_RE = re.compile(rb'"(?:content|reasoning_content|arguments)":\s*"[^"]|"tool_calls"')
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def load_corpus(path, model):
+    """读取语料，返回 OpenAI chat 请求列表"""
+    corpus = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if 'messages' in item:
+                payload = dict(item)
+            else:
+                text = '\n\n'.join(part for part in (item.get('title'), item.get('body')) if part)
+                payload = {'messages': [
+                    {'role': 'system', 'content': SYSTEM_PROMPT},
+                    {'role': 'user', 'content': text or json.dumps(item)},
+                ]}
+            payload['model'] = model or payload.get('model') or 'claude-sonnet-4-5-20250929'
+            corpus.append(payload)
+    if not corpus:
+        raise SystemExit(f'empty corpus: {path}')
+    return corpus
+
+
+def to_anthropic(payload):
+    """把语料里的 OpenAI 请求改写成 /v1/messages 请求（仅处理字符串内容）"""
+    system = [m['content'] for m in payload['messages'] if m.get('role') == 'system']
+    messages = [
+        {'role': m['role'], 'content': m.get('content') or ''}
+        for m in payload['messages'] if m.get('role') in ('user', 'assistant')
+    ]
+    result = {'model': payload['model'], 'max_tokens': payload.get('max_tokens', 4096), 'messages': messages}
+    if system:
+        result['system'] = '\n\n'.join(s for s in system if isinstance(s, str))
+    return result
+
+
+class _ProcessSampler:
+    """采样被测进程的 CPU 时间与 RSS（读取 /proc，仅 Linux 可用）"""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss_kb = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def available(self):
+        return bool(self.pid) and os.path.exists(f'/proc/{self.pid}/stat')
+
+    def cpu_seconds(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        # utime、stime 为 stat 的第 14、15 个字段（去掉前两个字段后下标 11、12）
+        return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+
+    def rss_kb(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        return 0
+
+    def start(self):
+        self.peak_rss_kb = self.rss_kb()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.peak_rss_kb = max(self.peak_rss_kb, self.rss_kb())
+            except OSError:
+                return
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+
+def _run_one(conn, path, body, headers, stream):
+    """发送一个请求并读完响应，返回单请求统计"""
+    started = time.perf_counter()
+    conn.request('POST', path, body=body, headers=headers)
+    resp = conn.getresponse()
+    result = {'status': resp.status, 'ttft': None, 'duration': None, 'tokens': 0, 'token_latencies': [],
+              'frames': 0, 'bytes': 0}
+    if resp.status != 200 or not stream:
+        data = resp.read()
+        result['duration'] = time.perf_counter() - started
+        if resp.status == 200:
+            result['ttft'] = result['duration']
+            result['token_latencies'] = [time.time() - float(ts) for ts in _TIMESTAMP_RE.findall(data)]
+            result['tokens'] = len(result['token_latencies'])
+        return result
+
+    is_chat = path.endswith('/chat/completions')
+    completed = False
+    while True:
+        line = resp.readline()
+        if not line:
+            break
+        result['bytes'] += len(line)
+        if not line.startswith(b'data:'):
+            continue
+        result['frames'] += 1
+        now = time.perf_counter()
+        if is_chat:
+            if line.startswith(b'data: [DONE]'):
+                completed = True
+                continue
+            if b'"error"' in line[:16]:
+                result['status'] = 'stream_error'
+            has_token = _CHAT_TOKEN_RE.search(line) is not None
+        else:
+            if b'"type":"error"' in line:
+                result['status'] = 'stream_error'
+            completed = completed or b'"type":"message_stop"' in line
+            has_token = b'content_block_delta' in line
+        if has_token:
+            result['tokens'] += 1
+            if result['ttft'] is None:
+                result['ttft'] = now - started
+        timestamps = _TIMESTAMP_RE.findall(line)
+        if timestamps:
+            wall = time.time()
+            result['token_latencies'].extend(wall - float(ts) for ts in timestamps)
+    result['duration'] = time.perf_counter() - started
+    if result['status'] == 200 and not completed:
+        # 代理中途出错时流会被直接截断，没有结束标记
+        result['status'] = 'truncated'
+    return result
+
+
+def run_level(host, port, endpoint, corpus, concurrency, total_requests, stream=True, proxy_pid=None,
+              access_key=''):
+    """在固定并发下发送 total_requests 个请求，返回该档位的汇总报告"""
+    path = '/v1/chat/completions' if endpoint == 'chat' else '/v1/messages'
+    bodies = []
+    for payload in corpus:
+        request = dict(payload) if endpoint == 'chat' else to_anthropic(payload)
+        request['stream'] = stream
+        bodies.append(json.dumps(request).encode('utf-8'))
+    headers = {'Content-Type': 'application/json'}
+    if access_key:
+        headers['Authorization'] = f'Bearer {access_key}'
+
+    counter = itertools.count()
+    results = []
+    results_lock = threading.Lock()
+
+    def worker():
+        conn = http.client.HTTPConnection(host, port, timeout=600)
+        try:
+            while True:
+                n = next(counter)
+                if n >= total_requests:
+                    return
+                try:
+                    result = _run_one(conn, path, bodies[n % len(bodies)], headers, stream)
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    conn = http.client.HTTPConnection(host, port, timeout=600)
+                    result = {'status': type(e).__name__, 'ttft': None, 'duration': None,
+                              'tokens': 0, 'token_latencies': [], 'frames': 0, 'bytes': 0}
+                with results_lock:
+                    results.append(result)
+        finally:
+            conn.close()
+
+    sampler = _ProcessSampler(proxy_pid)
+    sampled = sampler.available()
+    if sampled:
+        rss_before = sampler.rss_kb()
+        cpu_before = sampler.cpu_seconds()
+        sampler.start()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r['status'] == 200]
+    ttfts = [r['ttft'] for r in ok if r['ttft'] is not None]
+    latencies = [value for r in ok for value in r['token_latencies']]
+    errors = {}
+    for r in results:
+        if r['status'] != 200:
+            errors[str(r['status'])] = errors.get(str(r['status']), 0) + 1
+
+    report = {
+        'endpoint': endpoint,
+        'stream': stream,
+        'concurrency': concurrency,
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'rps': round(len(ok) / elapsed, 3) if elapsed else None,
+        'ttft_p50_ms': _ms(_percentile(ttfts, 50)),
+        'ttft_p99_ms': _ms(_percentile(ttfts, 99)),
+        'tokens_per_request': round(statistics.mean(r['tokens'] for r in ok), 1) if ok else None,
+        # 流式响应的 SSE 帧数与字节数，开启 STREAM_COALESCE 后帧数应明显下降
+        'frames_per_request': round(statistics.mean(r['frames'] for r in ok), 1) if ok and stream else None,
+        'bytes_per_request': round(statistics.mean(r['bytes'] for r in ok)) if ok and stream else None,
+        # 模拟中转站发出 token 到压测端收到的耗时，即代理为每个 token 增加的延迟（含本机回环）
+        'token_latency_p50_ms': _ms(_percentile(latencies, 50)),
+        'token_latency_p99_ms': _ms(_percentile(latencies, 99)),
+        'cpu_ms_per_stream': None,
+        'rss_kb_per_stream': None,
+    }
+    if sampled:
+        sampler.stop()
+        cpu = sampler.cpu_seconds() - cpu_before
+        report['cpu_ms_per_stream'] = round(cpu * 1000 / len(results), 3) if results else None
+        report['rss_kb_per_stream'] = round(max(sampler.peak_rss_kb - rss_before, 0) / concurrency, 1)
+    return report
+
+
+REPORT_COLUMNS = (
+    ('concurrency', 'conc'),
+    ('ok', 'ok'),
+    ('rps', 'rps'),
+    ('ttft_p50_ms', 'ttft p50'),
+    ('ttft_p99_ms', 'ttft p99'),
+    ('token_latency_p50_ms', 'tok p50'),
+    ('token_latency_p99_ms', 'tok p99'),
+    ('frames_per_request', 'frames/req'),
+    ('bytes_per_request', 'bytes/req'),
+    ('cpu_ms_per_stream', 'cpu ms/req'),
+    ('rss_kb_per_stream', 'rss KB/stream'),
+)
+
+
+def format_report(levels):
+    """把各并发档位的报告排成一张表"""
+    rows = [[title for _, title in REPORT_COLUMNS]]
+    for level in levels:
+        row = ['-' if level.get(key) is None else str(level[key]) for key, _ in REPORT_COLUMNS]
+        if level.get('errors'):
+            row.append(f'errors={level["errors"]}')
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows if i < len(row)) for i in range(len(REPORT_COLUMNS))]
+    return '\n'.join(
+        '  '.join(cell.rjust(widths[i]) if i < len(widths) else cell for i, cell in enumerate(row))
+        for row in rows
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Load generator for the proxy')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3029)
+    parser.add_argument('--endpoint', choices=('chat', 'messages'), default='chat')
+    parser.add_argument('--corpus', default=os.path.join(os.path.dirname(__file__), '..', 'requests.jsonl'))
+    parser.add_argument('--model', default='')
+    parser.add_argument('--levels', default='1,8,32', help='逗号分隔的并发档位')
+    parser.add_argument('--requests-per-level', type=int, default=0, help='每档请求数，默认为并发数的 4 倍')
+    parser.add_argument('--non-stream', action='store_true')
+    parser.add_argument('--proxy-pid', type=int, default=0, help='被测进程 pid，用于统计 CPU 与 RSS')
+    parser.add_argument('--access-key', default=os.getenv('ACCESS_API_KEY', ''))
+    parser.add_argument('--output', default='', help='把报告写成 JSON 文件')
+    return parser
+
+
+def run(options, meta=None):
+    corpus = load_corpus(options.corpus, options.model)
+    levels = []
+    for concurrency in (int(value) for value in options.levels.split(',') if value.strip()):
+        total = options.requests_per_level or concurrency * 4
+        report = run_level(options.host, options.port, options.endpoint, corpus, concurrency, total,
+                           stream=not options.non_stream, proxy_pid=options.proxy_pid,
+                           access_key=options.access_key)
+        levels.append(report)
+        print(f'[bench] concurrency={concurrency} rps={report["rps"]} ttft_p50={report["ttft_p50_ms"]}ms', flush=True)
+
+    print(format_report(levels))
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta or {}, 'levels': levels}, f, indent=2)
+    return levels
+
+
+def main(argv=None):
+    run(build_parser().parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""本地模拟 Anthropic 中转站，用作压测时的 PROXY_TARGET_URL
+
+仅依赖标准库。/v1/messages 按参数生成 thinking / text / tool_use 事件，可控制首字节延迟、
+逐 token 间隔与错误注入。每个 text_delta 都带有发送时刻的时间戳（形如 `w@1700000000.123456 `），
+压测端据此计算每个 token 经过代理增加的延迟。
+
+    python bench/mock_relay.py --port 9100 --text-tokens 200 --token-interval-ms 5
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_REQUEST_COUNT = 0
+_REQUEST_COUNT_LOCK = threading.Lock()
+
+
+def _event(event_type, data):
+    return f'event: {event_type}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode('utf-8')
+
+
+def _delta(index, delta):
+    return _event('content_block_delta', {'type': 'content_block_delta', 'index': index, 'delta': delta})
+
+
+def _tool_input(size):
+    """生成约 size 字节的 str_replace 参数，模拟 Agent 的编辑调用"""
+    body = ''.join(random.choice('abcdefghij    \n') for _ in range(max(size - 80, 8)))
+    return {'path': '/tmp/bench_target.py', 'old_string': body, 'new_string': body.upper()}
+
+
+def _split(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)] or ['']
+
+
+class MockRelayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # 每个 SSE 事件单独写出；不关闭 Nagle 时回环上与延迟 ACK 叠加，每个事件会多等几十毫秒
+    disable_nagle_algorithm = True
+    options = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok', 'requests': _REQUEST_COUNT})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        global _REQUEST_COUNT
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if self.path.split('?')[0] != '/v1/messages':
+            self._send_json(404, {'error': 'not found'})
+            return
+        with _REQUEST_COUNT_LOCK:
+            _REQUEST_COUNT += 1
+
+        opts = self.options
+        if opts.ttfb_ms:
+            time.sleep(opts.ttfb_ms / 1000)
+        if opts.error_rate and random.random() < opts.error_rate:
+            self._send_json(opts.error_status, {
+                'type': 'error',
+                'error': {'type': 'overloaded_error', 'message': 'injected error'},
+            })
+            return
+
+        model = payload.get('model', 'mock-model')
+        if payload.get('stream'):
+            self._send_stream(model)
+        else:
+            self._send_message(model)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _usage(self):
+        opts = self.options
+        return {
+            'input_tokens': opts.input_tokens,
+            'cache_read_input_tokens': opts.cache_read_tokens,
+            'cache_creation_input_tokens': 0,
+            'output_tokens': opts.thinking_tokens + opts.text_tokens + opts.tool_calls * 20,
+        }
+
+    def _send_message(self, model):
+        opts = self.options
+        content = []
+        if opts.thinking_tokens:
+            content.append({'type': 'thinking', 'thinking': 'hmm ' * opts.thinking_tokens, 'signature': 'sig'})
+        if opts.text_tokens:
+            content.append({'type': 'text', 'text': f'w@{time.time():.6f} ' * opts.text_tokens})
+        for _ in range(opts.tool_calls):
+            content.append({
+                'type': 'tool_use',
+                'id': f'toolu_{uuid.uuid4().hex[:24]}',
+                'name': 'str_replace',
+                'input': _tool_input(opts.tool_args_bytes),
+            })
+        self._send_json(200, {
+            'id': f'msg_{uuid.uuid4().hex[:24]}',
+            'type': 'message',
+            'role': 'assistant',
+            'model': model,
+            'content': content,
+            'stop_reason': 'tool_use' if opts.tool_calls else 'end_turn',
+            'usage': self._usage(),
+        })
+
+    def _send_stream(self, model):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for event in self._events(model):
+                self.wfile.write(f'{len(event):x}\r\n'.encode('ascii') + event + b'\r\n')
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _events(self, model):
+        opts = self.options
+        interval = opts.token_interval_ms / 1000
+        usage = self._usage()
+        yield _event('message_start', {'type': 'message_start', 'message': {
+            'id': f'msg_{uuid.uuid4().hex[:24]}', 'type': 'message', 'role': 'assistant', 'model': model,
+            'content': [], 'stop_reason': None,
+            'usage': {**usage, 'output_tokens': 1},
+        }})
+        index = 0
+        if opts.thinking_tokens:
+            yield _event('content_block_start', {'type': 'content_block_start', 'index': index,
+                                                 'content_block': {'type': 'thinking', 'thinking': ''}})
+            for _ in range(opts.thinking_tokens):
+                time.sleep(interval)
+                yield _delta(index, {'type': 'thinking_delta', 'thinking': 'hmm '})
+            yield _delta(index, {'type': 'signature_delta', 'signature': 'sig'})
+            yield _event('content_block_stop', {'type': 'content_block_stop', 'index': index})
+            index += 1
+        if opts.text_tokens:
+            yield _event('content_block_start', {'type': 'content_block_start', 'index': index,
+                                                 'content_block': {'type': 'text', 'text': ''}})
+            for i in range(opts.text_tokens):
+                time.sleep(interval)
+                if opts.midstream_error_rate and i == opts.text_tokens // 2 \
+                        and random.random() < opts.midstream_error_rate:
+                    yield _event('error', {'type': 'error', 'error': {
+                        'type': 'overloaded_error', 'message': 'injected mid-stream error'}})
+                    return
+                yield _delta(index, {'type': 'text_delta', 'text': f'w@{time.time():.6f} '})
+            yield _event('content_block_stop', {'type': 'content_block_stop', 'index': index})
+            index += 1
+        for _ in range(opts.tool_calls):
+            yield _event('content_block_start', {'type': 'content_block_start', 'index': index, 'content_block': {
+                'type': 'tool_use', 'id': f'toolu_{uuid.uuid4().hex[:24]}', 'name': 'str_replace', 'input': {}}})
+            for piece in _split(json.dumps(_tool_input(opts.tool_args_bytes)), opts.tool_chunk_bytes):
+                time.sleep(interval)
+                yield _delta(index, {'type': 'input_json_delta', 'partial_json': piece})
+            yield _event('content_block_stop', {'type': 'content_block_stop', 'index': index})
+            index += 1
+        yield _event('message_delta', {'type': 'message_delta', 'delta': {
+            'stop_reason': 'tool_use' if opts.tool_calls else 'end_turn', 'stop_sequence': None,
+        }, 'usage': {'output_tokens': usage['output_tokens']}})
+        yield _event('message_stop', {'type': 'message_stop'})
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Mock Anthropic relay for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--ttfb-ms', type=float, default=0, help='首字节前的延迟')
+    parser.add_argument('--token-interval-ms', type=float, default=5, help='相邻增量事件的间隔')
+    parser.add_argument('--thinking-tokens', type=int, default=0)
+    parser.add_argument('--text-tokens', type=int, default=200)
+    parser.add_argument('--tool-calls', type=int, default=0)
+    parser.add_argument('--tool-args-bytes', type=int, default=400)
+    parser.add_argument('--tool-chunk-bytes', type=int, default=16, help='每个 input_json_delta 的字节数')
+    parser.add_argument('--input-tokens', type=int, default=2000)
+    parser.add_argument('--cache-read-tokens', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help='直接返回错误状态码的比例')
+    parser.add_argument('--error-status', type=int, default=529)
+    parser.add_argument('--midstream-error-rate', type=float, default=0, help='流中途发送 error 事件并结束的比例')
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    MockRelayHandler.options = options
+    server = ThreadingHTTPServer((options.host, options.port), MockRelayHandler)
+    server.daemon_threads = True
+    print(f'Mock relay listening on {options.host}:{options.port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
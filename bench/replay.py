@@ -0,0 +1,319 @@
+"""回放 TRAFFIC_CAPTURE 抓取的流量，对比新版本的耗时与输出
+
+离线模式（默认）：在进程内把记录依次送入 openai_to_anthropic_request 与流式转换器，
+对比转换结果、输出帧以及转换/翻译耗时。
+
+    python bench/replay.py captures/*.jsonl.gz
+
+在线模式：启动一个按原始时间间隔重放上游 SSE 的模拟中转站，把记录的 OpenAI 请求发给正在运行的代理
+（代理的 PROXY_TARGET_URL 需指向 --relay-port），对比输出与 TTFT / 总耗时。
+
+    PROXY_TARGET_URL=http://127.0.0.1:9300 python start.py &
+    python bench/replay.py captures/*.jsonl.gz --proxy http://127.0.0.1:3029 --relay-port 9300
+"""
+import argparse
+import copy
+import hashlib
+import http.client
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai_adapter import (  # noqa: E402
+    anthropic_to_openai_response,
+    openai_to_anthropic_request,
+)
+from sse_transcoder import SSETranscoder  # noqa: E402
+from traffic_capture import read_recordings  # noqa: E402
+
+# 在线模式下每次请求的 id 不同，对比前统一替换
+_ID_RE = re.compile(rb'"id": ?"chatcmpl-[^"]*"')
+
+
+def _canonical(obj):
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False)
+
+
+def _canonical_frames(data):
+    """逐帧按 _canonical 重新序列化 SSE 的 JSON 载荷，对比结果不受空格、非 ASCII 转义等序列化格式差异影响"""
+    frames = data.split(b'\n\n')
+    for i, frame in enumerate(frames):
+        if frame.startswith(b'data: {'):
+            try:
+                frames[i] = b'data: ' + _canonical(json.loads(frame[6:])).encode('utf-8')
+            except ValueError:
+                pass
+    return b'\n\n'.join(frames)
+
+
+def _raw(data):
+    return data.encode('latin-1') if isinstance(data, str) else data
+
+
+def _first_difference(expected, actual):
+    for i, (a, b) in enumerate(zip(expected, actual)):
+        if a != b:
+            return i
+    return None if len(expected) == len(actual) else min(len(expected), len(actual))
+
+
+def _snippet(data, pos, width=80):
+    return data[max(0, pos - width // 2):pos + width // 2]
+
+
+def load(paths):
+    recordings = []
+    for path in paths:
+        recordings.extend(read_recordings(path))
+    return [r for r in recordings if r.get('anthropic_request') is not None]
+
+
+# ─── 离线回放 ───────────────────────────────────────────────
+
+def replay_offline(recording):
+    result = {'request_id': recording['request_id'], 'stream': recording['stream']}
+
+    started = time.perf_counter()
+    converted = openai_to_anthropic_request(copy.deepcopy(recording['openai_request']))
+    result['conversion_ms'] = (time.perf_counter() - started) * 1000
+    result['recorded_conversion_ms'] = recording['timings'].get('conversion_ms')
+    converted['stream'] = recording['anthropic_request'].get('stream', recording['stream'])
+    result['conversion_equal'] = _canonical(json.loads(json.dumps(converted))) == _canonical(
+        recording['anthropic_request'])
+
+    if recording.get('upstream_status') != 200 or not recording['upstream']:
+        return result
+
+    request_id = recording['request_id']
+    if recording['stream']:
+        expected = b''.join(_raw(data) for _, data in recording['output'])
+        started = time.perf_counter()
+        transcoder = SSETranscoder(request_id)
+        frames = []
+        for _, data in recording['upstream']:
+            frames.extend(transcoder.feed(_raw(data)))
+        frames.extend(transcoder.finish())
+        result['translation_ms'] = (time.perf_counter() - started) * 1000
+        actual = b''.join(frames) + b'data: [DONE]\n\n'
+        # SSE 帧以空行分隔，JSON 载荷中的换行都已转义
+        result['recorded_frames'] = expected.count(b'\n\n')
+        result['frames'] = actual.count(b'\n\n')
+        expected, actual = _canonical_frames(expected), _canonical_frames(actual)
+    else:
+        started = time.perf_counter()
+        response = anthropic_to_openai_response(
+            json.loads(_raw(recording['upstream'][0][1])), request_id=request_id)
+        result['translation_ms'] = (time.perf_counter() - started) * 1000
+        expected = _canonical(recording['output'][0][1]).encode('utf-8') if recording['output'] else b''
+        actual = _canonical(response).encode('utf-8')
+
+    _compare_output(result, expected, actual)
+    return result
+
+
+def _compare_output(result, expected, actual):
+    diff_at = _first_difference(expected, actual)
+    result['output_equal'] = diff_at is None
+    if diff_at is not None:
+        result['diff'] = {
+            'offset': diff_at,
+            'expected': _snippet(expected, diff_at).decode('utf-8', errors='replace'),
+            'actual': _snippet(actual, diff_at).decode('utf-8', errors='replace'),
+        }
+
+
+# ─── 在线回放 ───────────────────────────────────────────────
+
+class _ReplayRelay(ThreadingHTTPServer):
+    """按记录重放上游响应：先按请求体精确匹配，匹配不到时按记录顺序取下一条"""
+
+    daemon_threads = True
+
+    def __init__(self, address, recordings, speed):
+        super().__init__(address, _ReplayRelayHandler)
+        self.speed = speed
+        self.by_body = {}
+        self.pending = deque()
+        self.lock = threading.Lock()
+        for recording in recordings:
+            key = hashlib.sha256(_canonical(recording['anthropic_request']).encode('utf-8')).hexdigest()
+            self.by_body.setdefault(key, deque()).append(recording)
+            self.pending.append(recording)
+        self.unmatched = 0
+
+    def take(self, body):
+        key = hashlib.sha256(_canonical(json.loads(body)).encode('utf-8')).hexdigest()
+        with self.lock:
+            candidates = self.by_body.get(key)
+            if candidates:
+                recording = candidates.popleft()
+            else:
+                self.unmatched += 1
+                recording = self.pending[0] if self.pending else None
+                if recording is not None:
+                    key = hashlib.sha256(_canonical(recording['anthropic_request']).encode('utf-8')).hexdigest()
+                    self.by_body[key].remove(recording)
+            if recording is not None:
+                self.pending.remove(recording)
+            return recording
+
+
+class _ReplayRelayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        recording = self.server.take(body)
+        if recording is None:
+            self.send_error(404, 'no recording left')
+            return
+        speed = self.server.speed
+        upstream = recording['upstream']
+        ttfb = recording['timings'].get('ttfb_ms', 0) - recording['timings'].get('conversion_ms', 0)
+        if speed and ttfb > 0:
+            time.sleep(ttfb / 1000 / speed)
+
+        self.send_response(recording['upstream_status'] or 502)
+        if not recording['stream'] or recording['upstream_status'] != 200:
+            data = b''.join(_raw(chunk) for _, chunk in upstream)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        previous = upstream[0][0] if upstream else 0
+        for offset, chunk in upstream:
+            if speed and offset > previous:
+                time.sleep((offset - previous) / speed)
+            previous = offset
+            data = _raw(chunk)
+            self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def replay_live(recording, proxy_url, access_key=''):
+    url = urllib.parse.urlsplit(proxy_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=600)
+    headers = {'Content-Type': 'application/json'}
+    if access_key:
+        headers['Authorization'] = f'Bearer {access_key}'
+    result = {'request_id': recording['request_id'], 'stream': recording['stream']}
+    started = time.perf_counter()
+    try:
+        conn.request('POST', '/v1/chat/completions', body=json.dumps(recording['openai_request']), headers=headers)
+        resp = conn.getresponse()
+        chunks = []
+        first = None
+        while True:
+            data = resp.read1(65536) if recording['stream'] else resp.read()
+            if not data:
+                break
+            if first is None:
+                first = time.perf_counter() - started
+            chunks.append(data)
+            if not recording['stream']:
+                break
+    finally:
+        conn.close()
+    result['duration_ms'] = (time.perf_counter() - started) * 1000
+    result['first_byte_ms'] = first * 1000 if first is not None else None
+    result['recorded_duration_ms'] = recording['timings'].get('duration_ms')
+    result['recorded_first_byte_ms'] = (recording['output'][0][0] * 1000) if recording['output'] else None
+    result['status'] = resp.status
+
+    if recording['stream']:
+        expected = _canonical_frames(b''.join(_raw(data) for _, data in recording['output']))
+        actual = _canonical_frames(b''.join(chunks))
+    else:
+        expected = _canonical(recording['output'][0][1]).encode('utf-8') if recording['output'] else b''
+        actual = _canonical(json.loads(b''.join(chunks))).encode('utf-8') if resp.status == 200 else b''
+    _compare_output(result, _ID_RE.sub(b'"id":"ID"', expected), _ID_RE.sub(b'"id":"ID"', actual))
+    return result
+
+
+# ─── 报告 ──────────────────────────────────────────────────
+
+def _median(values):
+    values = [v for v in values if v is not None]
+    return round(statistics.median(values), 3) if values else None
+
+
+def summarize(results, live):
+    mismatched = [r for r in results if r.get('output_equal') is False]
+    print(f'recordings: {len(results)}  output mismatches: {len(mismatched)}')
+    if live:
+        print(f'first byte ms  median recorded={_median(r["recorded_first_byte_ms"] for r in results)}'
+              f'  replayed={_median(r["first_byte_ms"] for r in results)}')
+        print(f'duration ms    median recorded={_median(r["recorded_duration_ms"] for r in results)}'
+              f'  replayed={_median(r["duration_ms"] for r in results)}')
+    else:
+        conversion_mismatched = [r for r in results if not r['conversion_equal']]
+        print(f'conversion mismatches: {len(conversion_mismatched)}')
+        print(f'conversion ms  median recorded={_median(r["recorded_conversion_ms"] for r in results)}'
+              f'  replayed={_median(r["conversion_ms"] for r in results)}')
+        print(f'translation ms median replayed={_median(r.get("translation_ms") for r in results)}')
+        print(f'stream frames  median recorded={_median(r.get("recorded_frames") for r in results)}'
+              f'  replayed={_median(r.get("frames") for r in results)}')
+        for r in conversion_mismatched[:5]:
+            print(f'  conversion differs: {r["request_id"]}')
+    for r in mismatched[:5]:
+        diff = r['diff']
+        print(f'  output differs: {r["request_id"]} at byte {diff["offset"]}')
+        print(f'    expected: {diff["expected"]!r}')
+        print(f'    actual:   {diff["actual"]!r}')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Replay captured traffic')
+    parser.add_argument('paths', nargs='+', help='抓包文件（.jsonl.gz / .jsonl）')
+    parser.add_argument('--proxy', default='', help='在线模式：被测代理地址')
+    parser.add_argument('--relay-port', type=int, default=9300, help='在线模式：重放上游的监听端口')
+    parser.add_argument('--speed', type=float, default=1.0, help='上游重放速度倍数，0 表示不等待')
+    parser.add_argument('--access-key', default=os.getenv('ACCESS_API_KEY', ''))
+    parser.add_argument('--output', default='', help='把逐条结果写成 JSON 文件')
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    recordings = load(options.paths)
+    if not recordings:
+        raise SystemExit('no recordings found')
+
+    if options.proxy:
+        relay = _ReplayRelay(('127.0.0.1', options.relay_port), recordings, options.speed)
+        threading.Thread(target=relay.serve_forever, daemon=True).start()
+        try:
+            results = [replay_live(r, options.proxy, options.access_key) for r in recordings]
+        finally:
+            relay.shutdown()
+        if relay.unmatched:
+            print(f'warning: {relay.unmatched} upstream requests did not match a recording body exactly')
+    else:
+        results = [replay_offline(r) for r in recordings]
+
+    summarize(results, live=bool(options.proxy))
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
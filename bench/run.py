@@ -0,0 +1,145 @@
+"""一键压测：启动模拟中转站与代理，按并发档位压测并保存报告，便于跨提交对比
+
+    python bench/run.py --mode waitress --levels 1,8,32 --output bench/results/waitress.json
+    python bench/run.py --mode async --mock-args="--thinking-tokens 50 --tool-calls 1"
+    python bench/run.py --compare bench/results/before.json bench/results/after.json
+"""
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import loadgen  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _wait_ready(url, process, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'process exited early: {" ".join(process.args)}')
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f'timed out waiting for {url}')
+
+
+def _json_backend(url):
+    """代理实际使用的 JSON 后端（取自 /health），用于对比 JSON_BACKEND=json 与 auto 的报告"""
+    try:
+        with urllib.request.urlopen(url, timeout=1) as resp:
+            return json.load(resp).get('json', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _stop(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run(options):
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'bench', 'mock_relay.py'), '--port', str(options.mock_port)]
+        + shlex.split(options.mock_args),
+        stdout=subprocess.DEVNULL,
+    )
+    proxy = None
+    try:
+        _wait_ready(f'http://127.0.0.1:{options.mock_port}/health', mock)
+        env = {
+            **os.environ,
+            'PROXY_TARGET_URL': f'http://127.0.0.1:{options.mock_port}',
+            'PROXY_API_KEY': os.environ.get('PROXY_API_KEY') or 'sk-bench',
+            'PROXY_PORT': str(options.port),
+            'SERVER_MODE': options.mode,
+            'ACCESS_API_KEY': '',
+            'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+        }
+        proxy = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'start.py')],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        )
+        _wait_ready(f'http://127.0.0.1:{options.port}/health', proxy)
+
+        options.host = '127.0.0.1'
+        options.proxy_pid = proxy.pid
+        options.access_key = ''
+        meta = {
+            'revision': _git_revision(),
+            'mode': options.mode,
+            'endpoint': options.endpoint,
+            'mock_args': options.mock_args,
+            'stream_coalesce': os.environ.get('STREAM_COALESCE', 'false'),
+            'json_backend': _json_backend(f'http://127.0.0.1:{options.port}/health'),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        if options.output:
+            os.makedirs(os.path.dirname(os.path.abspath(options.output)), exist_ok=True)
+        loadgen.run(options, meta)
+    finally:
+        if proxy is not None:
+            _stop(proxy)
+        _stop(mock)
+
+
+def compare(before_path, after_path):
+    """并排对比两份报告，按并发档位对齐"""
+    with open(before_path, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(after_path, encoding='utf-8') as f:
+        after = json.load(f)
+    print(f'before: {before["meta"]}')
+    print(f'after:  {after["meta"]}')
+    before_levels = {level['concurrency']: level for level in before['levels']}
+    for level in after['levels']:
+        old = before_levels.get(level['concurrency'])
+        if old is None:
+            continue
+        print(f'\nconcurrency={level["concurrency"]}')
+        for key, title in loadgen.REPORT_COLUMNS[2:]:
+            a, b = old.get(key), level.get(key)
+            change = f'{(b - a) / a * 100:+.1f}%' if a and b is not None else ''
+            print(f'  {title:>14}  {str(a):>12}  ->  {str(b):>12}  {change}')
+
+
+def build_parser():
+    parser = loadgen.build_parser()
+    parser.description = 'Start the mock relay and the proxy, then run the load generator'
+    parser.add_argument('--mode', choices=('waitress', 'async'), default='waitress')
+    parser.add_argument('--mock-port', type=int, default=9100)
+    parser.add_argument('--mock-args', default='', help='传给 mock_relay.py 的参数')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='对比两份 JSON 报告')
+    parser.set_defaults(port=3129)
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    if options.compare:
+        compare(*options.compare)
+    else:
+        run(options)
+
+
+if __name__ == '__main__':
+    main()
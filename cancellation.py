@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import threading
+
+import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_STATS = {
+    'cancelled': 0,
+    'tokens_saved': 0,
+}
+_STATS_LOCK = threading.Lock()
+
+
+class StreamGuard:
+    """流式响应的客户端断开检测
+
+    client_disconnected 为返回客户端是否已断开的函数（waitress 的 waitress.client_disconnected，
+    aiohttp 的 transport 状态）；服务器不提供时只能在写出失败或生成器被关闭时发现断开。
+    发现断开后调用方应立即关闭上游响应，流结束时调用 finish 记录统计。
+    """
+
+    __slots__ = ('route', 'max_tokens', 'cancelled', '_client_disconnected')
+
+    def __init__(self, route, max_tokens=None, client_disconnected=None):
+        self.route = route
+        self.max_tokens = max_tokens
+        self.cancelled = False
+        self._client_disconnected = client_disconnected
+
+    def client_gone(self):
+        """客户端是否已断开；发现断开时标记为取消"""
+        if not self.cancelled and self._client_disconnected is not None and self._client_disconnected():
+            self.cancelled = True
+        return self.cancelled
+
+    def cancel(self):
+        """写出失败或生成器被服务器关闭：客户端已断开"""
+        self.cancelled = True
+
+    def finish(self, output_tokens=0):
+        """流结束时调用；被取消时计入取消的流数与节省的 token
+
+        节省的 token 按 max_tokens 减去已生成的输出计，是上游本可能继续生成的上限估计。
+        """
+        if not self.cancelled:
+            return
+        saved = max((self.max_tokens or 0) - (output_tokens or 0), 0)
+        with _STATS_LOCK:
+            _STATS['cancelled'] += 1
+            _STATS['tokens_saved'] += saved
+        metrics.STREAMS_CANCELLED.inc((self.route,))
+        if saved:
+            metrics.CANCELLED_TOKENS_SAVED.inc((self.route,), saved)
+        logger.info('[%s] client disconnected, upstream stream cancelled', self.route)
+
+
+def watch_async(guard):
+    """async 模式：每 CLIENT_DISCONNECT_POLL 秒检查一次客户端，断开时取消当前任务
+
+    上游尚未返回首字节或长时间没有数据时也能及时中止。返回轮询任务，流结束时需 cancel()；
+    调用方捕获 CancelledError 后用 absorb_cancel 判断是否由断开引起。
+    """
+    task = asyncio.current_task()
+
+    async def poll():
+        while True:
+            await asyncio.sleep(Config.CLIENT_DISCONNECT_POLL)
+            if guard.client_gone():
+                task.cancel()
+                return
+
+    return asyncio.ensure_future(poll())
+
+
+def absorb_cancel(guard):
+    """捕获 CancelledError 后调用：由客户端断开引起时返回 True 并撤销取消，否则调用方应继续抛出"""
+    if not guard.cancelled:
+        return False
+    task = asyncio.current_task()
+    if hasattr(task, 'uncancel'):
+        task.uncancel()
+    return True
+
+
+def stats():
+    """客户端断开取消的流数与节省的 token（上限估计），供 /health 输出"""
+    with _STATS_LOCK:
+        return dict(_STATS)
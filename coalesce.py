@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import threading
+import time
+
+from config import Config
+
+# 超出后不再接纳新的跟随请求，已消费的数据随即释放
+_MAX_BUFFER_BYTES = Config.REQUEST_COALESCE_BUFFER_MB * 1024 * 1024
+
+_STATS = {
+    'flights': 0,
+    'joined': 0,
+}
+_STATS_LOCK = threading.Lock()
+
+# key: 请求体哈希；value: 仍可加入的上游调用
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class FlightError(Exception):
+    """共享的上游调用失败或等待超时"""
+
+
+class _Cursor:
+    """跟随请求在缓冲区中的读取位置（绝对序号）"""
+
+    __slots__ = ('pos',)
+
+    def __init__(self, pos):
+        self.pos = pos
+
+
+class Flight:
+    """一次由多个相同请求共享的上游调用
+
+    leader 负责请求上游，按原样 publish 上游字节；跟随请求从缓冲区开头读起，各自做格式转换，
+    因此晚加入的请求也能拿到完整响应。窗口结束或缓冲超出上限后不再接纳新请求，
+    所有跟随者都已读过的数据随即丢弃，缓冲区只保留最慢读者之后的部分。
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.started = time.monotonic()
+        self.status = None
+        self.content_type = 'application/json'
+        self.error = None
+        self.done = False
+        self.joinable = True
+        self._chunks = []
+        self._base = 0  # _chunks[0] 的绝对序号
+        self._bytes = 0
+        self._cursors = set()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    def _changed(self):
+        self._cond.notify_all()
+
+    def respond(self, status, content_type=None):
+        """leader 收到上游响应头"""
+        with self._lock:
+            self.status = status
+            if content_type:
+                self.content_type = content_type
+            self._changed()
+
+    def publish(self, data):
+        """leader 追加一段上游字节"""
+        with self._lock:
+            self._chunks.append(data)
+            self._bytes += len(data)
+            if self.joinable and (self._bytes > _MAX_BUFFER_BYTES
+                                  or time.monotonic() - self.started > Config.REQUEST_COALESCE_WINDOW):
+                self.joinable = False
+            if not self.joinable:
+                self._trim()
+            self._changed()
+
+    def close(self, error=None):
+        """上游调用结束；只有第一次调用生效，error 非空表示失败或中途断开"""
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+            self.error = error
+            self._changed()
+        with _flights_lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]
+
+    def leave(self, cursor):
+        """跟随请求结束（含客户端提前断开），不再占用缓冲区"""
+        with self._lock:
+            self._cursors.discard(cursor)
+            if not self.joinable:
+                self._trim()
+
+    def _trim(self):
+        keep_from = min((c.pos for c in self._cursors), default=self._base + len(self._chunks))
+        drop = keep_from - self._base
+        if drop > 0:
+            self._bytes -= sum(len(chunk) for chunk in self._chunks[:drop])
+            del self._chunks[:drop]
+            self._base = keep_from
+
+    def _take(self, cursor):
+        """取出 cursor 之后的数据；暂无新数据且未结束时返回 None（需持有锁）"""
+        start = cursor.pos - self._base
+        if start >= len(self._chunks) and not self.done:
+            return None
+        chunks = self._chunks[start:]
+        cursor.pos += len(chunks)
+        if chunks and not self.joinable:
+            self._trim()
+        return chunks
+
+    def _response_ready(self):
+        return self.status is not None or self.done
+
+    def _check_response(self):
+        if self.status is None:
+            raise FlightError(self.error or 'coalesced upstream call ended without a response')
+        return self.status
+
+    def wait_response(self):
+        """等待 leader 收到上游响应头，返回状态码"""
+        with self._lock:
+            if not self._cond.wait_for(self._response_ready, Config.API_TIMEOUT):
+                raise FlightError('timed out waiting for the coalesced upstream call')
+            return self._check_response()
+
+    def subscribe(self, cursor):
+        """从 cursor 处依次产出上游字节，直到上游调用结束"""
+        while True:
+            with self._lock:
+                chunks = self._take(cursor)
+                while chunks is None:
+                    if not self._cond.wait(Config.API_TIMEOUT):
+                        raise FlightError('timed out waiting for the coalesced upstream call')
+                    chunks = self._take(cursor)
+                done, error = self.done, self.error
+            yield from chunks
+            if done:
+                if error:
+                    raise FlightError(error)
+                return
+
+
+class AsyncFlight(Flight):
+    """asyncio 模式的 Flight：leader 与跟随者都在事件循环中运行，用 asyncio.Event 唤醒"""
+
+    def __init__(self, key):
+        super().__init__(key)
+        self._event = asyncio.Event()
+
+    def _changed(self):
+        self._event.set()
+        self._event = asyncio.Event()
+
+    async def _wait(self, event):
+        try:
+            await asyncio.wait_for(event.wait(), Config.API_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise FlightError('timed out waiting for the coalesced upstream call') from None
+
+    async def wait_response(self):
+        while True:
+            with self._lock:
+                if self._response_ready():
+                    return self._check_response()
+                event = self._event
+            await self._wait(event)
+
+    async def subscribe(self, cursor):
+        while True:
+            with self._lock:
+                chunks = self._take(cursor)
+                event = self._event
+                done, error = self.done, self.error
+            if chunks is None:
+                await self._wait(event)
+                continue
+            for chunk in chunks:
+                yield chunk
+            if done:
+                if error:
+                    raise FlightError(error)
+                return
+
+
+def flight_key(body):
+    """返回请求的合并 key；未开启合并时返回 None"""
+    if not Config.REQUEST_COALESCING:
+        return None
+    return hashlib.sha256(body).hexdigest()
+
+
+def join(key, flight_cls=Flight):
+    """加入相同请求的上游调用，返回 (flight, cursor)
+
+    cursor 为 None 表示没有可加入的调用，当前请求成为 leader，需要自己请求上游并 publish。
+    """
+    now = time.monotonic()
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            with flight._lock:
+                if (not flight.done and flight.joinable
+                        and now - flight.started <= Config.REQUEST_COALESCE_WINDOW):
+                    # 可加入期间缓冲区从未裁剪，_base 恒为 0
+                    cursor = _Cursor(flight._base)
+                    flight._cursors.add(cursor)
+                    with _STATS_LOCK:
+                        _STATS['joined'] += 1
+                    return flight, cursor
+        flight = flight_cls(key)
+        _flights[key] = flight
+    with _STATS_LOCK:
+        _STATS['flights'] += 1
+    return flight, None
+
+
+def stats():
+    """请求合并统计，供 /health 输出；joined 即节省的上游调用次数"""
+    with _STATS_LOCK:
+        result = dict(_STATS)
+    with _flights_lock:
+        result['in_flight'] = len(_flights)
+    result['enabled'] = Config.REQUEST_COALESCING
+    return result
@@ -7,3 +7,126 @@ class Config:
     PROXY_PORT = int(os.getenv('PROXY_PORT', '3029'))
     API_TIMEOUT = int(os.getenv('API_TIMEOUT', '300'))
     ACCESS_API_KEY = os.getenv('ACCESS_API_KEY', '')
+    # 多上游：逗号分隔的 url|key 列表（key 省略时用 PROXY_API_KEY），留空则只用 PROXY_TARGET_URL
+    PROXY_UPSTREAMS = os.getenv('PROXY_UPSTREAMS', '')
+    # 服务模式：waitress（线程池，默认）/ async（aiohttp + httpx，适合大量并发长流）
+    SERVER_MODE = os.getenv('SERVER_MODE', 'waitress').lower()
+
+    # 日志：级别、输出格式（text / json）、逐条消息摘要的抽样率（0~1，DEBUG 级别下全部记录）
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+    LOG_MESSAGE_SAMPLE_RATE = float(os.getenv('LOG_MESSAGE_SAMPLE_RATE', '0'))
+
+    # 流量抓包：记录请求、转换结果、上游原始 SSE 与输出帧，后台写入按大小轮转的 gzip JSONL
+    TRAFFIC_CAPTURE = os.getenv('TRAFFIC_CAPTURE', 'false').lower() == 'true'
+    TRAFFIC_CAPTURE_DIR = os.getenv('TRAFFIC_CAPTURE_DIR', 'captures')
+    TRAFFIC_CAPTURE_FILE_MB = int(os.getenv('TRAFFIC_CAPTURE_FILE_MB', '64'))
+    # 写盘跟不上时最多排队的记录数，超出后丢弃
+    TRAFFIC_CAPTURE_QUEUE = int(os.getenv('TRAFFIC_CAPTURE_QUEUE', '1000'))
+
+    # 响应缓存：相同请求直接返回上一次的回复（流式请求重放缓存的 SSE）
+    RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'false').lower() == 'true'
+    RESPONSE_CACHE_MAX_MB = int(os.getenv('RESPONSE_CACHE_MAX_MB', '128'))
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+    # 磁盘缓存目录，留空则只缓存在内存中
+    RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR', '')
+    # 只缓存 temperature 为 0 的请求
+    RESPONSE_CACHE_DETERMINISTIC_ONLY = os.getenv('RESPONSE_CACHE_DETERMINISTIC_ONLY', 'true').lower() == 'true'
+    # 是否缓存以工具调用结束的回复
+    RESPONSE_CACHE_TOOL_USE = os.getenv('RESPONSE_CACHE_TOOL_USE', 'false').lower() == 'true'
+
+    # 准入控制：按客户端（接入 Key 或来源地址）限制并发与 TPM，全局限制进行中的上游请求，
+    # 超出时按权重轮询排队，队列满或排队超时返回 429 + Retry-After
+    ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', 'false').lower() == 'true'
+    # 客户端区分方式：token（接入 Key，取不到时用来源地址）/ ip
+    ADMISSION_CLIENT_KEY = os.getenv('ADMISSION_CLIENT_KEY', 'token').lower()
+    ADMISSION_MAX_INFLIGHT = int(os.getenv('ADMISSION_MAX_INFLIGHT', '64'))
+    ADMISSION_PER_KEY_CONCURRENCY = int(os.getenv('ADMISSION_PER_KEY_CONCURRENCY', '8'))
+    ADMISSION_PER_KEY_TPM = int(os.getenv('ADMISSION_PER_KEY_TPM', '0'))
+    ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '256'))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '30'))
+    # 逗号分隔的 客户端:权重 列表，未列出的客户端权重为 1
+    ADMISSION_WEIGHTS = os.getenv('ADMISSION_WEIGHTS', '')
+
+    # 请求合并：窗口内到达的相同请求共用一次上游调用，上游流同时分发给所有等待的客户端
+    REQUEST_COALESCING = os.getenv('REQUEST_COALESCING', 'false').lower() == 'true'
+    REQUEST_COALESCE_WINDOW = float(os.getenv('REQUEST_COALESCE_WINDOW', '10'))
+    # 单次共享调用的缓冲上限，超出后不再接纳新请求
+    REQUEST_COALESCE_BUFFER_MB = int(os.getenv('REQUEST_COALESCE_BUFFER_MB', '16'))
+
+    # 上游连接池：复用 keep-alive 连接，省去每次请求的 TCP + TLS 握手
+    UPSTREAM_POOL_HOSTS = int(os.getenv('UPSTREAM_POOL_HOSTS', '10'))
+    UPSTREAM_POOL_PER_HOST = int(os.getenv('UPSTREAM_POOL_PER_HOST', '100'))
+    UPSTREAM_POOL_BLOCK = os.getenv('UPSTREAM_POOL_BLOCK', 'false').lower() == 'true'
+    UPSTREAM_IDLE_TIMEOUT = float(os.getenv('UPSTREAM_IDLE_TIMEOUT', '60'))
+    # HTTP/2 多路复用（仅 async 模式生效，requests 不支持 HTTP/2）
+    UPSTREAM_HTTP2 = os.getenv('UPSTREAM_HTTP2', 'false').lower() == 'true'
+
+    # 多上游负载均衡：least_outstanding（进行中请求最少）/ ewma（TTFB 加权平均 × 进行中请求数）
+    UPSTREAM_BALANCE = os.getenv('UPSTREAM_BALANCE', 'least_outstanding').lower()
+    # 连续失败（连接错误、5xx、429）达到次数后熔断，冷却后放行一个试探请求
+    UPSTREAM_CIRCUIT_FAILURES = int(os.getenv('UPSTREAM_CIRCUIT_FAILURES', '5'))
+    UPSTREAM_CIRCUIT_COOLDOWN = float(os.getenv('UPSTREAM_CIRCUIT_COOLDOWN', '30'))
+    # 主动健康检查间隔（秒），0 为关闭
+    UPSTREAM_HEALTH_CHECK_INTERVAL = float(os.getenv('UPSTREAM_HEALTH_CHECK_INTERVAL', '0'))
+    UPSTREAM_HEALTH_CHECK_PATH = os.getenv('UPSTREAM_HEALTH_CHECK_PATH', '/v1/models')
+    UPSTREAM_HEALTH_CHECK_TIMEOUT = float(os.getenv('UPSTREAM_HEALTH_CHECK_TIMEOUT', '5'))
+    # 首字节前失败（连接错误、5xx、429）时的重试：次数、指数退避基数与单次等待上限（秒）
+    UPSTREAM_RETRIES = int(os.getenv('UPSTREAM_RETRIES', '2'))
+    UPSTREAM_RETRY_BACKOFF = float(os.getenv('UPSTREAM_RETRY_BACKOFF', '0.5'))
+    UPSTREAM_RETRY_MAX_DELAY = float(os.getenv('UPSTREAM_RETRY_MAX_DELAY', '10'))
+    # 重试与对冲的额外请求预算：每个请求积累的额度，长期额外请求数不超过请求数 × 该比例
+    UPSTREAM_RETRY_BUDGET = float(os.getenv('UPSTREAM_RETRY_BUDGET', '0.1'))
+    # 对冲请求（仅 async 模式）：超过首字节耗时 p95 仍未收到 message_start 时再发一个相同请求
+    UPSTREAM_HEDGE = os.getenv('UPSTREAM_HEDGE', 'false').lower() == 'true'
+    UPSTREAM_HEDGE_MIN_DELAY = float(os.getenv('UPSTREAM_HEDGE_MIN_DELAY', '1'))
+    # async 模式下检查流式请求客户端是否断开的间隔（秒），断开后立即中止上游请求
+    CLIENT_DISCONNECT_POLL = float(os.getenv('CLIENT_DISCONNECT_POLL', '1'))
+
+    # Prompt caching：自动放置 cache_control 断点（tools / system / 对话滚动边界）
+    PROMPT_CACHE = os.getenv('PROMPT_CACHE', 'true').lower() == 'true'
+    PROMPT_CACHE_BREAKPOINTS = [
+        item.strip() for item in os.getenv('PROMPT_CACHE_BREAKPOINTS', 'tools,system,messages').split(',')
+        if item.strip()
+    ]
+    # 缓存有效期，留空使用默认 5 分钟，可设为 1h
+    PROMPT_CACHE_TTL = os.getenv('PROMPT_CACHE_TTL', '')
+
+    # 会话转换缓存：按消息前缀哈希复用上一轮的转换结果，只转换新增消息
+    CONVERSION_CACHE = os.getenv('CONVERSION_CACHE', 'true').lower() == 'true'
+    CONVERSION_CACHE_MAX_MB = int(os.getenv('CONVERSION_CACHE_MAX_MB', '256'))
+
+    # 图片缓存：data: URL 按内容寻址，历史中重复出现的截图只切分、校验一次
+    IMAGE_CACHE = os.getenv('IMAGE_CACHE', 'true').lower() == 'true'
+    IMAGE_CACHE_MAX_MB = int(os.getenv('IMAGE_CACHE_MAX_MB', '128'))
+    # 上传前缩小过大的图片（需要 Pillow）：长边超过 IMAGE_MAX_DIMENSION 像素或超过 IMAGE_MAX_BYTES 时
+    # 缩放并重新编码为 JPEG（有透明通道时为 PNG）
+    IMAGE_RESIZE = os.getenv('IMAGE_RESIZE', 'false').lower() == 'true'
+    IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', '1568'))
+    IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', '1048576'))
+    IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+
+    # 上下文压缩：估算的输入 token 超过 CONTEXT_COMPACTION_MAX_TOKENS 时，从最早的消息开始把超过
+    # CONTEXT_COMPACTION_MIN_TOKENS 的 tool_result 截断为首尾共 CONTEXT_COMPACTION_KEEP_TOKENS，
+    # 最近 CONTEXT_COMPACTION_KEEP_TURNS 轮不动
+    CONTEXT_COMPACTION = os.getenv('CONTEXT_COMPACTION', 'false').lower() == 'true'
+    CONTEXT_COMPACTION_MAX_TOKENS = int(os.getenv('CONTEXT_COMPACTION_MAX_TOKENS', '120000'))
+    CONTEXT_COMPACTION_KEEP_TURNS = int(os.getenv('CONTEXT_COMPACTION_KEEP_TURNS', '4'))
+    CONTEXT_COMPACTION_MIN_TOKENS = int(os.getenv('CONTEXT_COMPACTION_MIN_TOKENS', '1000'))
+    CONTEXT_COMPACTION_KEEP_TOKENS = int(os.getenv('CONTEXT_COMPACTION_KEEP_TOKENS', '200'))
+    # tool_result 去重：内容完全相同且不短于 TOOL_RESULT_DEDUP_MIN_CHARS 的工具结果，较早的副本替换为引用
+    TOOL_RESULT_DEDUP = os.getenv('TOOL_RESULT_DEDUP', 'false').lower() == 'true'
+    TOOL_RESULT_DEDUP_MIN_CHARS = int(os.getenv('TOOL_RESULT_DEDUP_MIN_CHARS', '1024'))
+
+    # JSON 后端：auto 在安装了 msgspec 时用于解析（结果与标准库一致），json 强制使用标准库；序列化始终用标准库
+    JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto').lower()
+
+    # old_string 修复时缓存的文件内容上限（按 mtime/size 失效）
+    TOOL_REPAIR_FILE_CACHE_MB = int(os.getenv('TOOL_REPAIR_FILE_CACHE_MB', '64'))
+    # 流式响应中缓冲工具参数，修复 file_path / old_string 后整体发送（文本与思考增量不受影响）
+    STREAM_TOOL_REPAIR = os.getenv('STREAM_TOOL_REPAIR', 'false').lower() == 'true'
+    # 流式增量合并：同一块内连续的 text/thinking/工具参数增量合并为一个 chunk，攒满字节数、
+    # 遇到块边界或超过时间窗口（仅 async 模式跨网络读取暂存，waitress 模式只合并同一次读取）时发送
+    STREAM_COALESCE = os.getenv('STREAM_COALESCE', 'false').lower() == 'true'
+    STREAM_COALESCE_BYTES = int(os.getenv('STREAM_COALESCE_BYTES', '4096'))
+    STREAM_COALESCE_WINDOW_MS = float(os.getenv('STREAM_COALESCE_WINDOW_MS', '20'))
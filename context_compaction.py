@@ -0,0 +1,213 @@
+import logging
+import threading
+
+import metrics
+from config import Config
+from tool_cache import SerializedTools
+
+logger = logging.getLogger(__name__)
+
+# 图片按固定 token 数估算（长边 1568 像素的图片约 1600 token）
+_IMAGE_TOKENS = 1600
+
+# 截断处插入的说明，模型需要时可以重新调用工具获取完整输出
+_ELIDED = '\n[... {} tokens of earlier tool output omitted by the proxy to save context ...]\n'
+# 重复的 tool_result 替换为指向最后一次出现的引用
+_DUPLICATE = '[identical to the output of tool call {} later in this conversation]'
+
+_STATS = {
+    'requests': 0,
+    'compacted': 0,
+    'tool_results': 0,
+    'tokens_removed': 0,
+    'deduplicated': 0,
+    'dedup_tokens_removed': 0,
+}
+_STATS_LOCK = threading.Lock()
+
+
+def estimate_tokens(obj):
+    """本地粗略估算 token 数：ASCII 约 4 个字符 1 个 token，其余按 UTF-8 字节数计"""
+    if isinstance(obj, str):
+        return (len(obj) if obj.isascii() else len(obj.encode('utf-8'))) // 4
+    if isinstance(obj, dict):
+        if obj.get('type') == 'image':
+            return _IMAGE_TOKENS
+        return sum(estimate_tokens(value) for value in obj.values())
+    if isinstance(obj, SerializedTools):
+        return len(obj.json) // 4
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_tokens(value) for value in obj)
+    return 1
+
+
+def dedup_tool_results(anthropic_request):
+    """把内容完全相同的 tool_result 的较早副本替换为指向最后一次出现的短引用
+
+    Agent 循环里反复读取同一文件、执行同一命令时，同样的输出会在历史中出现多次。
+    从后往前扫描一遍，以内容字符串为键（字符串的哈希会被缓存，转换缓存复用的消息无需重新计算）；
+    不短于 TOOL_RESULT_DEDUP_MIN_CHARS 的纯文本结果才参与。只替换内容，block 与消息结构不变。
+    """
+    if not Config.TOOL_RESULT_DEDUP:
+        return anthropic_request
+    messages = anthropic_request.get('messages')
+    if not messages:
+        return anthropic_request
+
+    min_chars = Config.TOOL_RESULT_DEDUP_MIN_CHARS
+    latest = {}  # 内容 → 最后一次出现的 tool_use_id
+    removed = 0
+    replaced = 0
+    for index in range(len(messages) - 1, -1, -1):
+        msg = messages[index]
+        content = msg.get('content')
+        if msg.get('role') != 'user' or not isinstance(content, list):
+            continue
+        new_content = None
+        for pos in range(len(content) - 1, -1, -1):
+            block = content[pos]
+            if not isinstance(block, dict) or block.get('type') != 'tool_result':
+                continue
+            text = _tool_result_text(block)
+            if text is None or len(text) < min_chars:
+                continue
+            tool_use_id = latest.get(text)
+            if tool_use_id is None:
+                latest[text] = block.get('tool_use_id', '')
+                continue
+            stub = _DUPLICATE.format(tool_use_id)
+            if new_content is None:
+                new_content = list(content)
+            new_content[pos] = {**block, 'content': stub}
+            removed += estimate_tokens(text) - estimate_tokens(stub)
+            replaced += 1
+        if new_content is not None:
+            messages[index] = {**msg, 'content': new_content}
+
+    if replaced:
+        with _STATS_LOCK:
+            _STATS['deduplicated'] += replaced
+            _STATS['dedup_tokens_removed'] += removed
+        metrics.COMPACTION_TOKENS_REMOVED.observe((anthropic_request.get('model', ''), 'dedup'), removed)
+        logger.info('[compaction] replaced %d duplicate tool results (removed ~%d tokens)', replaced, removed)
+    return anthropic_request
+
+
+def compact(anthropic_request):
+    """估算的输入 token 超过 CONTEXT_COMPACTION_MAX_TOKENS 时截断较早的大 tool_result
+
+    从最早的消息开始，把超过 CONTEXT_COMPACTION_MIN_TOKENS 的 tool_result 内容缩减为
+    首尾共 CONTEXT_COMPACTION_KEEP_TOKENS（为 0 时整段省略），降到预算以内即停止；
+    最近 CONTEXT_COMPACTION_KEEP_TURNS 轮保持原样。只替换 tool_result 的内容，
+    tool_use / tool_result 的配对不变。会话增长时截断点只会向后移动，已截断的前缀
+    每轮保持一致，不影响 prompt caching 命中。消息 dict 可能被转换缓存共享，只替换不修改。
+    """
+    if not Config.CONTEXT_COMPACTION:
+        return anthropic_request
+    messages = anthropic_request.get('messages')
+    if not messages:
+        return anthropic_request
+
+    total = (estimate_tokens(messages) + estimate_tokens(anthropic_request.get('system') or '')
+             + estimate_tokens(anthropic_request.get('tools') or ()))
+    budget = Config.CONTEXT_COMPACTION_MAX_TOKENS
+    with _STATS_LOCK:
+        _STATS['requests'] += 1
+    if total <= budget:
+        return anthropic_request
+
+    removed = 0
+    truncated = 0
+    for index in range(_recent_turns_start(messages, Config.CONTEXT_COMPACTION_KEEP_TURNS)):
+        if total - removed <= budget:
+            break
+        msg = messages[index]
+        content = msg.get('content')
+        if msg.get('role') != 'user' or not isinstance(content, list):
+            continue
+        new_content = None
+        for pos, block in enumerate(content):
+            if total - removed <= budget:
+                break
+            if not isinstance(block, dict) or block.get('type') != 'tool_result':
+                continue
+            compacted, saved = _compact_tool_result(block)
+            if not saved:
+                continue
+            if new_content is None:
+                new_content = list(content)
+            new_content[pos] = compacted
+            removed += saved
+            truncated += 1
+        if new_content is not None:
+            messages[index] = {**msg, 'content': new_content}
+
+    if truncated:
+        with _STATS_LOCK:
+            _STATS['compacted'] += 1
+            _STATS['tool_results'] += truncated
+            _STATS['tokens_removed'] += removed
+        metrics.COMPACTION_TOKENS_REMOVED.observe((anthropic_request.get('model', ''), 'truncate'), removed)
+        logger.info('[compaction] ~%d -> ~%d tokens, truncated %d tool results (removed ~%d tokens)',
+                    total, total - removed, truncated, removed)
+    else:
+        logger.info('[compaction] ~%d tokens exceeds budget %d, nothing left to truncate', total, budget)
+    return anthropic_request
+
+
+def _recent_turns_start(messages, turns):
+    """最近 turns 轮的起始下标；一轮从一条 assistant 消息开始，包括其后返回工具结果的 user 消息"""
+    if turns <= 0:
+        return len(messages)
+    seen = 0
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].get('role') == 'assistant':
+            seen += 1
+            if seen == turns:
+                return index
+    return 0
+
+
+def _compact_tool_result(block):
+    """截断一个 tool_result，返回 (新 block, 估算减少的 token 数)；无需截断时减少数为 0
+
+    只处理纯文本内容（字符串或 text block 列表），带图片的结果保持原样。
+    """
+    text = _tool_result_text(block)
+    if text is None:
+        return block, 0
+
+    tokens = estimate_tokens(text)
+    if tokens <= Config.CONTEXT_COMPACTION_MIN_TOKENS:
+        return block, 0
+    # 首尾各保留一半；非 ASCII 文本按字符数截取，保留的 token 数只是近似
+    keep_chars = max(Config.CONTEXT_COMPACTION_KEEP_TOKENS, 0) * 2
+    head = text[:keep_chars]
+    tail = text[-keep_chars:] if keep_chars else ''
+    new_text = head + _ELIDED.format(tokens - estimate_tokens(head) - estimate_tokens(tail)) + tail
+    saved = tokens - estimate_tokens(new_text)
+    if saved <= 0:
+        return block, 0
+    return {**block, 'content': new_text}, saved
+
+
+def _tool_result_text(block):
+    """tool_result 的纯文本内容；包含图片等非文本内容时返回 None"""
+    content = block.get('content')
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list) and all(isinstance(part, dict) and part.get('type') == 'text' for part in content):
+        return '\n'.join(part.get('text', '') for part in content)
+    return None
+
+
+def stats():
+    """上下文压缩与 tool_result 去重统计，供 /health 输出；*tokens_removed 为累计减少的估算 token 数"""
+    with _STATS_LOCK:
+        result = dict(_STATS)
+    result.update(
+        enabled=Config.CONTEXT_COMPACTION,
+        max_tokens=Config.CONTEXT_COMPACTION_MAX_TOKENS,
+        dedup_enabled=Config.TOOL_RESULT_DEDUP,
+    )
+    return result
@@ -0,0 +1,124 @@
+import threading
+
+from config import Config
+from lru import ByteLRU
+
+# 每个会话保留的前缀条目数（会话只向后增长，旧前缀很快失效）
+MAX_ENTRIES_PER_CONVERSATION = 4
+
+# key: 会话指纹（前两条消息的结构哈希）；value: 该会话的前缀条目，长的在前
+_cache = ByteLRU(Config.CONVERSION_CACHE_MAX_MB * 1024 * 1024)
+
+_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'reused_messages': 0,
+    'converted_messages': 0,
+}
+_STATS_LOCK = threading.Lock()
+
+
+class _Entry:
+    __slots__ = ('source', 'system_parts', 'messages', 'size')
+
+    def __init__(self, source, system_parts, messages, size):
+        self.source = source
+        self.system_parts = system_parts
+        self.messages = messages
+        self.size = size
+
+
+class PrefixLookup:
+    """一次前缀查询的结果：前 length 条 OpenAI 消息的转换结果可直接复用"""
+
+    __slots__ = ('length', 'system_parts', 'messages', 'key', 'size')
+
+    def __init__(self, length=0, system_parts=(), messages=(), key=None, size=0):
+        self.length = length
+        self.system_parts = system_parts
+        self.messages = messages
+        self.key = key
+        self.size = size
+
+
+def _fingerprint(obj):
+    """结构哈希，仅用于定位候选条目；是否命中由逐项比较决定"""
+    if isinstance(obj, str):
+        return hash(obj)
+    if isinstance(obj, dict):
+        return hash(tuple((key, _fingerprint(value)) for key, value in obj.items()))
+    if isinstance(obj, list):
+        return hash(tuple(_fingerprint(value) for value in obj))
+    try:
+        return hash(obj)
+    except TypeError:
+        return hash(repr(obj))
+
+
+def _estimate_size(obj):
+    """粗略估算对象占用的字节数（字符串长度之和）"""
+    if isinstance(obj, str):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(_estimate_size(value) for value in obj.values()) + 64
+    if isinstance(obj, list):
+        return sum(_estimate_size(value) for value in obj) + 32
+    return 16
+
+
+def lookup(messages):
+    """返回缓存中与本次请求相同的最长消息前缀
+
+    同一会话每轮都在历史末尾追加消息，上一轮的完整历史就是本轮的前缀。
+    候选前缀用列表相等比较验证，比较在 C 层完成，比重新转换便宜一个数量级。
+    """
+    if not Config.CONVERSION_CACHE or len(messages) < 2:
+        return PrefixLookup()
+
+    key = _fingerprint(messages[:2])
+    for entry in _cache.get(key) or ():
+        length = len(entry.source)
+        if length <= len(messages) and entry.source == messages[:length]:
+            with _STATS_LOCK:
+                _STATS['hits'] += 1
+                _STATS['reused_messages'] += length
+                _STATS['converted_messages'] += len(messages) - length
+            return PrefixLookup(length, entry.system_parts, entry.messages, key, entry.size)
+
+    with _STATS_LOCK:
+        _STATS['misses'] += 1
+        _STATS['converted_messages'] += len(messages)
+    return PrefixLookup(key=key)
+
+
+def store(prefix, messages, system_parts, converted):
+    """缓存本次完整历史的转换结果，下一轮作为前缀复用
+
+    缓存的消息 dict 会被后续请求共享，下游处理必须复制后再修改。
+    """
+    if prefix.key is None:
+        return
+    size = prefix.size + _estimate_size(messages[prefix.length:])
+    entry = _Entry(list(messages), tuple(system_parts), tuple(converted), size)
+    entries = [entry]
+    for old in _cache.peek(prefix.key) or ():
+        if len(entries) >= MAX_ENTRIES_PER_CONVERSATION:
+            break
+        if len(old.source) != len(entry.source):
+            entries.append(old)
+    entries.sort(key=lambda item: len(item.source), reverse=True)
+    _cache.put(prefix.key, tuple(entries), sum(item.size for item in entries))
+
+
+def stats():
+    """转换缓存统计，供 /health 输出"""
+    with _STATS_LOCK:
+        result = dict(_STATS)
+    lru_stats = _cache.stats()
+    result.update(
+        conversations=lru_stats['entries'],
+        bytes=lru_stats['bytes'],
+        max_bytes=lru_stats['max_bytes'],
+        evictions=lru_stats['evictions'],
+    )
+    return result
@@ -0,0 +1,149 @@
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import threading
+
+import metrics
+from config import Config
+from lru import ByteLRU
+
+logger = logging.getLogger(__name__)
+
+# Anthropic 接受的图片类型
+_SUPPORTED_MEDIA_TYPES = frozenset(('image/jpeg', 'image/png', 'image/gif', 'image/webp'))
+
+# key: data URL 的 SHA-1；value: (Anthropic image source, 每次上传节省的字节数)
+_cache = ByteLRU(Config.IMAGE_CACHE_MAX_MB * 1024 * 1024)
+
+_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'invalid': 0,
+    'resized': 0,
+    'bytes_saved': 0,
+}
+_STATS_LOCK = threading.Lock()
+
+_pillow_missing_logged = False
+
+
+def image_source(url):
+    """data: URL → Anthropic base64 image source
+
+    Cursor 在之后的每一轮都会重发历史中的截图；按 URL 内容寻址缓存转换结果，同一张图片
+    只切分、校验（以及按 IMAGE_RESIZE 缩放）一次。返回的 dict 被多个请求共享，不能原地修改。
+    """
+    if not Config.IMAGE_CACHE:
+        source, saved = _convert(url)
+        _count_saved(saved)
+        return source
+
+    key = hashlib.sha1(url.encode('utf-8')).digest()
+    cached = _cache.get(key)
+    if cached is None:
+        cached = _convert(url)
+        _cache.put(key, cached, len(cached[0]['data']) + 128)
+        with _STATS_LOCK:
+            _STATS['misses'] += 1
+    else:
+        with _STATS_LOCK:
+            _STATS['hits'] += 1
+    source, saved = cached
+    _count_saved(saved)
+    return source
+
+
+def _count_saved(saved):
+    if saved:
+        with _STATS_LOCK:
+            _STATS['bytes_saved'] += saved
+        metrics.IMAGE_BYTES_SAVED.inc(amount=saved)
+
+
+def _convert(url):
+    """切分并校验 data URL，返回 (source, 节省的字节数)；无法识别的图片原样上传，由上游报错"""
+    header, _, b64 = url.partition(';base64,')
+    media_type = header.replace('data:', '') or 'image/png'
+    source = {
+        'type': 'base64',
+        'media_type': media_type,
+        'data': b64,
+    }
+    try:
+        raw = base64.b64decode(b64, validate=True)
+    except (binascii.Error, ValueError):
+        raw = None
+    if raw is None or media_type not in _SUPPORTED_MEDIA_TYPES:
+        with _STATS_LOCK:
+            _STATS['invalid'] += 1
+        logger.warning('[image] invalid image data url (media_type=%s, %d bytes)', media_type, len(url))
+        return source, 0
+
+    if not Config.IMAGE_RESIZE:
+        return source, 0
+    resized = _resize(raw)
+    if resized is None:
+        return source, 0
+    new_type, data = resized
+    new_b64 = base64.b64encode(data).decode('ascii')
+    if len(new_b64) >= len(b64):
+        return source, 0
+    with _STATS_LOCK:
+        _STATS['resized'] += 1
+    logger.info('[image] resized %s %d -> %s %d bytes', media_type, len(raw), new_type, len(data))
+    return {'type': 'base64', 'media_type': new_type, 'data': new_b64}, len(b64) - len(new_b64)
+
+
+def _resize(raw):
+    """超出 IMAGE_MAX_DIMENSION 或 IMAGE_MAX_BYTES 的图片缩小并重新编码，返回 (media_type, 字节)
+
+    有透明通道的图片保存为 PNG，其余为 JPEG；动图、无法解析的图片以及未安装 Pillow 时返回 None。
+    """
+    global _pillow_missing_logged
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _pillow_missing_logged:
+            _pillow_missing_logged = True
+            logger.warning('[image] IMAGE_RESIZE requires Pillow (pip install Pillow), images are sent as-is')
+        return None
+
+    max_dimension = Config.IMAGE_MAX_DIMENSION
+    try:
+        with Image.open(io.BytesIO(raw)) as image:
+            too_large = max_dimension > 0 and max(image.size) > max_dimension
+            if not too_large and len(raw) <= Config.IMAGE_MAX_BYTES:
+                return None
+            if getattr(image, 'is_animated', False):
+                return None
+            if too_large:
+                image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            else:
+                image.load()
+            output = io.BytesIO()
+            if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                image.save(output, format='PNG', optimize=True)
+                return 'image/png', output.getvalue()
+            image.convert('RGB').save(output, format='JPEG', quality=Config.IMAGE_JPEG_QUALITY, optimize=True)
+            return 'image/jpeg', output.getvalue()
+    except Exception as e:
+        logger.warning('[image] failed to resize image: %s', e)
+        return None
+
+
+def stats():
+    """图片缓存与缩放统计，供 /health 输出；bytes_saved 为累计少上传的 base64 字节数"""
+    with _STATS_LOCK:
+        result = dict(_STATS)
+    lru_stats = _cache.stats()
+    result.update(
+        enabled=Config.IMAGE_CACHE,
+        resize=Config.IMAGE_RESIZE,
+        images=lru_stats['entries'],
+        bytes=lru_stats['bytes'],
+        max_bytes=lru_stats['max_bytes'],
+        evictions=lru_stats['evictions'],
+    )
+    return result
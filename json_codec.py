@@ -0,0 +1,52 @@
+import json
+import logging
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 只用快速后端解析：msgspec 解析出的值与 json.loads 相同，它拒绝的输入（NaN/Infinity 字面量、
+# 孤立的 UTF-16 代理项、超出 64 位的整数等）一律退回标准库处理。orjson 解析超大整数时会转成浮点数，不使用。
+# 序列化的结果直接发给客户端或上游，始终用 json.dumps：orjson / msgspec 输出紧凑 JSON、
+# 非 ASCII 字符不转义、NaN 输出为 null，逐字节对齐要在 Python 里重新扫描输出，比标准库的 C 实现还慢。
+
+_fast_loads = None
+_LOADS_ERRORS = ()
+
+LOADS_BACKEND = 'json'
+DUMPS_BACKEND = 'json'
+
+if Config.JSON_BACKEND == 'auto':
+    try:
+        import msgspec
+    except ImportError:
+        pass
+    else:
+        _fast_loads = msgspec.json.decode
+        _LOADS_ERRORS = (msgspec.DecodeError,)
+        LOADS_BACKEND = 'msgspec'
+
+
+def loads(data):
+    """解析 JSON（str 或 bytes），结果与 json.loads 相同"""
+    if _fast_loads is not None:
+        try:
+            return _fast_loads(data)
+        except _LOADS_ERRORS:
+            pass
+    return json.loads(data)
+
+
+def dumpb(obj):
+    """序列化为 bytes，可直接作为请求体或响应体发送，与 json.dumps(obj).encode() 相同"""
+    return json.dumps(obj).encode('ascii')
+
+
+def dumps(obj):
+    """序列化为 str，与 json.dumps 相同"""
+    return json.dumps(obj)
+
+
+def stats():
+    """当前使用的 JSON 后端，供 /health 输出"""
+    return {'loads': LOADS_BACKEND, 'dumps': DUMPS_BACKEND}
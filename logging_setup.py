@@ -0,0 +1,73 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+from config import Config
+
+TEXT_FORMAT = '%(asctime)s [%(name)s] %(levelname)s: %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出一行 JSON，便于日志平台按字段检索"""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                    + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        # 经过 _QueueHandler 的记录已在请求线程渲染好 exc_text
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """只复制记录后入队，消息格式化留给后台线程
+
+    默认的 prepare 会在请求线程调用 format 并丢弃 args，格式化实际上仍在请求线程。
+    异常堆栈在入队前渲染为 exc_text 并丢弃 traceback，队列里的记录不持有栈帧及其局部变量。
+    args 在后台线程才格式化，日志参数不要传之后还会被修改的可变对象。
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_EXC_FORMATTER = logging.Formatter()
+
+
+def setup_logging():
+    """配置根日志：请求线程/协程只把记录放进队列，由后台线程负责格式化和写出
+
+    写 stderr 或日志文件变慢时不会阻塞请求处理；进程退出前会把队列里的日志写完。
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    if Config.LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers[:] = [_QueueHandler(log_queue)]
+    root.setLevel(Config.LOG_LEVEL)
+    return listener
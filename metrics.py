@@ -0,0 +1,239 @@
+import threading
+import time
+
+# 所有指标按注册顺序输出
+_REGISTRY = []
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+CONVERSION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+COMPACTION_TOKENS_BUCKETS = (1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=''):
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.extend(self._render_sample(labels, value))
+        return lines
+
+    def _render_sample(self, labels, value):
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, value):
+        with self._lock:
+            sample = self._values.get(labels)
+            if sample is None:
+                # [各桶计数..., +Inf 计数, 总和]
+                sample = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[i] += 1
+                    break
+            else:
+                sample[-2] += 1
+            sample[-1] += value
+
+    def _render_sample(self, labels, sample):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), sample[:-1]):
+            cumulative += count
+            le = 'le="+Inf"' if bound == '+Inf' else f'le="{_format_value(float(bound))}"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+        label_str = _format_labels(self.labelnames, labels)
+        lines.append(f'{self.name}_sum{label_str} {_format_value(sample[-1])}')
+        lines.append(f'{self.name}_count{label_str} {cumulative}')
+        return lines
+
+
+def render():
+    """Prometheus 文本格式（0.0.4）"""
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# ─── 代理指标 ───────────────────────────────────────────────
+
+CONVERSION_SECONDS = Histogram(
+    'proxy_conversion_seconds', 'OpenAI to Anthropic request conversion time',
+    ('model', 'stream'), CONVERSION_BUCKETS)
+UPSTREAM_TTFB_SECONDS = Histogram(
+    'proxy_upstream_ttfb_seconds', 'Time from sending the upstream request to receiving response headers',
+    ('model', 'stream'))
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    'proxy_time_to_first_token_seconds', 'Time from receiving the client request to writing the first token',
+    ('model', 'stream'))
+STREAM_DURATION_SECONDS = Histogram(
+    'proxy_stream_duration_seconds', 'Total duration of streamed responses',
+    ('model', 'stream'))
+TOKENS_PER_SECOND = Histogram(
+    'proxy_output_tokens_per_second', 'Output tokens per second after the first token',
+    ('model', 'stream'), TOKENS_PER_SECOND_BUCKETS)
+ACTIVE_STREAMS = Gauge(
+    'proxy_active_streams', 'Streams currently being relayed', ('model',))
+UPSTREAM_RESPONSES = Counter(
+    'proxy_upstream_responses_total', 'Upstream responses by status code', ('model', 'stream', 'code'))
+ERRORS = Counter(
+    'proxy_errors_total', 'Requests that failed inside the proxy', ('model', 'stream', 'type'))
+TOKENS = Counter(
+    'proxy_tokens_total', 'Token usage reported by upstream', ('model', 'stream', 'type'))
+ADMISSION_INFLIGHT = Gauge(
+    'proxy_admission_inflight', 'Upstream requests admitted and not yet finished')
+ADMISSION_QUEUE_DEPTH = Gauge(
+    'proxy_admission_queue_depth', 'Requests waiting for admission')
+ADMISSION_WAIT_SECONDS = Histogram(
+    'proxy_admission_wait_seconds', 'Time queued requests waited for admission')
+ADMISSION_REJECTED = Counter(
+    'proxy_admission_rejected_total', 'Requests shed with 429 by admission control', ('reason',))
+COALESCED_REQUESTS = Counter(
+    'proxy_coalesced_requests_total', 'Requests served by joining an identical in-flight upstream call',
+    ('model', 'stream'))
+IMAGE_BYTES_SAVED = Counter(
+    'proxy_image_bytes_saved_total', 'Upstream request bytes saved by downsizing oversized images')
+STREAMS_CANCELLED = Counter(
+    'proxy_streams_cancelled_total', 'Streams whose upstream request was cancelled because the client disconnected',
+    ('route',))
+CANCELLED_TOKENS_SAVED = Counter(
+    'proxy_cancelled_tokens_saved_total',
+    'Unused max_tokens of cancelled streams (upper bound on output tokens saved)', ('route',))
+COMPACTION_TOKENS_REMOVED = Histogram(
+    'proxy_compaction_tokens_removed',
+    'Estimated input tokens removed per request by tool_result deduplication and context compaction',
+    ('model', 'stage'), COMPACTION_TOKENS_BUCKETS)
+
+# Anthropic usage 字段 → tokens_total 的 type 标签
+_USAGE_FIELDS = (
+    ('input_tokens', 'input'),
+    ('output_tokens', 'output'),
+    ('cache_read_input_tokens', 'cache_read'),
+    ('cache_creation_input_tokens', 'cache_creation'),
+)
+
+
+_TPM_FIELDS = ('input_tokens', 'cache_creation_input_tokens', 'output_tokens')
+
+
+class RequestMetrics:
+    """单个 /v1/chat/completions 请求的计时与计数
+
+    每个请求创建一次；流式循环里只在每批网络读取后调用 frames_sent，逐 delta 不做任何记录。
+    """
+
+    __slots__ = ('model', 'labels', 'started', 'first_token_at', 'tokens', '_frames', '_streaming')
+
+    def __init__(self, model, stream):
+        self.model = model
+        self.labels = (model, 'true' if stream else 'false')
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.tokens = 0
+        self._frames = 0
+        self._streaming = False
+
+    def conversion(self, seconds):
+        CONVERSION_SECONDS.observe(self.labels, seconds)
+
+    def upstream_response(self, status_code, ttfb):
+        UPSTREAM_TTFB_SECONDS.observe(self.labels, ttfb)
+        UPSTREAM_RESPONSES.inc(self.labels + (str(status_code),))
+
+    def error(self, error_type):
+        ERRORS.inc(self.labels + (error_type,))
+
+    def coalesced(self):
+        """请求加入了相同的进行中上游调用，节省一次上游请求"""
+        COALESCED_REQUESTS.inc(self.labels)
+
+    def stream_started(self):
+        self._streaming = True
+        ACTIVE_STREAMS.inc((self.model,))
+
+    def frames_sent(self, count):
+        """记录写给客户端的帧数；第一帧是 role 帧，之后的第一帧即首个 token"""
+        if self.first_token_at is None:
+            self._frames += count
+            if self._frames > 1:
+                self.first_token_at = time.perf_counter()
+                TIME_TO_FIRST_TOKEN_SECONDS.observe(self.labels, self.first_token_at - self.started)
+
+    def finish(self, usage):
+        """请求结束：记录 token 用量、流时长与输出速率"""
+        now = time.perf_counter()
+        usage = usage or {}
+        # 计入准入控制 TPM 的 token 数（缓存读取不计）
+        self.tokens = sum(usage.get(field) or 0 for field in _TPM_FIELDS)
+        for field, token_type in _USAGE_FIELDS:
+            value = usage.get(field)
+            if value:
+                TOKENS.inc(self.labels + (token_type,), value)
+
+        if self._streaming:
+            self._streaming = False
+            ACTIVE_STREAMS.dec((self.model,))
+            STREAM_DURATION_SECONDS.observe(self.labels, now - self.started)
+
+        output_tokens = usage.get('output_tokens') or 0
+        generating = now - (self.first_token_at or self.started)
+        if output_tokens and generating > 0:
+            TOKENS_PER_SECOND.observe(self.labels, output_tokens / generating)
@@ -1,6 +1,13 @@
 import json
 import uuid
 
+import context_compaction
+import conversion_cache
+import image_cache
+import json_codec
+import tool_cache
+from config import Config
+from prompt_cache import apply_cache_breakpoints, record_cache_usage
 from tool_use_fixer import (
     normalize_tool_arguments,
     repair_exact_match_tool_arguments,
@@ -14,9 +21,6 @@ STOP_REASON_MAP = {
     'stop_sequence': 'stop',
 }
 
-# 流式 tool_use 状态管理，key 为 request_id
-_STREAM_TOOL_STATE = {}
-
 
 def _gen_id():
     return f'chatcmpl-{uuid.uuid4().hex[:29]}'
@@ -26,81 +30,7 @@ def _gen_id():
 
 def openai_to_anthropic_request(payload):
     """将 OpenAI 格式请求转换为 Anthropic 格式"""
-    messages = payload.get('messages', [])
-    anthropic_messages = []
-    system_parts = []
-
-    for msg in messages:
-        role = msg.get('role', '')
-        content = msg.get('content', '')
-
-        # system 消息提取到顶层
-        if role == 'system':
-            if isinstance(content, list):
-                for part in content:
-                    if isinstance(part, dict) and part.get('type') == 'text':
-                        system_parts.append(part['text'])
-                    elif isinstance(part, str):
-                        system_parts.append(part)
-            else:
-                system_parts.append(str(content))
-            continue
-
-        # 角色映射
-        anthropic_role = 'assistant' if role == 'assistant' else 'user'
-
-        # content 处理
-        anthropic_content = _convert_content(msg)
-
-        # assistant 消息中的 tool_calls → tool_use content blocks
-        if role == 'assistant' and 'tool_calls' in msg:
-            if isinstance(anthropic_content, str):
-                blocks = []
-                if anthropic_content:
-                    blocks.append({'type': 'text', 'text': anthropic_content})
-            elif isinstance(anthropic_content, list):
-                blocks = list(anthropic_content)
-            else:
-                blocks = []
-
-            for tc in msg['tool_calls']:
-                func = tc.get('function', {})
-                arguments = func.get('arguments', '{}')
-                if isinstance(arguments, str):
-                    try:
-                        arguments = json.loads(arguments)
-                    except json.JSONDecodeError:
-                        arguments = {}
-                blocks.append({
-                    'type': 'tool_use',
-                    'id': tc.get('id', f'toolu_{uuid.uuid4().hex[:24]}'),
-                    'name': func.get('name', ''),
-                    'input': arguments,
-                })
-            anthropic_content = blocks
-
-        # tool 角色 → tool_result
-        if role == 'tool':
-            tool_call_id = msg.get('tool_call_id', '')
-            text_content = content if isinstance(content, str) else json.dumps(content)
-            anthropic_content = [{
-                'type': 'tool_result',
-                'tool_use_id': tool_call_id,
-                'content': text_content,
-            }]
-            anthropic_role = 'user'
-
-        # 跳过空 content 的消息
-        if not anthropic_content or anthropic_content == [] or anthropic_content == '':
-            continue
-
-        anthropic_messages.append({
-            'role': anthropic_role,
-            'content': anthropic_content,
-        })
-
-    # 合并相邻同角色消息
-    anthropic_messages = _merge_consecutive_roles(anthropic_messages)
+    system_parts, anthropic_messages = _convert_messages(payload.get('messages', []))
 
     result = {
         'model': payload.get('model', 'claude-sonnet-4-20250514'),
@@ -113,14 +43,121 @@ def openai_to_anthropic_request(payload):
 
     # tools 转换
     if 'tools' in payload:
-        result['tools'] = _convert_tools(payload['tools'])
+        result['tools'] = tool_cache.convert_tools(payload['tools'], _convert_tools)
 
     # 透传参数
     for key in ('temperature', 'top_p', 'stream'):
         if key in payload:
             result[key] = payload[key]
 
-    return result
+    # 重复的 tool_result 只保留最后一份；仍超出 token 预算时截断较早的 tool_result，之后再放置断点
+    result = context_compaction.dedup_tool_results(result)
+    result = context_compaction.compact(result)
+
+    # prompt caching 断点
+    return apply_cache_breakpoints(result)
+
+
+def encode_anthropic_request(anthropic_payload):
+    """序列化上游请求体（bytes）；预序列化的 tools 片段直接拼接"""
+    tools = anthropic_payload.get('tools')
+    if not isinstance(tools, tool_cache.SerializedTools):
+        return json_codec.dumpb(anthropic_payload)
+    rest = {key: value for key, value in anthropic_payload.items() if key != 'tools'}
+    body = json_codec.dumpb(rest)
+    separator = b', ' if rest else b''
+    return body[:-1] + separator + b'"tools": ' + tools.json + b'}'
+
+
+def _convert_messages(messages):
+    """转换消息列表，返回 (system_parts, 合并后的 Anthropic 消息)
+
+    命中前缀缓存时只转换新增的尾部消息，再与缓存的结果合并。
+    """
+    prefix = conversion_cache.lookup(messages)
+    system_parts = list(prefix.system_parts)
+    anthropic_messages = list(prefix.messages)
+
+    for msg in messages[prefix.length:]:
+        anthropic_msg = _convert_message(msg, system_parts)
+        if anthropic_msg is not None:
+            anthropic_messages.append(anthropic_msg)
+
+    # 合并相邻同角色消息
+    anthropic_messages = _merge_consecutive_roles(anthropic_messages)
+    conversion_cache.store(prefix, messages, system_parts, anthropic_messages)
+    return system_parts, list(anthropic_messages)
+
+
+def _convert_message(msg, system_parts):
+    """转换单条消息；system 消息提取到 system_parts 并返回 None"""
+    role = msg.get('role', '')
+    content = msg.get('content', '')
+
+    # system 消息提取到顶层
+    if role == 'system':
+        if isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and part.get('type') == 'text':
+                    system_parts.append(part['text'])
+                elif isinstance(part, str):
+                    system_parts.append(part)
+        else:
+            system_parts.append(str(content))
+        return None
+
+    # 角色映射
+    anthropic_role = 'assistant' if role == 'assistant' else 'user'
+
+    # content 处理
+    anthropic_content = _convert_content(msg)
+
+    # assistant 消息中的 tool_calls → tool_use content blocks
+    if role == 'assistant' and 'tool_calls' in msg:
+        if isinstance(anthropic_content, str):
+            blocks = []
+            if anthropic_content:
+                blocks.append({'type': 'text', 'text': anthropic_content})
+        elif isinstance(anthropic_content, list):
+            blocks = list(anthropic_content)
+        else:
+            blocks = []
+
+        for tc in msg['tool_calls']:
+            func = tc.get('function', {})
+            arguments = func.get('arguments', '{}')
+            if isinstance(arguments, str):
+                try:
+                    arguments = json_codec.loads(arguments)
+                except json.JSONDecodeError:
+                    arguments = {}
+            blocks.append({
+                'type': 'tool_use',
+                'id': tc.get('id', f'toolu_{uuid.uuid4().hex[:24]}'),
+                'name': func.get('name', ''),
+                'input': arguments,
+            })
+        anthropic_content = blocks
+
+    # tool 角色 → tool_result
+    if role == 'tool':
+        tool_call_id = msg.get('tool_call_id', '')
+        text_content = content if isinstance(content, str) else json.dumps(content)
+        anthropic_content = [{
+            'type': 'tool_result',
+            'tool_use_id': tool_call_id,
+            'content': text_content,
+        }]
+        anthropic_role = 'user'
+
+    # 跳过空 content 的消息
+    if not anthropic_content or anthropic_content == [] or anthropic_content == '':
+        return None
+
+    return {
+        'role': anthropic_role,
+        'content': anthropic_content,
+    }
 
 
 def _convert_content(msg):
@@ -143,16 +180,10 @@ def _convert_content(msg):
                     url_data = part.get('image_url', {})
                     url = url_data.get('url', '') if isinstance(url_data, dict) else str(url_data)
                     if url.startswith('data:'):
-                        # base64 图片
-                        media_type, _, b64 = url.partition(';base64,')
-                        media_type = media_type.replace('data:', '')
+                        # base64 图片，按内容缓存切分与缩放结果
                         blocks.append({
                             'type': 'image',
-                            'source': {
-                                'type': 'base64',
-                                'media_type': media_type or 'image/png',
-                                'data': b64,
-                            }
+                            'source': image_cache.image_source(url),
                         })
                     else:
                         blocks.append({
@@ -200,7 +231,8 @@ def _merge_consecutive_roles(messages):
             # 统一为 list 格式合并
             prev_blocks = _to_blocks(prev_content)
             curr_blocks = _to_blocks(curr_content)
-            merged[-1]['content'] = prev_blocks + curr_blocks
+            # 生成新 dict，不修改可能被转换缓存共享的消息
+            merged[-1] = {**merged[-1], 'content': prev_blocks + curr_blocks}
         else:
             merged.append(msg)
     return merged
@@ -269,41 +301,212 @@ def anthropic_to_openai_response(response_data, request_id=None):
         message['tool_calls'] = tool_calls
 
     usage = response_data.get('usage', {})
+    model = response_data.get('model', 'claude')
+    record_cache_usage(model, usage)
 
     return {
         'id': request_id,
         'object': 'chat.completion',
-        'model': response_data.get('model', 'claude'),
+        'model': model,
         'choices': [{
             'index': 0,
             'message': message,
             'finish_reason': finish_reason,
         }],
-        'usage': {
-            'prompt_tokens': usage.get('input_tokens', 0),
-            'completion_tokens': usage.get('output_tokens', 0),
-            'total_tokens': usage.get('input_tokens', 0) + usage.get('output_tokens', 0),
-        },
+        'usage': _openai_usage(usage),
     }
 
 
+def _openai_usage(usage):
+    """Anthropic usage → OpenAI usage
+
+    Anthropic 的 input_tokens 不含缓存部分，OpenAI 的 prompt_tokens 含，
+    缓存读取量放在 prompt_tokens_details.cached_tokens。
+    """
+    cache_read = usage.get('cache_read_input_tokens') or 0
+    cache_creation = usage.get('cache_creation_input_tokens') or 0
+    prompt_tokens = (usage.get('input_tokens') or 0) + cache_read + cache_creation
+    completion_tokens = usage.get('output_tokens') or 0
+    result = {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+    }
+    if 'cache_read_input_tokens' in usage or 'cache_creation_input_tokens' in usage:
+        result['prompt_tokens_details'] = {'cached_tokens': cache_read}
+    return result
+
+
 # ─── 流式响应转换 ────────────────────────────────────────────
 
+def gen_stream_id():
+    """流式响应的 chunk id；每个流唯一，不依赖 id(request) 这类可能被复用的值"""
+    return f'chatcmpl-stream-{uuid.uuid4().hex[:24]}'
+
+
+class StreamTranslator:
+    """单个流的 Anthropic SSE 事件 → OpenAI chunk 转换状态
+
+    由流自己持有，不经过全局字典，也无需加锁；不带 finish_reason 的 chunk 复用预先
+    序列化的 id/model 外壳，只序列化 delta。开启 STREAM_TOOL_REPAIR 时工具参数
+    只累积不输出，由 content_block_stop 修复后统一发送。
+    """
+
+    __slots__ = (
+        'request_id', 'model', 'usage', 'stop_reason', 'repair_tools',
+        'tool_index', 'tool_parts', 'tool_open', 'current_tool_id', 'current_tool_name',
+        '_head', '_tail',
+    )
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or _gen_id()
+        self.model = 'claude'
+        self.usage = {}
+        self.stop_reason = None
+        # 缓冲工具参数，在 content_block_stop 时修复后整体发送
+        self.repair_tools = Config.STREAM_TOOL_REPAIR
+        self.tool_index = -1
+        self.tool_parts = []
+        self.tool_open = False
+        self.current_tool_id = None
+        self.current_tool_name = None
+        envelope = json_codec.dumps(_make_stream_chunk(self.request_id, delta=None))
+        self._head, _, self._tail = envelope.rpartition('null')
+
+    def chunk(self, delta):
+        """序列化一个不带 finish_reason 的 chunk，与 json_codec.dumps(_make_stream_chunk(...)) 一致"""
+        return self._head + json_codec.dumps(delta) + self._tail
+
+    def translate(self, event_type, event_data):
+        """将一个 Anthropic SSE 事件转换为 OpenAI chunk JSON 字符串列表"""
+        chunks = []
+
+        if event_type == 'message_start':
+            message = event_data.get('message', {})
+            self.usage = dict(message.get('usage', {}))
+            delta = {'role': 'assistant', 'content': ''}
+            model = message.get('model')
+            if model:
+                self.model = model
+                chunk = _make_stream_chunk(self.request_id, delta=delta)
+                chunk['model'] = model
+                chunks.append(json_codec.dumps(chunk))
+            else:
+                chunks.append(self.chunk(delta))
+
+        elif event_type == 'content_block_start':
+            block = event_data.get('content_block', {})
+            if block.get('type') == 'tool_use':
+                self.tool_index += 1
+                self.tool_parts = []
+                self.current_tool_id = block.get('id', f'toolu_{uuid.uuid4().hex[:24]}')
+                self.current_tool_name = block.get('name', '')
+                self.tool_open = True
+                # 发送 tool_call 的 id 和 name
+                chunks.append(self.chunk({
+                    'tool_calls': [{
+                        'index': self.tool_index,
+                        'id': self.current_tool_id,
+                        'type': 'function',
+                        'function': {
+                            'name': self.current_tool_name,
+                            'arguments': '',
+                        },
+                    }]
+                }))
+
+        elif event_type == 'content_block_delta':
+            delta = event_data.get('delta', {})
+            delta_type = delta.get('type', '')
+
+            if delta_type == 'text_delta':
+                text = delta.get('text', '')
+                if text:
+                    chunks.append(self.chunk({'content': text}))
+
+            elif delta_type == 'thinking_delta':
+                thinking = delta.get('thinking', '')
+                if thinking:
+                    chunks.append(self.chunk({'reasoning_content': thinking}))
+
+            elif delta_type == 'input_json_delta':
+                partial = delta.get('partial_json', '')
+                # 修复模式下累积 JSON 等 content_block_stop 统一发送，否则逐块发送 arguments 片段
+                if self.repair_tools:
+                    self.tool_parts.append(partial)
+                elif partial:
+                    chunks.append(self.chunk({
+                        'tool_calls': [{
+                            'index': self.tool_index,
+                            'function': {'arguments': partial},
+                        }]
+                    }))
+
+        elif event_type == 'content_block_stop':
+            chunks.extend(self.flush_tool_arguments())
+
+        elif event_type == 'message_delta':
+            # 流被截断、没有收到 content_block_stop 时，也要把缓冲的参数发出去
+            chunks.extend(self.flush_tool_arguments())
+            delta = event_data.get('delta', {})
+            stop_reason = delta.get('stop_reason', '')
+            self.stop_reason = stop_reason
+            finish_reason = STOP_REASON_MAP.get(stop_reason, 'stop')
+            # message_delta 的 usage 是累计值，覆盖 message_start 中的同名字段
+            self.usage.update(event_data.get('usage', {}))
+            record_cache_usage(self.model, self.usage)
+            chunk = _make_stream_chunk(self.request_id, delta={}, finish_reason=finish_reason)
+            chunk['usage'] = _openai_usage(self.usage)
+            chunks.append(json_codec.dumps(chunk))
+
+        return chunks
+
+    def flush_tool_arguments(self):
+        """修复模式下，把缓冲的工具参数按非流式路径的规则修复后作为一个 delta 发送"""
+        if not self.tool_open:
+            return []
+        self.tool_open = False
+        if not self.repair_tools:
+            return []
+
+        args_str = ''.join(self.tool_parts)
+        self.tool_parts = []
+        try:
+            args = json_codec.loads(args_str) if args_str.strip() else {}
+        except json.JSONDecodeError:
+            args = None
+        if isinstance(args, dict):
+            args = normalize_tool_arguments(args)
+            args = repair_exact_match_tool_arguments(self.current_tool_name or '', args)
+            args_str = json.dumps(args)
+
+        return [self.chunk({
+            'tool_calls': [{
+                'index': self.tool_index,
+                'function': {'arguments': args_str},
+            }]
+        })]
+
+
+# 兼容按 request_id 调用的函数接口；新代码应直接持有 StreamTranslator
+_STREAM_TRANSLATORS = {}
+
+
 def init_stream_state(request_id):
     """初始化流式状态"""
-    _STREAM_TOOL_STATE[request_id] = {
-        'tool_index': -1,
-        'tool_buf': '',
-        'current_tool_id': None,
-        'current_tool_name': None,
-        'input_tokens': 0,
-        'output_tokens': 0,
-    }
+    translator = StreamTranslator(request_id)
+    _STREAM_TRANSLATORS[request_id] = translator
+    return translator
+
+
+def get_stream_state(request_id):
+    """获取流式状态，未初始化时返回 None"""
+    return _STREAM_TRANSLATORS.get(request_id)
 
 
 def cleanup_stream_state(request_id):
     """清理流式状态"""
-    _STREAM_TOOL_STATE.pop(request_id, None)
+    _STREAM_TRANSLATORS.pop(request_id, None)
 
 
 def anthropic_to_openai_stream_chunk(event_type, event_data, request_id):
@@ -311,89 +514,13 @@ def anthropic_to_openai_stream_chunk(event_type, event_data, request_id):
 
     返回值: list of (chunk_json_str) 或空列表
     """
-    if not request_id:
-        request_id = _gen_id()
-
-    state = _STREAM_TOOL_STATE.get(request_id, {})
-    chunks = []
-
-    if event_type == 'message_start':
-        message = event_data.get('message', {})
-        usage = message.get('usage', {})
-        state['input_tokens'] = usage.get('input_tokens', 0)
-        chunk = _make_stream_chunk(request_id, delta={'role': 'assistant', 'content': ''})
-        model = message.get('model')
-        if model:
-            chunk['model'] = model
-        chunks.append(json.dumps(chunk))
-
-    elif event_type == 'content_block_start':
-        block = event_data.get('content_block', {})
-        if block.get('type') == 'tool_use':
-            state['tool_index'] += 1
-            state['tool_buf'] = ''
-            state['current_tool_id'] = block.get('id', f'toolu_{uuid.uuid4().hex[:24]}')
-            state['current_tool_name'] = block.get('name', '')
-            # 发送 tool_call 的 id 和 name
-            chunk = _make_stream_chunk(request_id, delta={
-                'tool_calls': [{
-                    'index': state['tool_index'],
-                    'id': state['current_tool_id'],
-                    'type': 'function',
-                    'function': {
-                        'name': state['current_tool_name'],
-                        'arguments': '',
-                    },
-                }]
-            })
-            chunks.append(json.dumps(chunk))
-
-    elif event_type == 'content_block_delta':
-        delta = event_data.get('delta', {})
-        delta_type = delta.get('type', '')
-
-        if delta_type == 'text_delta':
-            text = delta.get('text', '')
-            if text:
-                chunk = _make_stream_chunk(request_id, delta={'content': text})
-                chunks.append(json.dumps(chunk))
-
-        elif delta_type == 'thinking_delta':
-            thinking = delta.get('thinking', '')
-            if thinking:
-                chunk = _make_stream_chunk(request_id, delta={'reasoning_content': thinking})
-                chunks.append(json.dumps(chunk))
-
-        elif delta_type == 'input_json_delta':
-            partial = delta.get('partial_json', '')
-            state['tool_buf'] += partial
-            # 累积 JSON，逐块发送 arguments 片段
-            if partial:
-                chunk = _make_stream_chunk(request_id, delta={
-                    'tool_calls': [{
-                        'index': state['tool_index'],
-                        'function': {'arguments': partial},
-                    }]
-                })
-                chunks.append(json.dumps(chunk))
-
-    elif event_type == 'message_delta':
-        delta = event_data.get('delta', {})
-        stop_reason = delta.get('stop_reason', '')
-        finish_reason = STOP_REASON_MAP.get(stop_reason, 'stop')
-        usage = event_data.get('usage', {})
-        state['output_tokens'] = usage.get('output_tokens', 0)
-        chunk = _make_stream_chunk(request_id, delta={}, finish_reason=finish_reason)
-        chunk['usage'] = {
-            'prompt_tokens': state.get('input_tokens', 0),
-            'completion_tokens': state['output_tokens'],
-            'total_tokens': state.get('input_tokens', 0) + state['output_tokens'],
-        }
-        chunks.append(json.dumps(chunk))
-
-    elif event_type == 'message_stop':
+    # 未初始化的 request_id 按一次性状态处理，不登记到全局
+    translator = _STREAM_TRANSLATORS.get(request_id) if request_id else None
+    if translator is None:
+        translator = StreamTranslator(request_id)
+    chunks = translator.translate(event_type, event_data)
+    if event_type == 'message_stop':
         cleanup_stream_state(request_id)
-
     return chunks
 
 
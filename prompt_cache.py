@@ -0,0 +1,152 @@
+import threading
+
+from config import Config
+from tool_cache import SerializedTools
+
+# Anthropic 单个请求最多允许 4 个 cache_control 断点
+MAX_BREAKPOINTS = 4
+
+# 可以携带 cache_control 的 content block 类型（thinking 块不行）
+_CACHEABLE_BLOCK_TYPES = ('text', 'image', 'tool_use', 'tool_result', 'document')
+
+# 按模型统计缓存命中情况
+_CACHE_STATS = {}
+_CACHE_STATS_LOCK = threading.Lock()
+
+
+def _cache_control():
+    cache_control = {'type': 'ephemeral'}
+    if Config.PROMPT_CACHE_TTL:
+        cache_control['ttl'] = Config.PROMPT_CACHE_TTL
+    return cache_control
+
+
+def apply_cache_breakpoints(anthropic_request):
+    """按配置在 tools / system / 对话滚动边界上放置 cache_control 断点
+
+    Cursor 每轮都会重发几乎相同的前缀（system、工具定义、历史对话），断点让中转站
+    直接复用已缓存的前缀。只在副本上修改，不影响调用方持有的 block。
+    """
+    if not Config.PROMPT_CACHE:
+        return anthropic_request
+
+    messages = anthropic_request.get('messages', [])
+    budget = MAX_BREAKPOINTS - _count_existing_breakpoints(messages)
+
+    for target in Config.PROMPT_CACHE_BREAKPOINTS:
+        if budget <= 0:
+            break
+        if target == 'tools':
+            tools = anthropic_request.get('tools')
+            if tools and 'cache_control' not in tools[-1]:
+                if isinstance(tools, SerializedTools):
+                    anthropic_request['tools'] = tools.with_cache_control(_cache_control())
+                else:
+                    anthropic_request['tools'] = tools[:-1] + [{**tools[-1], 'cache_control': _cache_control()}]
+                budget -= 1
+        elif target == 'system':
+            system = anthropic_request.get('system')
+            if isinstance(system, str) and system:
+                anthropic_request['system'] = [{
+                    'type': 'text',
+                    'text': system,
+                    'cache_control': _cache_control(),
+                }]
+                budget -= 1
+        elif target == 'messages':
+            for index in _rolling_boundaries(messages)[:budget]:
+                if _mark_message(messages, index):
+                    budget -= 1
+
+    return anthropic_request
+
+
+def _count_existing_breakpoints(messages):
+    """统计客户端自带的断点（直接透传的 Anthropic 原生 block 可能已带 cache_control）"""
+    count = 0
+    for msg in messages:
+        content = msg.get('content')
+        if isinstance(content, list):
+            for block in content:
+                if isinstance(block, dict) and 'cache_control' in block:
+                    count += 1
+    return count
+
+
+def _rolling_boundaries(messages):
+    """对话滚动边界：最后一条消息 + 上一轮的最后一条 user 消息
+
+    最后一条消息的断点写入本轮缓存；上一轮的边界用于命中上一次请求写入的缓存，
+    避免单轮工具调用过多时超出 Anthropic 向前查找 20 个 block 的范围。
+    """
+    if not messages:
+        return []
+    boundaries = [len(messages) - 1]
+    for index in range(len(messages) - 3, -1, -1):
+        if messages[index].get('role') == 'user':
+            boundaries.append(index)
+            break
+    return boundaries
+
+
+def _mark_message(messages, index):
+    msg = messages[index]
+    content = msg.get('content')
+    if isinstance(content, str):
+        if not content:
+            return False
+        new_content = [{'type': 'text', 'text': content, 'cache_control': _cache_control()}]
+    elif isinstance(content, list):
+        for pos in range(len(content) - 1, -1, -1):
+            block = content[pos]
+            if isinstance(block, dict) and block.get('type') in _CACHEABLE_BLOCK_TYPES:
+                if 'cache_control' in block:
+                    return False
+                new_content = list(content)
+                new_content[pos] = {**block, 'cache_control': _cache_control()}
+                break
+        else:
+            return False
+    else:
+        return False
+    messages[index] = {**msg, 'content': new_content}
+    return True
+
+
+# ─── 命中率统计 ─────────────────────────────────────────────
+
+def record_cache_usage(model, usage):
+    """记录一次请求的缓存用量（Anthropic usage 字段）"""
+    cache_read = usage.get('cache_read_input_tokens') or 0
+    cache_creation = usage.get('cache_creation_input_tokens') or 0
+    input_tokens = usage.get('input_tokens') or 0
+    with _CACHE_STATS_LOCK:
+        stats = _CACHE_STATS.get(model)
+        if stats is None:
+            stats = _CACHE_STATS[model] = {
+                'requests': 0,
+                'hits': 0,
+                'input_tokens': 0,
+                'cache_read_input_tokens': 0,
+                'cache_creation_input_tokens': 0,
+            }
+        stats['requests'] += 1
+        stats['hits'] += 1 if cache_read else 0
+        stats['input_tokens'] += input_tokens
+        stats['cache_read_input_tokens'] += cache_read
+        stats['cache_creation_input_tokens'] += cache_creation
+
+
+def cache_stats():
+    """各模型的缓存命中率快照，供 /health 输出"""
+    result = {}
+    with _CACHE_STATS_LOCK:
+        for model, stats in _CACHE_STATS.items():
+            prompt_total = (stats['input_tokens'] + stats['cache_read_input_tokens']
+                            + stats['cache_creation_input_tokens'])
+            result[model] = {
+                **stats,
+                'hit_rate': round(stats['hits'] / stats['requests'], 4) if stats['requests'] else 0.0,
+                'token_hit_rate': round(stats['cache_read_input_tokens'] / prompt_total, 4) if prompt_total else 0.0,
+            }
+    return result
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+from config import Config
+from lru import ByteLRU
+from sse_transcoder import SSETranscoder
+
+logger = logging.getLogger(__name__)
+
+# 完整结束、可以缓存的 stop_reason；tool_use 由 RESPONSE_CACHE_TOOL_USE 决定
+_CACHEABLE_STOP_REASONS = ('end_turn', 'stop_sequence', 'max_tokens')
+
+# 每写入多少条磁盘缓存清理一次过期文件
+_DISK_SWEEP_INTERVAL = 100
+
+# key: 请求体哈希；value: (过期时间, 上游原始响应字节)
+_memory = ByteLRU(Config.RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+
+_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'disk_hits': 0,
+}
+_STATS_LOCK = threading.Lock()
+_disk_writes = 0
+
+
+def _count(name):
+    with _STATS_LOCK:
+        _STATS[name] += 1
+
+
+def cache_key(anthropic_payload, body):
+    """返回请求的缓存 key；未开启缓存或请求不确定（temperature 非 0）时返回 None
+
+    key 是编码后上游请求体的哈希，请求体已包含 stream 标记，流式与非流式分开缓存。
+    """
+    if not Config.RESPONSE_CACHE:
+        return None
+    if Config.RESPONSE_CACHE_DETERMINISTIC_ONLY and anthropic_payload.get('temperature') != 0:
+        return None
+    return hashlib.sha256(body).hexdigest()
+
+
+def should_store(stop_reason):
+    """只缓存正常结束的回复；工具调用轮次默认不缓存（依赖的文件内容可能已变化）"""
+    if stop_reason in _CACHEABLE_STOP_REASONS:
+        return True
+    return stop_reason == 'tool_use' and Config.RESPONSE_CACHE_TOOL_USE
+
+
+def _disk_path(key):
+    return os.path.join(Config.RESPONSE_CACHE_DIR, key[:2], key)
+
+
+def get_memory(key):
+    """只查询内存缓存，不访问磁盘；未命中时返回 None 且不计入 misses，调用方随后再调用 get"""
+    item = _memory.get(key)
+    if item is not None:
+        expires_at, data = item
+        if expires_at > time.time():
+            _count('hits')
+            return data
+        _memory.pop(key)
+    return None
+
+
+def get(key):
+    """查询缓存，返回上游原始响应（非流式为 JSON，流式为 SSE 字节）或 None"""
+    data = get_memory(key)
+    if data is not None:
+        return data
+
+    if Config.RESPONSE_CACHE_DIR:
+        now = time.time()
+        path = _disk_path(key)
+        try:
+            expires_at = os.stat(path).st_mtime + Config.RESPONSE_CACHE_TTL
+            if expires_at > now:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                _memory.put(key, (expires_at, data), len(data))
+                _count('hits')
+                _count('disk_hits')
+                return data
+            os.unlink(path)
+        except OSError:
+            pass
+
+    _count('misses')
+    return None
+
+
+def put(key, data):
+    global _disk_writes
+    _memory.put(key, (time.time() + Config.RESPONSE_CACHE_TTL, data), len(data))
+    _count('stores')
+    if not Config.RESPONSE_CACHE_DIR:
+        return
+
+    path = _disk_path(key)
+    tmp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning('[response_cache] failed to write %s: %s', path, e)
+        return
+
+    with _STATS_LOCK:
+        _disk_writes += 1
+        sweep = _disk_writes % _DISK_SWEEP_INTERVAL == 0
+    if sweep:
+        _sweep_disk()
+
+
+def _sweep_disk():
+    """删除磁盘上已过期的缓存文件"""
+    deadline = time.time() - Config.RESPONSE_CACHE_TTL
+    for root, _, files in os.walk(Config.RESPONSE_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.stat(path).st_mtime < deadline:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+def replay_stream(data):
+    """把缓存的上游 SSE 重新送入转换器，一次性生成完整的 OpenAI SSE 响应"""
+    request_id = f'chatcmpl-cache-{uuid.uuid4().hex[:24]}'
+    transcoder = SSETranscoder(request_id)
+    frames = transcoder.feed(data)
+    frames.extend(transcoder.finish())
+    return b''.join(frames) + b'data: [DONE]\n\n'
+
+
+def stats():
+    """响应缓存统计，供 /health 输出"""
+    with _STATS_LOCK:
+        result = dict(_STATS)
+    lru_stats = _memory.stats()
+    result.update(
+        enabled=Config.RESPONSE_CACHE,
+        entries=lru_stats['entries'],
+        bytes=lru_stats['bytes'],
+        max_bytes=lru_stats['max_bytes'],
+        evictions=lru_stats['evictions'],
+    )
+    return result
@@ -0,0 +1,368 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+from config import Config
+from upstream import get_session, prepare_headers
+
+logger = logging.getLogger(__name__)
+
+# 计为上游故障、且可以在首字节前换上游重试的状态码（529 为 Anthropic 的 overloaded）
+RETRYABLE_STATUS = frozenset((429, 500, 502, 503, 504, 529))
+
+# TTFB 的指数加权平均系数
+_EWMA_ALPHA = 0.3
+
+_CLOSED = 'closed'
+_OPEN = 'open'
+_HALF_OPEN = 'half_open'
+
+# 对冲延迟取最近多少个流式首字节耗时的 p95，样本不足时不对冲
+_FIRST_BYTE_SAMPLES = 256
+_MIN_HEDGE_SAMPLES = 20
+
+# 额外请求预算的初始值与上限：允许短时突发，长期比例由 UPSTREAM_RETRY_BUDGET 决定
+_BUDGET_RESERVE = 10.0
+
+_lock = threading.Lock()
+_checker = None
+
+_STATS = {
+    'retries': 0,
+    'hedges': 0,
+    'hedge_wins': 0,
+    'budget_denied': 0,
+}
+_first_byte_times = deque(maxlen=_FIRST_BYTE_SAMPLES)
+_budget = _BUDGET_RESERVE
+
+
+class Upstream:
+    """一个上游中转站地址 + Key
+
+    outstanding 为进行中的请求数（流式请求直到流结束才释放）；连续失败达到
+    UPSTREAM_CIRCUIT_FAILURES 后熔断 UPSTREAM_CIRCUIT_COOLDOWN 秒，之后放行一个试探请求，
+    成功则恢复，失败则重新熔断。主动健康检查失败的上游在下次检查成功前不参与选择。
+    """
+
+    def __init__(self, name, url, api_key):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.messages_url = f'{self.url}/v1/messages'
+        self.headers = prepare_headers(api_key)
+        self.headers['Content-Type'] = 'application/json'
+        self.outstanding = 0
+        self.ewma_ttfb = None
+        self.state = _CLOSED
+        self.opened_at = 0.0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self._trial = None  # 半开状态下进行中的试探请求（Lease）
+        self._stats = {
+            'requests': 0,
+            'failures': 0,
+            'failovers': 0,
+            'circuit_opens': 0,
+        }
+
+    def _available(self, now):
+        """能否接收新请求（需持有 _lock）；熔断冷却结束后只放行一个试探请求"""
+        if not self.healthy:
+            return False
+        if self.state == _CLOSED:
+            return True
+        if self.state == _OPEN:
+            return now - self.opened_at >= Config.UPSTREAM_CIRCUIT_COOLDOWN
+        return self._trial is None
+
+    def _cost(self):
+        if Config.UPSTREAM_BALANCE == 'ewma':
+            # 没有样本的上游按 0 计，先让它拿到流量
+            return (self.ewma_ttfb or 0.0) * (self.outstanding + 1)
+        return self.outstanding
+
+    def response(self, status_code, ttfb):
+        """收到上游响应头：更新 TTFB 均值，按状态码记录成功或失败"""
+        with _lock:
+            if self.ewma_ttfb is None:
+                self.ewma_ttfb = ttfb
+            else:
+                self.ewma_ttfb += _EWMA_ALPHA * (ttfb - self.ewma_ttfb)
+        if status_code in RETRYABLE_STATUS:
+            self.failure()
+        else:
+            self._success()
+
+    def failure(self):
+        """连接失败或收到 5xx/429"""
+        with _lock:
+            self._stats['failures'] += 1
+            self.consecutive_failures += 1
+            trial = self.state == _HALF_OPEN
+            self._trial = None
+            if trial or (self.state == _CLOSED
+                         and self.consecutive_failures >= Config.UPSTREAM_CIRCUIT_FAILURES):
+                self.state = _OPEN
+                self.opened_at = time.monotonic()
+                self._stats['circuit_opens'] += 1
+                opened = True
+            else:
+                opened = False
+        if opened:
+            logger.warning('[routing] circuit opened for %s after %d failures',
+                           self.name, self.consecutive_failures)
+
+    def _success(self):
+        with _lock:
+            recovered = self.state != _CLOSED
+            self.state = _CLOSED
+            self.consecutive_failures = 0
+            self._trial = None
+        if recovered:
+            logger.info('[routing] circuit closed for %s', self.name)
+
+    def failover(self):
+        """本次请求放弃该上游，换下一个上游重试"""
+        with _lock:
+            self._stats['failovers'] += 1
+
+    def _release(self, lease):
+        with _lock:
+            self.outstanding -= 1
+            # 试探请求未拿到响应就结束（如客户端断开）时，允许下一个请求继续试探；
+            # 其他请求结束不影响进行中的试探
+            if self._trial is lease:
+                self._trial = None
+
+    def stats(self):
+        with _lock:
+            result = dict(self._stats)
+            result.update(
+                name=self.name,
+                state=self.state,
+                healthy=self.healthy,
+                outstanding=self.outstanding,
+                consecutive_failures=self.consecutive_failures,
+                ewma_ttfb_ms=None if self.ewma_ttfb is None else round(self.ewma_ttfb * 1000, 1),
+            )
+        return result
+
+
+class Lease:
+    """acquire 选中的一次上游请求；请求结束时调用 release，重复调用无副作用
+
+    其余属性与方法（name、messages_url、headers、response、failure、failover 等）转发给 Upstream。
+    """
+
+    __slots__ = ('upstream', '_released')
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self.upstream, name)
+
+    def release(self):
+        """请求结束（非流式读完响应体、流式流结束）时调用"""
+        if not self._released:
+            self._released = True
+            self.upstream._release(self)
+
+
+def _parse_upstreams():
+    """PROXY_UPSTREAMS 为逗号分隔的 url|key 列表；留空时使用 PROXY_TARGET_URL + PROXY_API_KEY"""
+    entries = []
+    for item in Config.PROXY_UPSTREAMS.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        url, _, api_key = item.partition('|')
+        entries.append((url.strip(), api_key.strip() or Config.PROXY_API_KEY))
+    if not entries:
+        entries.append((Config.PROXY_TARGET_URL, Config.PROXY_API_KEY))
+
+    upstreams = []
+    names = set()
+    for url, api_key in entries:
+        # 同一地址配置多个 Key 时加序号区分，统计中不出现 Key
+        name = url.rstrip('/')
+        if name in names:
+            name = f'{name}#{len(upstreams)}'
+        names.add(name)
+        upstreams.append(Upstream(name, url, api_key))
+    return upstreams
+
+
+UPSTREAMS = _parse_upstreams()
+
+
+def acquire(exclude=()):
+    """选择一个上游并计入 outstanding，返回 Lease；exclude 为本次请求已失败的 Lease
+
+    优先在可用（未熔断、健康检查通过）的上游中选择代价最低的；全部不可用时退回到
+    未尝试过的上游中选择，避免所有上游同时熔断时直接拒绝请求。都已尝试过则返回 None。
+    """
+    _ensure_checker()
+    now = time.monotonic()
+    with _lock:
+        excluded = {lease.upstream for lease in exclude}
+        candidates = [u for u in UPSTREAMS if u not in excluded]
+        if not candidates:
+            return None
+        available = [u for u in candidates if u._available(now)]
+        upstream = min(available or candidates, key=Upstream._cost)
+        if upstream.state == _OPEN and upstream._available(now):
+            upstream.state = _HALF_OPEN
+        lease = Lease(upstream)
+        # 全部上游不可用时退回选中的请求不算试探，结束时不清除进行中的试探
+        if upstream.state == _HALF_OPEN and upstream._trial is None:
+            upstream._trial = lease
+        upstream.outstanding += 1
+        upstream._stats['requests'] += 1
+    return lease
+
+
+def can_failover(tried):
+    """首字节前失败时是否还有未尝试的上游"""
+    return len(tried) < len(UPSTREAMS)
+
+
+def request_started():
+    """每个客户端请求存入 UPSTREAM_RETRY_BUDGET 个额外请求额度"""
+    global _budget
+    with _lock:
+        _budget = min(_budget + Config.UPSTREAM_RETRY_BUDGET, _BUDGET_RESERVE)
+
+
+def _spend_budget():
+    """重试与对冲各消耗 1 个额度，额度不足时拒绝，避免上游过载时重试放大流量"""
+    global _budget
+    with _lock:
+        if _budget >= 1:
+            _budget -= 1
+            return True
+        _STATS['budget_denied'] += 1
+        return False
+
+
+def _parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def next_attempt(tried, retries, retry_after=None):
+    """首字节前失败后的下一步：返回 None 表示放弃，否则为再次请求前等待的秒数
+
+    还有未尝试的上游时立即换上游（返回 0）；所有上游都失败过后按指数退避加随机抖动重试，
+    并至少等到上游 retry-after 指定的时间。retry-after 超过 UPSTREAM_RETRY_MAX_DELAY、
+    重试次数用完或额外请求预算不足时放弃。
+    """
+    if can_failover(tried):
+        return 0.0
+    if retries >= Config.UPSTREAM_RETRIES:
+        return None
+    delay = Config.UPSTREAM_RETRY_BACKOFF * 2 ** retries
+    delay = min(random.uniform(delay / 2, delay), Config.UPSTREAM_RETRY_MAX_DELAY)
+    wait = _parse_retry_after(retry_after)
+    if wait is not None:
+        if wait > Config.UPSTREAM_RETRY_MAX_DELAY:
+            return None
+        delay = max(delay, wait)
+    if not _spend_budget():
+        return None
+    with _lock:
+        _STATS['retries'] += 1
+    return delay
+
+
+def record_first_byte(seconds):
+    """记录流式请求从发出到收到首字节（message_start）的耗时"""
+    with _lock:
+        _first_byte_times.append(seconds)
+
+
+def hedge_delay():
+    """对冲前等待的秒数：最近首字节耗时的 p95，不低于 UPSTREAM_HEDGE_MIN_DELAY；样本不足时返回 None"""
+    with _lock:
+        if len(_first_byte_times) < _MIN_HEDGE_SAMPLES:
+            return None
+        samples = sorted(_first_byte_times)
+    p95 = samples[min(int(len(samples) * 0.95), len(samples) - 1)]
+    return max(p95, Config.UPSTREAM_HEDGE_MIN_DELAY)
+
+
+def start_hedge():
+    """是否发出对冲请求（消耗额外请求预算）"""
+    if not _spend_budget():
+        return False
+    with _lock:
+        _STATS['hedges'] += 1
+    return True
+
+
+def hedge_won():
+    with _lock:
+        _STATS['hedge_wins'] += 1
+
+
+def stats():
+    """各上游的负载、熔断与健康状态，以及重试与对冲计数，供 /health 输出"""
+    with _lock:
+        result = dict(_STATS)
+        result['budget'] = round(_budget, 2)
+    result.update(
+        balance=Config.UPSTREAM_BALANCE,
+        hedge=Config.UPSTREAM_HEDGE,
+        upstreams=[upstream.stats() for upstream in UPSTREAMS],
+    )
+    return result
+
+
+class _HealthChecker(threading.Thread):
+    """定期 GET 各上游的 UPSTREAM_HEALTH_CHECK_PATH；连接失败或返回 5xx/429 视为不健康"""
+
+    def __init__(self, interval):
+        super().__init__(name='upstream-health', daemon=True)
+        self.interval = interval
+
+    def run(self):
+        session = get_session()
+        while True:
+            time.sleep(self.interval)
+            for upstream in UPSTREAMS:
+                try:
+                    resp = session.get(
+                        f'{upstream.url}{Config.UPSTREAM_HEALTH_CHECK_PATH}',
+                        headers=upstream.headers,
+                        timeout=Config.UPSTREAM_HEALTH_CHECK_TIMEOUT,
+                    )
+                    resp.close()
+                    healthy = resp.status_code not in RETRYABLE_STATUS
+                except Exception as e:
+                    logger.debug('[routing] health check %s failed: %s', upstream.name, e)
+                    healthy = False
+                if healthy != upstream.healthy:
+                    logger.warning('[routing] %s is now %s', upstream.name, 'healthy' if healthy else 'unhealthy')
+                with _lock:
+                    upstream.healthy = healthy
+
+
+def _ensure_checker():
+    global _checker
+    if _checker is None and Config.UPSTREAM_HEALTH_CHECK_INTERVAL > 0:
+        with _lock:
+            if _checker is None:
+                _checker = _HealthChecker(Config.UPSTREAM_HEALTH_CHECK_INTERVAL)
+                _checker.start()
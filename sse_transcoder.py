@@ -0,0 +1,264 @@
+import json
+import logging
+import re
+import time
+from json.decoder import scanstring
+
+import json_codec
+from config import Config
+from openai_adapter import StreamTranslator, _make_stream_chunk
+
+logger = logging.getLogger(__name__)
+
+# content_block_delta 的紧凑 JSON 前缀（Anthropic 事件字段顺序固定），
+# 命中后只需取出字符串载荷，无需完整 json.loads
+_DELTA_PREFIX_RE = re.compile(
+    rb'\{"type":"content_block_delta","index":\d+,"delta":\{"type":"'
+    rb'(text_delta","text|thinking_delta","thinking|input_json_delta","partial_json)":"'
+)
+_DELTA_KIND = {
+    b'text_delta","text': 'content',
+    b'thinking_delta","thinking': 'reasoning_content',
+    b'input_json_delta","partial_json': 'arguments',
+}
+# 序列化结果可能与原始字节不同的字节：非可打印 ASCII 与反斜杠
+_NEEDS_ESCAPE_RE = re.compile(rb'[^ -\[\]-~]')
+# 最常见的情形：完整的一条增量事件（event 行 + data 行），载荷为无需转义的可打印 ASCII
+_FAST_EVENT_RE = re.compile(
+    rb'event: ?content_block_delta\r?\ndata: ?'
+    + _DELTA_PREFIX_RE.pattern
+    + rb'([ !#-\[\]-~]*)"\}\}\r?\n(?:\r?\n)?'
+)
+# 会发送缓冲的工具参数（触发修复）的事件
+_REPAIR_EVENTS = ('content_block_stop', 'message_delta')
+_REPAIR_MARKERS = tuple(event.encode('ascii') for event in _REPAIR_EVENTS)
+
+_SENTINEL = '\x00sse-payload\x00'
+_SENTINEL_JSON = json_codec.dumps(_SENTINEL)
+
+
+def _split_template(request_id, delta):
+    """序列化一个带占位符的 chunk，拆成 (前缀, 后缀) 两段字节"""
+    chunk_json = json_codec.dumps(_make_stream_chunk(request_id, delta=delta))
+    head, _, tail = chunk_json.partition(_SENTINEL_JSON)
+    return b'data: ' + head.encode('ascii'), tail.encode('ascii') + b'\n\n'
+
+
+class SSETranscoder:
+    """Anthropic SSE 字节流 → OpenAI SSE 帧的增量转换器
+
+    text/thinking/input_json 增量走快速路径：只转义载荷字符串并拼进预先序列化的
+    chunk 模板；其余事件回退到 StreamTranslator.translate。两条路径的输出
+    与逐事件 json_codec.loads + json_codec.dumps 逐字节一致。开启 STREAM_TOOL_REPAIR 时工具参数
+    只累积不输出，由 content_block_stop 统一发送。
+
+    开启 STREAM_COALESCE 时，同一块内连续的增量合并为一个 chunk：攒满
+    STREAM_COALESCE_BYTES 或遇到其他事件（块边界、message_delta 等）立即发送。
+    hold 为 False 时每次 feed 结束都会发送暂存的增量；为 True 时最多暂存
+    STREAM_COALESCE_WINDOW_MS，调用方需在 flush_delay 到期后调用 flush。
+    """
+
+    __slots__ = (
+        'request_id', 'translator', 'hold', '_buf', '_event_type', '_templates', '_tool_templates',
+        '_max_bytes', '_window', '_pending', '_pending_template', '_pending_size', '_pending_since',
+    )
+
+    def __init__(self, request_id, hold=False):
+        self.request_id = request_id
+        self.translator = StreamTranslator(request_id)
+        self._buf = b''
+        self._event_type = ''
+        self._templates = {
+            'content': _split_template(request_id, {'content': _SENTINEL}),
+            'reasoning_content': _split_template(request_id, {'reasoning_content': _SENTINEL}),
+        }
+        self._tool_templates = {}
+        # 0 表示不合并增量
+        self._max_bytes = max(Config.STREAM_COALESCE_BYTES, 1) if Config.STREAM_COALESCE else 0
+        self._window = Config.STREAM_COALESCE_WINDOW_MS / 1000
+        self.hold = hold and self._max_bytes > 0 and self._window > 0
+        self._pending = []
+        self._pending_template = None
+        self._pending_size = 0
+        self._pending_since = 0.0
+
+    @property
+    def usage(self):
+        """上游累计的 Anthropic usage"""
+        return self.translator.usage
+
+    @property
+    def stop_reason(self):
+        """上游 message_delta 给出的 stop_reason，流未正常结束时为 None"""
+        return self.translator.stop_reason
+
+    def feed(self, data):
+        """喂入一段上游字节，返回可直接写给客户端的 SSE 帧列表"""
+        buf = self._buf + data if self._buf else data
+        frames = []
+        pos = 0
+        size = len(buf)
+        fast_match = _FAST_EVENT_RE.match
+        while pos < size:
+            match = fast_match(buf, pos)
+            if match is not None:
+                pos = match.end()
+                self._event_type = 'content_block_delta'
+                kind = _DELTA_KIND[match.group(1)]
+                payload = match.group(2)
+                if kind == 'arguments':
+                    translator = self.translator
+                    if translator.repair_tools:
+                        translator.tool_parts.append(payload.decode('ascii'))
+                    elif payload:
+                        self._delta(frames, self._tool_template(translator.tool_index), payload)
+                elif payload:
+                    self._delta(frames, self._templates[kind], payload)
+                continue
+            newline = buf.find(b'\n', pos)
+            if newline < 0:
+                break
+            self._handle_line(buf[pos:newline], frames)
+            pos = newline + 1
+        self._buf = buf[pos:]
+        if self._pending and not (self.hold and time.monotonic() - self._pending_since < self._window):
+            self._flush_pending(frames)
+        return frames
+
+    def finish(self):
+        """处理末尾没有换行的残留数据"""
+        frames = []
+        if self._buf:
+            line, self._buf = self._buf, b''
+            self._handle_line(line, frames)
+        self._flush_pending(frames)
+        return frames
+
+    def may_repair(self, data=b''):
+        """feed(data)（data 为空时指 finish）是否可能修复工具参数
+
+        修复会读取本地文件；为 True 时 async 模式把这次转换放到线程池执行。
+        只做字节查找，可能误报，不会漏报。
+        """
+        translator = self.translator
+        if not translator.repair_tools:
+            return False
+        buf = self._buf + data if self._buf else data
+        if not (translator.tool_open or b'tool_use' in buf):
+            return False
+        return self._event_type in _REPAIR_EVENTS or any(marker in buf for marker in _REPAIR_MARKERS)
+
+    def flush_delay(self):
+        """距离暂存的增量必须发送还有多少秒；没有暂存时返回 None"""
+        if not self._pending:
+            return None
+        return max(self._pending_since + self._window - time.monotonic(), 0.0)
+
+    def flush(self):
+        """立即发送暂存的增量"""
+        frames = []
+        self._flush_pending(frames)
+        return frames
+
+    def _delta(self, frames, template, escaped):
+        """输出一段已转义的增量载荷（不含引号）；开启合并时追加到同类的暂存 chunk"""
+        if not self._max_bytes:
+            frames.append(template[0] + b'"' + escaped + b'"' + template[1])
+            return
+        if template is not self._pending_template:
+            self._flush_pending(frames)
+            self._pending_template = template
+            self._pending_since = time.monotonic()
+        self._pending.append(escaped)
+        self._pending_size += len(escaped)
+        if self._pending_size >= self._max_bytes:
+            self._flush_pending(frames)
+
+    def _flush_pending(self, frames):
+        if self._pending:
+            head, tail = self._pending_template
+            frames.append(head + b'"' + b''.join(self._pending) + b'"' + tail)
+            self._pending = []
+            self._pending_size = 0
+        self._pending_template = None
+
+    def _handle_line(self, line, frames):
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        if not line:
+            return
+        if line.startswith(b'event:'):
+            self._event_type = line[6:].strip().decode('utf-8', errors='replace')
+            return
+        if not line.startswith(b'data:'):
+            return
+        data = line[6:] if line.startswith(b'data: ') else line[5:].lstrip()
+        data = data.rstrip()
+        if not data:
+            return
+        if self._event_type == 'content_block_delta' and self._fast_delta(data, frames):
+            return
+        self._slow_event(data, frames)
+
+    def _fast_delta(self, data, frames):
+        match = _DELTA_PREFIX_RE.match(data)
+        if match is None:
+            return False
+        kind = _DELTA_KIND[match.group(1)]
+        start = match.end()
+        end = data.find(b'"', start)
+        if end < 0:
+            return False
+        payload = data[start:end]
+        if _NEEDS_ESCAPE_RE.search(payload) is None:
+            # 纯可打印 ASCII 且无转义：原始字节即为序列化结果
+            if data[end + 1:] != b'}}':
+                return False
+            escaped = b'"' + payload + b'"'
+            value = payload.decode('ascii') if kind == 'arguments' else None
+        else:
+            text = data.decode('utf-8', errors='replace')
+            try:
+                value, end = scanstring(text, start)
+            except ValueError:
+                return False
+            if text[end:] != '}}':
+                return False
+            escaped = json_codec.dumpb(value)
+
+        if kind == 'arguments':
+            translator = self.translator
+            if translator.repair_tools:
+                translator.tool_parts.append(value)
+                return True
+            template = self._tool_template(translator.tool_index)
+        else:
+            template = self._templates[kind]
+        if escaped[1:-1]:
+            self._delta(frames, template, escaped[1:-1])
+        return True
+
+    def _tool_template(self, tool_index):
+        template = self._tool_templates.get(tool_index)
+        if template is None:
+            template = _split_template(self.request_id, {
+                'tool_calls': [{
+                    'index': tool_index,
+                    'function': {'arguments': _SENTINEL},
+                }]
+            })
+            self._tool_templates[tool_index] = template
+        return template
+
+    def _slow_event(self, data, frames):
+        try:
+            event_data = json_codec.loads(data.decode('utf-8', errors='replace'))
+        except json.JSONDecodeError:
+            return
+        # 其他事件之前先发送暂存的增量，保持输出顺序
+        self._flush_pending(frames)
+        if self._event_type == 'content_block_start':
+            block = event_data.get('content_block', {})
+            logger.info('[stream] content_block_start type=%s name=%s', block.get('type'), block.get('name', ''))
+        for chunk_str in self.translator.translate(self._event_type, event_data):
+            frames.append(b'data: ' + chunk_str.encode('utf-8') + b'\n\n')
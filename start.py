@@ -1,27 +1,30 @@
-import logging
-
 from dotenv import load_dotenv
 
 load_dotenv()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(name)s] %(levelname)s: %(message)s',
-)
+from logging_setup import setup_logging
+
+setup_logging()
 
 from config import Config
 from app import create_app
 
 if __name__ == '__main__':
-    app = create_app()
-    print(f'Proxy service starting on 0.0.0.0:{Config.PROXY_PORT}')
+    print(f'Proxy service starting on 0.0.0.0:{Config.PROXY_PORT} (mode={Config.SERVER_MODE})')
     print(f'Target: {Config.PROXY_TARGET_URL}')
 
-    from waitress import serve
-    serve(
-        app,
-        host='0.0.0.0',
-        port=Config.PROXY_PORT,
-        channel_timeout=Config.API_TIMEOUT,
-        send_bytes=1,
-    )
+    if Config.SERVER_MODE == 'async':
+        from aiohttp import web
+        from async_app import create_async_app
+        web.run_app(create_async_app(), host='0.0.0.0', port=Config.PROXY_PORT, print=None)
+    else:
+        from waitress import serve
+        serve(
+            create_app(),
+            host='0.0.0.0',
+            port=Config.PROXY_PORT,
+            channel_timeout=Config.API_TIMEOUT,
+            send_bytes=1,
+            # 处理请求期间继续读取连接，客户端断开时能及时发现并中止上游流
+            channel_request_lookahead=5,
+        )
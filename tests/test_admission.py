@@ -0,0 +1,67 @@
+"""准入控制：空闲客户端的记录会被移除，_dispatch 只扫描有排队请求的客户端"""
+import time
+from unittest import mock
+
+import pytest
+
+import admission
+from config import Config
+
+
+@pytest.fixture(autouse=True)
+def limits():
+    with mock.patch.object(Config, 'ADMISSION_CONTROL', True), \
+            mock.patch.object(Config, 'ADMISSION_MAX_INFLIGHT', 1), \
+            mock.patch.object(Config, 'ADMISSION_QUEUE_SIZE', 10), \
+            mock.patch.object(Config, 'ADMISSION_PER_KEY_CONCURRENCY', 0), \
+            mock.patch.object(Config, 'ADMISSION_PER_KEY_TPM', 0):
+        yield
+    assert admission._inflight == 0
+    assert admission._queued == 0
+    assert admission._waiting == {}
+
+
+def test_idle_clients_are_forgotten():
+    for n in range(100):
+        admission.admit(f'10.0.0.{n}').release(tokens=50)
+    assert admission._clients == {}
+
+
+def test_waiting_clients_only():
+    ticket = admission.admit('a')
+    wakes = []
+    _, waiter = admission._enqueue('b', lambda: wakes.append('b'))
+    assert list(admission._waiting) == ['b']
+    assert set(admission._clients) == {'a', 'b'}
+
+    ticket.release()
+    assert wakes == ['b'] and waiter.granted
+    assert admission._waiting == {}
+    assert list(admission._clients) == ['b']
+
+    admission._finish_wait(waiter, time.perf_counter()).release()
+    assert admission._clients == {}
+
+
+def test_timed_out_waiter_is_forgotten():
+    ticket = admission.admit('a')
+    _, waiter = admission._enqueue('b', lambda: None)
+    with pytest.raises(admission.Rejected):
+        admission._finish_wait(waiter, time.perf_counter())
+    assert list(admission._clients) == ['a']
+    ticket.release()
+    assert admission._clients == {}
+
+
+def test_tpm_usage_kept_until_window_expires():
+    with mock.patch.object(Config, 'ADMISSION_PER_KEY_TPM', 100):
+        admission.admit('a').release(tokens=100)
+        admission.admit('b').release(tokens=10)
+        assert set(admission._clients) == {'a', 'b'}
+        with pytest.raises(admission.Rejected):
+            admission.admit('a')
+
+        later = time.monotonic() + admission._TPM_WINDOW + admission._SWEEP_INTERVAL
+        with mock.patch.object(admission.time, 'monotonic', return_value=later):
+            admission.admit('c').release()
+        assert admission._clients == {}
@@ -0,0 +1,89 @@
+"""对冲请求在等待首字节时被取消：不能遗留上游连接与 outstanding"""
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('httpx')
+
+import async_app  # noqa: E402
+import routing  # noqa: E402
+from config import Config  # noqa: E402
+
+
+class _FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self):
+        self.closed = False
+
+    async def _never(self):
+        await asyncio.Event().wait()
+        yield b''
+
+    def aiter_bytes(self):
+        return self._never()
+
+    async def aclose(self):
+        self.closed = True
+
+
+class _FakeClient:
+    """send 立即返回响应头（send_delay 为 None 时永不返回），响应体永远不到"""
+
+    def __init__(self, send_delay=0):
+        self.send_delay = send_delay
+        self.responses = []
+
+    def build_request(self, method, url, headers=None, content=None):
+        return url
+
+    async def send(self, request, stream=False):
+        if self.send_delay is None:
+            await asyncio.Event().wait()
+        await asyncio.sleep(self.send_delay)
+        resp = _FakeResponse()
+        self.responses.append(resp)
+        return resp
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(Config, 'UPSTREAM_HEDGE', True)
+    monkeypatch.setattr(Config, 'UPSTREAM_HEDGE_MIN_DELAY', 0.05)
+    monkeypatch.setattr(Config, 'UPSTREAM_HEALTH_CHECK_INTERVAL', 0)
+    monkeypatch.setattr(routing, '_budget', routing._BUDGET_RESERVE)
+    routing._first_byte_times.clear()
+    routing._first_byte_times.extend([0.05] * routing._MIN_HEDGE_SAMPLES)
+    yield
+    routing._first_byte_times.clear()
+
+
+def _cancel_after(client, seconds):
+    """seconds 秒后取消 _open_stream，在事件循环结束（会取消剩余任务）之前检查是否已全部释放"""
+    async def main():
+        task = asyncio.ensure_future(async_app._open_stream(client, b'{}', None))
+        await asyncio.sleep(seconds)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.1)
+        assert all(upstream.outstanding == 0 for upstream in routing.UPSTREAMS)
+        assert all(resp.closed for resp in client.responses)
+        assert len(asyncio.all_tasks()) == 1
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize('send_delay', [0, None])
+def test_cancel_during_hedge_delay(hedging, send_delay):
+    client = _FakeClient(send_delay)
+    _cancel_after(client, 0.01)
+
+
+@pytest.mark.parametrize('send_delay', [0, None])
+def test_cancel_during_race(hedging, send_delay):
+    client = _FakeClient(send_delay)
+    hedges = routing._STATS['hedges']
+    _cancel_after(client, 0.2)
+    assert routing._STATS['hedges'] == hedges + 1
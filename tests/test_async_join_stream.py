@@ -0,0 +1,84 @@
+"""async 模式的合并跟随请求：客户端断开后立即离开 flight，不把缓冲读到结束"""
+import asyncio
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('httpx')
+
+from aiohttp.test_utils import make_mocked_request  # noqa: E402
+
+import async_app  # noqa: E402
+import cancellation  # noqa: E402
+import coalesce  # noqa: E402
+import metrics  # noqa: E402
+from config import Config  # noqa: E402
+
+_MESSAGE_START = (b'event: message_start\ndata: {"type":"message_start","message":'
+                  b'{"model":"claude","usage":{"input_tokens":1}}}\n\n')
+
+
+class _Transport:
+    def __init__(self):
+        self.closing = False
+
+    def is_closing(self):
+        return self.closing
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+def _join(key, writer):
+    """已有一个进行中的 leader（上游暂时没有新数据），当前请求作为跟随者加入"""
+    leader, _ = coalesce.join(key, coalesce.AsyncFlight)
+    leader.respond(200)
+    leader.publish(_MESSAGE_START)
+    follower, cursor = coalesce.join(key, coalesce.AsyncFlight)
+    assert follower is leader and cursor is not None
+    transport = _Transport()
+    request = make_mocked_request('POST', '/v1/chat/completions', transport=transport, writer=writer)
+    guard = cancellation.StreamGuard('chat', client_disconnected=async_app._client_disconnected(request))
+    return leader, transport, async_app._join_stream(
+        request, leader, cursor, metrics.RequestMetrics('claude', True), None, guard)
+
+
+@pytest.fixture
+def coalescing(monkeypatch):
+    monkeypatch.setattr(Config, 'REQUEST_COALESCING', True)
+    monkeypatch.setattr(Config, 'REQUEST_COALESCE_WINDOW', 60)
+    monkeypatch.setattr(Config, 'CLIENT_DISCONNECT_POLL', 0.02)
+
+
+def _writer(write):
+    writer = mock.Mock()
+    writer.write = write
+    writer.write_headers = mock.AsyncMock()
+    writer.drain = mock.AsyncMock()
+    writer.write_eof = mock.AsyncMock()
+    return writer
+
+
+def test_follower_leaves_flight_when_client_disconnects(coalescing):
+    async def main():
+        leader, transport, handler = _join('follower-disconnects', _writer(mock.AsyncMock()))
+        task = asyncio.ensure_future(handler)
+        await asyncio.sleep(0.05)
+        assert not task.done() and len(leader._cursors) == 1
+        transport.closing = True
+        await asyncio.wait_for(task, 1)
+        assert not leader._cursors
+        leader.close()
+
+    asyncio.run(main())
+
+
+def test_follower_returns_quietly_on_connection_reset(coalescing):
+    async def main():
+        leader, _, handler = _join('follower-reset', _writer(mock.AsyncMock(side_effect=ConnectionResetError)))
+        await asyncio.wait_for(handler, 1)
+        assert not leader._cursors
+        leader.close()
+
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+"""async 模式的工具参数修复（读取本地文件）不在事件循环线程上执行"""
+import asyncio
+import random
+import threading
+from unittest import mock
+
+import pytest
+
+import openai_adapter
+from config import Config
+from sse_transcoder import SSETranscoder
+
+_STREAM = (
+    b'event: message_start\ndata: {"type":"message_start","message":{"model":"claude","usage":{"input_tokens":1}}}\n\n'
+    b'event: content_block_start\ndata: {"type":"content_block_start","index":0,'
+    b'"content_block":{"type":"text","text":""}}\n\n'
+    b'event: content_block_delta\ndata: {"type":"content_block_delta","index":0,'
+    b'"delta":{"type":"text_delta","text":"hi"}}\n\n'
+    b'event: content_block_stop\ndata: {"type":"content_block_stop","index":0}\n\n'
+    b'event: content_block_start\ndata: {"type":"content_block_start","index":1,'
+    b'"content_block":{"type":"tool_use","id":"toolu_1","name":"str_replace","input":{}}}\n\n'
+    b'event: content_block_delta\ndata: {"type":"content_block_delta","index":1,'
+    b'"delta":{"type":"input_json_delta","partial_json":"{\\"path\\": \\"a.py\\", "}}\n\n'
+    b'event: content_block_delta\ndata: {"type":"content_block_delta","index":1,'
+    b'"delta":{"type":"input_json_delta","partial_json":"\\"old_string\\": \\"x\\"}"}}\n\n'
+    b'event: content_block_stop\ndata: {"type":"content_block_stop","index":1}\n\n'
+    b'event: message_delta\ndata: {"type":"message_delta","delta":{"stop_reason":"tool_use"},'
+    b'"usage":{"output_tokens":5}}\n\n'
+)
+
+
+@pytest.fixture
+def repair_calls():
+    calls = []
+
+    def record(name, args):
+        calls.append(threading.current_thread())
+        return args
+
+    with mock.patch.object(Config, 'STREAM_TOOL_REPAIR', True), \
+            mock.patch.object(openai_adapter, 'repair_exact_match_tool_arguments', record):
+        yield calls
+
+
+def _split(data, rng):
+    cuts = sorted(rng.sample(range(1, len(data)), rng.randint(1, 12)))
+    return [data[start:end] for start, end in zip([0] + cuts, cuts + [len(data)])]
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_may_repair_has_no_false_negatives(repair_calls, seed):
+    rng = random.Random(seed)
+    for case in range(50):
+        # 流末尾不带换行时，最后一个事件由 finish 处理
+        stream = _STREAM.rstrip(b'\n') if case % 2 else _STREAM
+        transcoder = SSETranscoder('chatcmpl-test')
+        repair_calls.clear()
+        for chunk in _split(stream, rng):
+            predicted = transcoder.may_repair(chunk)
+            before = len(repair_calls)
+            transcoder.feed(chunk)
+            assert predicted or len(repair_calls) == before
+        predicted = transcoder.may_repair()
+        before = len(repair_calls)
+        transcoder.finish()
+        assert predicted or len(repair_calls) == before
+        assert len(repair_calls) == 1
+
+
+def test_async_repair_runs_off_the_event_loop(repair_calls):
+    pytest.importorskip('aiohttp')
+    pytest.importorskip('httpx')
+    import async_app
+
+    async def main():
+        transcoder = SSETranscoder('chatcmpl-test')
+        for chunk in _split(_STREAM, random.Random(0)):
+            await async_app._feed(transcoder, chunk)
+        await async_app._finish(transcoder)
+        await async_app._to_openai_response({
+            'content': [{'type': 'tool_use', 'id': 'toolu_1', 'name': 'str_replace',
+                         'input': {'path': 'a.py', 'old_string': 'x'}}],
+            'stop_reason': 'tool_use',
+        })
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(main())
+    assert len(repair_calls) == 2
+    assert loop_thread not in repair_calls
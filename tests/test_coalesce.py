@@ -0,0 +1,60 @@
+"""请求合并：leader 提前结束时跟随者立即收到失败，而不是等到 API_TIMEOUT"""
+import threading
+
+import pytest
+
+import coalesce
+from config import Config
+
+
+@pytest.fixture
+def coalescing(monkeypatch):
+    monkeypatch.setattr(Config, 'REQUEST_COALESCING', True)
+    monkeypatch.setattr(Config, 'REQUEST_COALESCE_WINDOW', 60)
+
+
+def test_close_is_idempotent(coalescing):
+    flight, cursor = coalesce.join('close-twice')
+    assert cursor is None
+    flight.close('upstream stream aborted')
+    flight.close()
+    assert flight.done and flight.error == 'upstream stream aborted'
+    # 已结束的 flight 不可加入，下一个请求成为新的 leader
+    leader, cursor = coalesce.join('close-twice')
+    assert leader is not flight and cursor is None
+    leader.close()
+
+
+def test_follower_wakes_when_leader_aborts(coalescing, monkeypatch):
+    monkeypatch.setattr(Config, 'API_TIMEOUT', 5)
+    flight, _ = coalesce.join('leader-aborts')
+    follower, cursor = coalesce.join('leader-aborts')
+    assert follower is flight and cursor is not None
+
+    timer = threading.Timer(0.05, flight.close, ('upstream stream aborted',))
+    timer.start()
+    with pytest.raises(coalesce.FlightError, match='aborted'):
+        flight.wait_response()
+    timer.join()
+
+
+def test_stream_closed_before_start_closes_flight(coalescing, monkeypatch):
+    """waitress 在生成器启动前关闭响应（客户端排队时断开）：flight 也要关闭"""
+    pytest.importorskip('flask')
+    import app as app_module
+
+    def fail(*args, **kwargs):
+        raise AssertionError('upstream must not be called')
+
+    monkeypatch.setattr(Config, 'ACCESS_API_KEY', '')
+    monkeypatch.setattr(app_module, '_send_upstream', fail)
+    from werkzeug.test import EnvironBuilder
+
+    payload = {'model': 'claude', 'stream': True, 'messages': [{'role': 'user', 'content': 'closed early'}]}
+    environ = EnvironBuilder(path='/v1/chat/completions', method='POST', json=payload).get_environ()
+    # 直接调用 WSGI 应用并在不迭代的情况下 close，测试客户端会先取第一块数据
+    in_flight = coalesce.stats()['in_flight']
+    app_iter = app_module.create_app()(environ, lambda status, headers, exc_info=None: None)
+    assert coalesce.stats()['in_flight'] == in_flight + 1
+    app_iter.close()
+    assert coalesce.stats()['in_flight'] == in_flight
@@ -0,0 +1,63 @@
+"""JSON 后端：默认在装有 msgspec 时用它解析，序列化输出与 json.dumps 逐字节相同"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import json_codec
+
+_SAMPLES = [
+    {'content': '你好 é \U0001f600', 'args': {'a': [1, 2.5, 1e16, 1e-07, None, True]}},
+    {'ctrl': '\x00\x1f\x7f "\\/', 'nan': float('nan'), 'inf': float('-inf'), 'big': 2 ** 70},
+    ['x', {'1': {}}, [], ''],
+]
+
+_INPUTS = [
+    b'{"a": NaN, "b": Infinity}',
+    b'{"big": 123456789012345678901234567890, "neg": -123456789012345678901234567890}',
+    '{"x": "\\ud800", "y": "\\ud83d\\ude00"}',
+    b'{"dup": 1, "dup": 2}',
+    b'\xef\xbb\xbf{"bom": true}',
+    b'{"f": 0.1, "g": 1e400, "h": -0.0, "i": 5E-324}',
+    '{"s": "héllo", "e": "\\u00e9"}'.encode('utf-8'),
+    b' [1, 2.0, "3"] ',
+]
+
+
+@pytest.mark.parametrize('obj', _SAMPLES)
+def test_dumps_matches_stdlib(obj):
+    assert json_codec.dumps(obj) == json.dumps(obj)
+    assert json_codec.dumpb(obj) == json.dumps(obj).encode('utf-8')
+
+
+@pytest.mark.parametrize('data', _INPUTS)
+def test_loads_matches_stdlib(data):
+    expected = json.loads(data)
+    result = json_codec.loads(data)
+    # NaN 不等于自身，按序列化结果比较（同时区分 2 与 2.0）
+    assert json.dumps(result) == json.dumps(expected)
+
+
+@pytest.mark.parametrize('data', [b'{"a": ', b'\xff', b'[1,]', b''])
+def test_loads_rejects_like_stdlib(data):
+    with pytest.raises(ValueError):
+        json_codec.loads(data)
+
+
+def test_fast_backend_detected_by_default():
+    env = {k: v for k, v in os.environ.items() if k != 'JSON_BACKEND'}
+    # 子进程沿用当前的 sys.path，是否装有 msgspec 与当前进程一致
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = 'import json, json_codec; print(json.dumps(json_codec.stats()))'
+    out = subprocess.run([sys.executable, '-c', script], cwd=root, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    try:
+        import msgspec  # noqa: F401
+    except ImportError:
+        expected = 'json'
+    else:
+        expected = 'msgspec'
+    assert json.loads(out) == {'loads': expected, 'dumps': 'json'}
@@ -0,0 +1,55 @@
+"""压测客户端按 OpenAI 流中的输出 chunk 计 TTFT 与 token 数，空格与紧凑两种 JSON 格式都要识别"""
+import io
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+
+import loadgen  # noqa: E402
+
+
+def _chunk(delta):
+    return {'id': 'chatcmpl-x', 'object': 'chat.completion.chunk', 'model': 'claude',
+            'choices': [{'index': 0, 'delta': delta}]}
+
+
+_DELTAS = [
+    {'role': 'assistant', 'content': ''},
+    {'reasoning_content': 'think'},
+    {'content': 'Hello'},
+    {'tool_calls': [{'index': 0, 'id': 'toolu_1', 'type': 'function',
+                     'function': {'name': 'Edit', 'arguments': ''}}]},
+    {'tool_calls': [{'index': 0, 'function': {'arguments': '{"a": 1}'}}]},
+]
+
+
+def _frames(separators):
+    return b''.join(b'data: ' + json.dumps(_chunk(delta), separators=separators).encode() + b'\n\n'
+                    for delta in _DELTAS) + b'data: [DONE]\n\n'
+
+
+class _FakeResponse(io.BytesIO):
+    status = 200
+
+
+class _FakeConnection:
+    def __init__(self, data):
+        self.data = data
+
+    def request(self, method, path, body=None, headers=None):
+        pass
+
+    def getresponse(self):
+        return _FakeResponse(self.data)
+
+
+@pytest.mark.parametrize('separators', [(', ', ': '), (',', ':')], ids=['spaced', 'compact'])
+def test_chat_tokens_counted_in_both_formats(separators):
+    result = loadgen._run_one(_FakeConnection(_frames(separators)), '/v1/chat/completions', b'{}', {}, True)
+    assert result['status'] == 200
+    # role chunk 不算，其余 4 个 chunk 都携带输出
+    assert result['tokens'] == 4
+    assert result['ttft'] is not None
@@ -0,0 +1,65 @@
+"""队列日志：请求线程只复制记录，格式化在后台线程执行"""
+import io
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+import logging_setup
+
+
+class _RecordingFormatter(logging_setup.JsonFormatter):
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def format(self, record):
+        self.threads.append(threading.current_thread())
+        return super().format(record)
+
+
+def _log_exception(logger):
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        logger.exception('[test] failed %s=%d', 'count', 3)
+
+
+def test_prepare_defers_formatting():
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger('test_logging_setup.prepare')
+    logger.propagate = False
+    logger.addHandler(logging_setup._QueueHandler(log_queue))
+    _log_exception(logger)
+
+    record = log_queue.get_nowait()
+    # 消息还没有格式化，堆栈已渲染、traceback 已丢弃
+    assert record.msg == '[test] failed %s=%d'
+    assert record.args == ('count', 3)
+    assert record.exc_info is None
+    assert 'ValueError: boom' in record.exc_text
+
+    entry = json.loads(logging_setup.JsonFormatter().format(record))
+    assert entry['message'] == '[test] failed count=3'
+    assert 'ValueError: boom' in entry['exc_info']
+    assert 'ValueError: boom' in logging.Formatter(logging_setup.TEXT_FORMAT).format(record)
+
+
+def test_listener_thread_formats():
+    log_queue = queue.SimpleQueue()
+    formatter = _RecordingFormatter()
+    handler = logging.StreamHandler(io.StringIO())
+    handler.setFormatter(formatter)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    logger = logging.getLogger('test_logging_setup.listener')
+    logger.propagate = False
+    logger.addHandler(logging_setup._QueueHandler(log_queue))
+    try:
+        logger.warning('[test] hello %s', 'world')
+        _log_exception(logger)
+    finally:
+        listener.stop()
+    assert len(formatter.threads) == 2
+    assert threading.current_thread() not in formatter.threads
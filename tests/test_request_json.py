@@ -0,0 +1,45 @@
+"""请求体不是合法 JSON 对象时两种模式都返回相同的 400 错误"""
+import asyncio
+from unittest import mock
+
+import pytest
+
+from config import Config
+
+_BODIES = [b'{"model": "claude", ', b'not json', b'[1, 2]']
+_ROUTES = ['/v1/chat/completions', '/v1/messages']
+
+
+@pytest.mark.parametrize('path', _ROUTES)
+@pytest.mark.parametrize('body', _BODIES)
+def test_flask_rejects_malformed_body(path, body):
+    pytest.importorskip('flask')
+    import app
+
+    with mock.patch.object(Config, 'ACCESS_API_KEY', ''):
+        resp = app.create_app().test_client().post(path, data=body)
+    assert resp.status_code == 400
+    assert resp.get_json()['error']['type'] == 'invalid_request_error'
+
+
+@pytest.mark.parametrize('path', _ROUTES)
+@pytest.mark.parametrize('body', _BODIES)
+def test_async_matches_flask(path, body):
+    pytest.importorskip('flask')
+    pytest.importorskip('aiohttp')
+    pytest.importorskip('httpx')
+    from aiohttp.test_utils import TestClient, TestServer
+
+    import app
+    import async_app
+
+    async def post():
+        async with TestClient(TestServer(async_app.create_async_app())) as client:
+            resp = await client.post(path, data=body)
+            return resp.status, await resp.json()
+
+    with mock.patch.object(Config, 'ACCESS_API_KEY', ''):
+        status, error = asyncio.run(post())
+        expected = app.create_app().test_client().post(path, data=body).get_json()
+    assert status == 400
+    assert error == expected
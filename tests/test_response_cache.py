@@ -0,0 +1,63 @@
+"""响应缓存：async 模式下磁盘读写与清理不在事件循环线程上执行"""
+import asyncio
+import threading
+from unittest import mock
+
+import pytest
+
+import response_cache
+from config import Config
+
+
+@pytest.fixture
+def disk_cache(tmp_path):
+    threads = []
+    disk_path = response_cache._disk_path
+    sweep_disk = response_cache._sweep_disk
+
+    def record(func):
+        def wrapper(*args):
+            threads.append(threading.current_thread())
+            return func(*args)
+        return wrapper
+
+    with mock.patch.object(Config, 'RESPONSE_CACHE_DIR', str(tmp_path)), \
+            mock.patch.object(response_cache, '_DISK_SWEEP_INTERVAL', 1), \
+            mock.patch.object(response_cache, '_disk_path', record(disk_path)), \
+            mock.patch.object(response_cache, '_sweep_disk', record(sweep_disk)):
+        yield threads
+
+
+def test_memory_hit_skips_disk(disk_cache):
+    response_cache.put('a' * 64, b'cached')
+    disk_cache.clear()
+    assert response_cache.get_memory('a' * 64) == b'cached'
+    assert response_cache.get('a' * 64) == b'cached'
+    assert disk_cache == []
+    assert response_cache.get_memory('b' * 64) is None
+    assert disk_cache == []
+
+
+def test_async_disk_io_runs_off_the_event_loop(disk_cache):
+    pytest.importorskip('aiohttp')
+    pytest.importorskip('httpx')
+    import async_app
+
+    key = 'c' * 64
+
+    async def main():
+        await async_app._cache_put(key, b'cached')
+        # 只留下磁盘上的副本
+        response_cache._memory.pop(key)
+        assert await async_app._cache_get(key) == b'cached'
+        assert await async_app._cache_get('d' * 64) is None
+        return threading.current_thread()
+
+    before = response_cache.stats()
+    loop_thread = asyncio.run(main())
+    after = response_cache.stats()
+    # put 写盘 + 清理，两次 get 读盘
+    assert len(disk_cache) == 4
+    assert loop_thread not in disk_cache
+    assert after['disk_hits'] - before['disk_hits'] == 1
+    assert after['misses'] - before['misses'] == 1
@@ -0,0 +1,57 @@
+"""熔断半开状态：只有试探请求自己结束时才允许下一个试探"""
+from unittest import mock
+
+import pytest
+
+pytest.importorskip('requests')
+
+import routing  # noqa: E402
+from config import Config  # noqa: E402
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    upstream = routing.Upstream('test', 'http://upstream.test', 'key')
+    monkeypatch.setattr(routing, 'UPSTREAMS', [upstream])
+    with mock.patch.object(Config, 'UPSTREAM_CIRCUIT_FAILURES', 1), \
+            mock.patch.object(Config, 'UPSTREAM_CIRCUIT_COOLDOWN', 0), \
+            mock.patch.object(Config, 'UPSTREAM_HEALTH_CHECK_INTERVAL', 0):
+        yield upstream
+    assert upstream.outstanding == 0
+
+
+def _open_circuit(upstream):
+    lease = routing.acquire()
+    lease.failure()
+    lease.release()
+    assert upstream.state == routing._OPEN
+
+
+def test_other_request_does_not_end_trial(upstream):
+    # 熔断前发出的请求
+    earlier = routing.acquire()
+    _open_circuit(upstream)
+
+    trial = routing.acquire()
+    assert upstream.state == routing._HALF_OPEN
+    # 唯一的上游正在试探，退回选中它的请求不是试探
+    fallback = routing.acquire()
+    earlier.release()
+    fallback.release()
+    assert not upstream._available(0)
+
+    trial.release()
+    assert upstream._available(0)
+
+
+def test_stale_trial_does_not_end_new_trial(upstream):
+    _open_circuit(upstream)
+    stale = routing.acquire()
+    # 试探失败后重新熔断，冷却结束后开始新的试探；旧的试探请求（如流式响应）还没结束
+    stale.failure()
+    trial = routing.acquire()
+    stale.release()
+    assert not upstream._available(0)
+    trial.release()
+    trial.release()
+    assert upstream._available(0)
@@ -0,0 +1,69 @@
+"""old_string 容错匹配：锚点加速的查找结果必须与整文件 finditer 一致"""
+import itertools
+import random
+import re
+
+import pytest
+
+from tool_use_fixer import _build_fuzzy_pattern, _find_fuzzy_matches, repair_exact_match_tool_arguments
+
+
+def _baseline(old_string, content):
+    """优化前的实现：整文件 finditer（只关心前两个匹配）"""
+    return [match.group() for match in itertools.islice(re.finditer(_build_fuzzy_pattern(old_string), content), 2)]
+
+
+_WORDS = ['abcd', 'def', 'x', 'return', 'self.value', '"s"', "'q'", '\\n', '“q”', 'foo(bar)']
+_SEPARATORS = [' ', '  ', '\t', '\n', ' \t ', '', '\\']
+
+
+def _random_text(rng, words):
+    return ''.join(rng.choice(_WORDS) + rng.choice(_SEPARATORS) for _ in range(words))
+
+
+def _perturb(rng, text):
+    """模拟模型改写：引号互换、空白变化、反斜杠个数变化"""
+    out = []
+    for ch in text:
+        roll = rng.random()
+        if ch == '"' and roll < 0.5:
+            out.append(rng.choice('“”'))
+        elif ch == "'" and roll < 0.5:
+            out.append('’')
+        elif ch in ' \t' and roll < 0.5:
+            out.append(rng.choice([' ', '\t', '  ']))
+        elif ch == '\\' and roll < 0.3:
+            out.append('\\\\')
+        else:
+            out.append(ch)
+    return ''.join(out)
+
+
+def test_overlapping_candidates_use_finditer_semantics():
+    content = 'abcd abcd abcd'
+    old_string = 'abcd\tabcd'
+    assert _find_fuzzy_matches(old_string, content) == _baseline(old_string, content) == ['abcd abcd']
+
+
+def test_overlapping_candidates_are_repaired(tmp_path):
+    path = tmp_path / 'f.txt'
+    path.write_text('abcd abcd abcd', encoding='utf-8')
+    args = repair_exact_match_tool_arguments(
+        'str_replace', {'path': str(path), 'old_string': 'abcd\tabcd', 'new_string': 'x'})
+    assert args['old_string'] == 'abcd abcd'
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_equal_full_scan(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        content = _random_text(rng, rng.randint(5, 80))
+        if rng.random() < 0.5:
+            # 重复片段，制造多个（可能重叠的）候选
+            content = content * rng.randint(2, 4)
+        start = rng.randrange(len(content))
+        old_string = _perturb(rng, content[start:start + rng.randint(4, 60)])
+        if not old_string.strip():
+            continue
+        assert _find_fuzzy_matches(old_string, content) == _baseline(old_string, content), (old_string, content)
+
@@ -0,0 +1,88 @@
+import json
+import threading
+from collections import OrderedDict
+
+import json_codec
+
+# 同时缓存的不同工具集数量（Cursor 按模式/版本只会用到少数几套）
+MAX_TOOLSETS = 32
+
+# key: 工具名元组；value: [(原始 tools, SerializedTools), ...]
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+_STATS = {
+    'hits': 0,
+    'misses': 0,
+}
+
+
+class SerializedTools(list):
+    """转换后的 Anthropic tools 列表，附带预先序列化好的 JSON 片段（UTF-8 bytes）
+
+    上游请求体直接拼接 json 片段，不再逐个遍历工具 schema。实例会被多个请求共享，
+    不能原地修改；需要带 cache_control 的版本时用 with_cache_control。
+    """
+
+    __slots__ = ('json', '_marked')
+
+    def __init__(self, tools):
+        super().__init__(tools)
+        self.json = json_codec.dumpb(tools)
+        self._marked = {}
+
+    def with_cache_control(self, cache_control):
+        """返回最后一个工具带 cache_control 的版本（按 cache_control 内容缓存）"""
+        key = json.dumps(cache_control, sort_keys=True)
+        marked = self._marked.get(key)
+        if marked is None:
+            marked = SerializedTools(self[:-1] + [{**self[-1], 'cache_control': cache_control}])
+            self._marked[key] = marked
+        return marked
+
+
+def _tool_names(tools):
+    names = []
+    for tool in tools:
+        if not isinstance(tool, dict):
+            return None
+        func = tool.get('function')
+        names.append(func.get('name') if isinstance(func, dict) else tool.get('name'))
+    return tuple(names)
+
+
+def convert_tools(tools, converter):
+    """带缓存的 tools 转换
+
+    先按工具名定位候选，再与缓存的原始 tools 做相等比较确认命中；比较在 C 层完成，
+    比重新转换 + 序列化整套 schema 便宜得多。同时兼容 OpenAI 嵌套格式与 Cursor 扁平格式。
+    """
+    key = _tool_names(tools)
+    if key is None:
+        return converter(tools)
+
+    with _lock:
+        candidates = _cache.get(key)
+        if candidates is not None:
+            _cache.move_to_end(key)
+            for source, converted in candidates:
+                if source == tools:
+                    _STATS['hits'] += 1
+                    return converted
+        _STATS['misses'] += 1
+
+    converted = SerializedTools(converter(tools))
+    with _lock:
+        candidates = _cache.setdefault(key, [])
+        candidates.insert(0, (tools, converted))
+        del candidates[4:]
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_TOOLSETS:
+            _cache.popitem(last=False)
+    return converted
+
+
+def stats():
+    """tools 缓存统计，供 /health 输出"""
+    with _lock:
+        return {**_STATS, 'toolsets': len(_cache)}
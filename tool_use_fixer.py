@@ -1,6 +1,14 @@
+import itertools
 import os
 import re
+import stat
+import threading
+import time
 import uuid
+from functools import lru_cache
+
+from config import Config
+from lru import ByteLRU
 
 SMART_DOUBLE_QUOTES = frozenset({
     '\u00ab', '\u201c', '\u201d', '\u275e',
@@ -11,6 +19,23 @@ SMART_SINGLE_QUOTES = frozenset({
     '\u2018', '\u2019', '\u201a', '\u201b',
 })
 
+# 锚点短于该长度时命中太多，直接整文件扫描
+MIN_ANCHOR_LENGTH = 4
+# 单个锚点的候选位置上限，超出后整文件扫描
+MAX_ANCHOR_CANDIDATES = 256
+
+# key: 文件路径；value: ((mtime_ns, size, inode), 内容)
+_file_cache = ByteLRU(Config.TOOL_REPAIR_FILE_CACHE_MB * 1024 * 1024)
+
+_STATS = {
+    'attempted': 0,
+    'succeeded': 0,
+    'time_ms': 0.0,
+    'file_reads': 0,
+    'file_cache_hits': 0,
+}
+_STATS_LOCK = threading.Lock()
+
 
 def normalize_tool_arguments(args):
     """字段映射：file_path → path"""
@@ -21,6 +46,12 @@ def normalize_tool_arguments(args):
     return args
 
 
+def _is_literal(ch):
+    """该字符在容错正则中是否按原样匹配"""
+    return not (ch in SMART_DOUBLE_QUOTES or ch in SMART_SINGLE_QUOTES
+                or ch in ('"', "'", ' ', '\t', '\\'))
+
+
 def _build_fuzzy_pattern(text):
     """构建容错正则：引号互换、空白差异、反斜杠差异"""
     pattern_parts = []
@@ -41,6 +72,27 @@ def _build_fuzzy_pattern(text):
     return ''.join(pattern_parts)
 
 
+@lru_cache(maxsize=256)
+def _compile_fuzzy(text):
+    """编译 old_string 的容错正则，返回 (最长字面量片段, 片段偏移, 前缀正则, 完整正则)
+
+    字面量片段在文件中只能原样出现，先用 str.find 定位，再在附近验证整段匹配，
+    避免对整个文件跑逐字符构造的正则。编译失败时返回 None。
+    """
+    best_start = best_end = run_start = 0
+    for i, ch in enumerate(text):
+        if not _is_literal(ch):
+            run_start = i + 1
+        elif i + 1 - run_start > best_end - best_start:
+            best_start, best_end = run_start, i + 1
+    try:
+        prefix = re.compile('(?:' + _build_fuzzy_pattern(text[:best_start]) + r')\Z')
+        full = re.compile(_build_fuzzy_pattern(text))
+    except re.error:
+        return None
+    return text[best_start:best_end], best_start, prefix, full
+
+
 def _replace_smart_quotes(text):
     """将智能引号替换为普通引号"""
     result = list(text)
@@ -52,6 +104,70 @@ def _replace_smart_quotes(text):
     return ''.join(result)
 
 
+def _read_file(file_path):
+    """读取文件内容，按 (mtime, size, inode) 校验缓存；不是普通文件或读取失败返回 None"""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+
+    version = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = _file_cache.get(file_path)
+    if cached is not None and cached[0] == version:
+        _count(file_cache_hits=1)
+        return cached[1]
+
+    try:
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            content = f.read()
+    except Exception:
+        return None
+    _count(file_reads=1)
+    _file_cache.put(file_path, (version, content), len(content) + 128)
+    return content
+
+
+def _find_fuzzy_matches(old_string, content):
+    """返回容错正则在 content 中的匹配文本（最多 2 个，调用方只关心是否唯一）
+
+    以最长字面量片段为锚点，反推匹配起点后用完整正则就地验证；锚点过短、出现次数过多
+    或前缀可能越出验证窗口时，退回整文件扫描。与 finditer 一样只取互不重叠的匹配：
+    下一个匹配从上一个匹配的结尾开始找。
+    """
+    compiled = _compile_fuzzy(old_string)
+    if compiled is None:
+        return []
+    anchor, anchor_offset, prefix, full = compiled
+
+    if len(anchor) >= MIN_ANCHOR_LENGTH:
+        # 前缀里的 \s+ 和 \\{1,2} 会变长，窗口留足余量
+        window = anchor_offset * 4 + 256
+        spans = []
+        last_end = 0
+        pos = content.find(anchor)
+        for _ in range(MAX_ANCHOR_CANDIDATES):
+            if pos == -1:
+                return [content[start:end] for start, end in spans]
+            # 匹配起点不晚于锚点，锚点落在上一个匹配内时不可能有新的不重叠匹配
+            if pos >= last_end:
+                window_start = max(last_end, pos - window)
+                head = prefix.search(content, window_start, pos)
+                if head is not None:
+                    if head.start() == window_start and window_start > last_end:
+                        break
+                    match = full.match(content, head.start())
+                    if match is not None:
+                        spans.append(match.span())
+                        if len(spans) > 1:
+                            return [content[start:end] for start, end in spans]
+                        last_end = match.end()
+            pos = content.find(anchor, pos + 1)
+
+    return [match.group() for match in itertools.islice(full.finditer(content), 2)]
+
+
 def repair_exact_match_tool_arguments(tool_name, args):
     """修复 StrReplace / search_replace 工具的 old_string 精确匹配问题"""
     if not isinstance(args, dict):
@@ -66,31 +182,30 @@ def repair_exact_match_tool_arguments(tool_name, args):
         return args
 
     file_path = args.get('path') or args.get('file_path')
-    if not file_path or not os.path.isfile(file_path):
+    if not file_path:
         return args
 
+    started = time.perf_counter()
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-            content = f.read()
-    except Exception:
-        return args
+        content = _read_file(file_path)
+        if content is None:
+            return args
 
-    # 已经精确匹配，无需修复
-    if old_string in content:
-        return args
+        # 已经精确匹配，无需修复
+        if old_string in content:
+            return args
 
-    # 构建容错正则尝试匹配
-    pattern = _build_fuzzy_pattern(old_string)
-    try:
-        matches = list(re.finditer(pattern, content))
-    except re.error:
-        return args
+        _count(attempted=1)
+        matches = _find_fuzzy_matches(old_string, content)
 
-    # 仅在唯一匹配时修复
-    if len(matches) != 1:
-        return args
+        # 仅在唯一匹配时修复
+        if len(matches) != 1:
+            return args
 
-    matched_text = matches[0].group()
+        matched_text = matches[0]
+        _count(succeeded=1)
+    finally:
+        _count(time_ms=(time.perf_counter() - started) * 1000)
 
     # 更新 old_string
     if 'old_string' in args:
@@ -110,6 +225,26 @@ def repair_exact_match_tool_arguments(tool_name, args):
     return args
 
 
+def _count(**deltas):
+    with _STATS_LOCK:
+        for name, delta in deltas.items():
+            _STATS[name] += delta
+
+
+def repair_stats():
+    """old_string 修复统计，供 /health 输出"""
+    with _STATS_LOCK:
+        result = dict(_STATS)
+    result['time_ms'] = round(result['time_ms'], 3)
+    lru_stats = _file_cache.stats()
+    result['file_cache'] = {
+        'files': lru_stats['entries'],
+        'bytes': lru_stats['bytes'],
+        'max_bytes': lru_stats['max_bytes'],
+    }
+    return result
+
+
 def fix_tool_use_response(response_data):
     """修复响应中的 tool_use 问题"""
     if not isinstance(response_data, dict):
@@ -0,0 +1,189 @@
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_STATS = {
+    'recorded': 0,
+    'dropped': 0,
+    'files': 0,
+}
+_STATS_LOCK = threading.Lock()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class Recording:
+    """一次 /v1/chat/completions 请求的完整记录
+
+    请求线程只做追加（上游原始字节与输出帧各带相对请求开始的时间），序列化与写盘都在后台线程完成。
+    """
+
+    __slots__ = ('request_id', 'stream', 'started', 'started_at', 'openai_request', 'anthropic_request',
+                 'timings', 'upstream_status', 'upstream', 'output')
+
+    def __init__(self, openai_request, stream):
+        self.request_id = None
+        self.stream = stream
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.openai_request = openai_request
+        self.anthropic_request = None
+        self.timings = {}
+        self.upstream_status = None
+        self.upstream = []
+        self.output = []
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def converted(self, anthropic_request, seconds):
+        self.anthropic_request = anthropic_request
+        self.timings['conversion_ms'] = round(seconds * 1000, 3)
+
+    def upstream_response(self, status_code):
+        self.upstream_status = status_code
+        self.timings['ttfb_ms'] = round(self.elapsed() * 1000, 3)
+
+    def upstream_data(self, data):
+        self.upstream.append((self.elapsed(), data))
+
+    def output_data(self, data):
+        self.output.append((self.elapsed(), data))
+
+    def finish(self):
+        """请求结束时调用：交给后台线程写盘，队列满时丢弃并计数"""
+        self.timings['duration_ms'] = round(self.elapsed() * 1000, 3)
+        writer = _get_writer()
+        try:
+            writer.queue.put_nowait(self)
+        except queue.Full:
+            with _STATS_LOCK:
+                _STATS['dropped'] += 1
+
+    def to_dict(self):
+        return {
+            'request_id': self.request_id,
+            'time': self.started_at,
+            'stream': self.stream,
+            'openai_request': self.openai_request,
+            'anthropic_request': self.anthropic_request,
+            'timings': self.timings,
+            'upstream_status': self.upstream_status,
+            'upstream': [[round(t, 6), _decode(data)] for t, data in self.upstream],
+            'output': [[round(t, 6), _decode(data)] for t, data in self.output],
+        }
+
+
+def _decode(data):
+    """网络读取可能把多字节字符拆开，字节按 latin-1 原样保存，回放时再 encode('latin-1')"""
+    return data.decode('latin-1') if isinstance(data, bytes) else data
+
+
+class _CaptureWriter(threading.Thread):
+    """后台写入 gzip 压缩的 JSONL，单个文件超过 TRAFFIC_CAPTURE_FILE_MB 后轮转"""
+
+    def __init__(self, directory, max_bytes, queue_size):
+        super().__init__(name='traffic-capture', daemon=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._raw = None
+        self._file = None
+        self._sequence = 0
+
+    def run(self):
+        while True:
+            recording = self.queue.get()
+            if recording is None:
+                break
+            try:
+                self._write(recording)
+            except Exception:
+                logger.exception('[capture] failed to write recording %s', recording.request_id)
+            if self.queue.empty() and self._file is not None:
+                # 空闲时刷盘，保证进程异常退出时已写入的记录可读
+                self._file.flush()
+        self._close()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join(timeout=10)
+
+    def _write(self, recording):
+        line = json.dumps(recording.to_dict(), ensure_ascii=False).encode('utf-8') + b'\n'
+        if self._file is None or self._raw.tell() >= self.max_bytes:
+            self._rotate()
+        self._file.write(line)
+        with _STATS_LOCK:
+            _STATS['recorded'] += 1
+
+    def _rotate(self):
+        self._close()
+        os.makedirs(self.directory, exist_ok=True)
+        self._sequence += 1
+        name = f'capture-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{self._sequence}.jsonl.gz'
+        self._raw = open(os.path.join(self.directory, name), 'wb')
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        with _STATS_LOCK:
+            _STATS['files'] += 1
+        logger.info('[capture] writing %s', name)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._raw.close()
+            self._file = self._raw = None
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = _CaptureWriter(
+                    Config.TRAFFIC_CAPTURE_DIR,
+                    Config.TRAFFIC_CAPTURE_FILE_MB * 1024 * 1024,
+                    Config.TRAFFIC_CAPTURE_QUEUE,
+                )
+                writer.start()
+                atexit.register(writer.stop)
+                _writer = writer
+    return _writer
+
+
+def start_recording(openai_request, stream):
+    """开启抓包时返回 Recording，否则返回 None（调用方据此跳过所有记录操作）"""
+    if not Config.TRAFFIC_CAPTURE:
+        return None
+    return Recording(openai_request, stream)
+
+
+def capture_stats():
+    """抓包统计，供 /health 输出"""
+    with _STATS_LOCK:
+        result = dict(_STATS)
+    result['enabled'] = Config.TRAFFIC_CAPTURE
+    result['queued'] = _writer.queue.qsize() if _writer is not None else 0
+    return result
+
+
+def read_recordings(path):
+    """逐条读取抓包文件（.jsonl.gz 或 .jsonl），文件末尾未写完的记录会被跳过"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, json.JSONDecodeError):
+            return
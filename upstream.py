@@ -0,0 +1,184 @@
+import threading
+import time
+
+import httpx
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from config import Config
+
+# 连接池统计：hits=复用已建立的连接，new_connections=新建 TCP/TLS，
+# waits=池满阻塞等待，idle_closed=空闲超时后主动关闭
+_POOL_STATS = {
+    'requests': 0,
+    'hits': 0,
+    'new_connections': 0,
+    'waits': 0,
+    'idle_closed': 0,
+}
+_POOL_STATS_LOCK = threading.Lock()
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _count(**deltas):
+    with _POOL_STATS_LOCK:
+        for key, value in deltas.items():
+            _POOL_STATS[key] += value
+
+
+def pool_stats():
+    """连接池统计快照，供 /health 输出"""
+    with _POOL_STATS_LOCK:
+        stats = dict(_POOL_STATS)
+    stats['http2'] = Config.UPSTREAM_HTTP2 and Config.SERVER_MODE == 'async'
+    return stats
+
+
+def prepare_headers(api_key=None):
+    """准备请求头，注入 API Key（默认 PROXY_API_KEY）"""
+    headers = {
+        'anthropic-version': '2023-06-01',
+    }
+    key = Config.PROXY_API_KEY if api_key is None else api_key
+    if key.startswith('sk-'):
+        headers['x-api-key'] = key
+    else:
+        headers['Authorization'] = f'Bearer {key}'
+    return headers
+
+
+# 透传上游响应时不转发的头：逐跳头，以及由本地服务器重新生成的头（响应体已解压，长度另计）
+_NON_RELAYED_HEADERS = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+    'transfer-encoding', 'upgrade', 'content-length', 'content-encoding', 'date', 'server',
+))
+
+
+def relay_headers(headers):
+    """上游响应头中可以原样转发给客户端的部分（含 Content-Type、request-id、限流信息等）"""
+    return {name: value for name, value in headers.items() if name.lower() not in _NON_RELAYED_HEADERS}
+
+
+# ─── 同步模式：requests + urllib3 连接池 ─────────────────────
+
+class _PoolStatsMixin:
+    """在 urllib3 连接池上统计复用情况，并关闭空闲过久的 keep-alive 连接"""
+
+    def _get_conn(self, timeout=None):
+        waited = self.block and self.pool is not None and self.pool.empty()
+        conn = super()._get_conn(timeout)
+        idle_closed = 0
+        idle_since = getattr(conn, '_idle_since', None)
+        if (idle_since is not None and getattr(conn, 'sock', None) is not None
+                and time.monotonic() - idle_since > Config.UPSTREAM_IDLE_TIMEOUT):
+            # 中转站/负载均衡通常会静默断开空闲连接，复用这类连接会直接失败
+            conn.close()
+            idle_closed = 1
+        if getattr(conn, 'sock', None) is None:
+            _count(requests=1, new_connections=1, waits=int(waited), idle_closed=idle_closed)
+        else:
+            _count(requests=1, hits=1, waits=int(waited))
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn._idle_since = time.monotonic()
+        super()._put_conn(conn)
+
+
+class _StatsHTTPConnectionPool(_PoolStatsMixin, HTTPConnectionPool):
+    pass
+
+
+class _StatsHTTPSConnectionPool(_PoolStatsMixin, HTTPSConnectionPool):
+    pass
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _StatsHTTPConnectionPool,
+            'https': _StatsHTTPSConnectionPool,
+        }
+
+
+def get_session():
+    """进程内共享的上游 Session，所有请求复用 keep-alive 连接"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = _PooledAdapter(
+                    pool_connections=Config.UPSTREAM_POOL_HOSTS,
+                    pool_maxsize=Config.UPSTREAM_POOL_PER_HOST,
+                    pool_block=Config.UPSTREAM_POOL_BLOCK,
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def iter_stream_bytes(resp, chunk_size=65536):
+    """逐块读取流式响应：有多少数据就返回多少，不会为凑满 chunk_size 而阻塞"""
+    read1 = getattr(resp.raw, 'read1', None)
+    if read1 is None:
+        # urllib3 < 2.3 没有 read1，退回 iter_lines 使用的小块读取
+        yield from resp.iter_content(chunk_size=512)
+        return
+    try:
+        while True:
+            data = read1(chunk_size, decode_content=True)
+            if not data:
+                return
+            yield data
+    except urllib3.exceptions.HTTPError as e:
+        raise requests.ConnectionError(e, response=resp) from e
+
+
+# ─── 异步模式：httpx 连接池（可选 HTTP/2） ──────────────────
+
+class _StatsAsyncTransport(httpx.AsyncHTTPTransport):
+    """通过 httpcore trace 区分新建连接与复用连接"""
+
+    async def handle_async_request(self, request):
+        pool = self._pool
+        max_connections = pool._max_connections
+        if max_connections is not None and len(pool.connections) >= max_connections:
+            if not any(conn.is_idle() for conn in pool.connections):
+                _count(waits=1)
+
+        connected = False
+
+        async def trace(event_name, info):
+            nonlocal connected
+            if event_name == 'connection.connect_tcp.complete':
+                connected = True
+
+        request.extensions = {**request.extensions, 'trace': trace}
+        response = await super().handle_async_request(request)
+        if connected:
+            _count(requests=1, new_connections=1)
+        else:
+            _count(requests=1, hits=1)
+        return response
+
+
+def create_async_client():
+    """创建异步上游客户端；连接池参数与同步模式共用同一组配置"""
+    pool_size = Config.UPSTREAM_POOL_HOSTS * Config.UPSTREAM_POOL_PER_HOST
+    limits = httpx.Limits(
+        max_connections=pool_size if Config.UPSTREAM_POOL_BLOCK else None,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=Config.UPSTREAM_IDLE_TIMEOUT,
+    )
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(Config.API_TIMEOUT),
+        transport=_StatsAsyncTransport(http2=Config.UPSTREAM_HTTP2, limits=limits),
+    )